@@ -12,6 +12,10 @@ from typing import Optional
 
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import writer
+from db import GrowBotDB, filtro_particao, snapshot_atual
 
 app = FastAPI(
     title="GrowBot API",
@@ -26,12 +30,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Conexão read-only para evitar problemas de lock
+# Leituras vão no snapshot publicado pelo sync (nunca no arquivo do writer)
 DB_PATH = Path(__file__).parent / "growbot.duckdb"
 
 def get_db():
-    """Cria conexão read-only fresh para cada request"""
-    return duckdb.connect(str(DB_PATH), read_only=True)
+    """Cria conexão read-only fresh no snapshot atual para cada request"""
+    return duckdb.connect(str(snapshot_atual(DB_PATH)), read_only=True)
 
 # Drivers válidos
 DRIVERS = ["RAFA", "FRANCIS", "RODRIGO", "KAROL", "ARTHUR"]
@@ -87,7 +91,7 @@ def health_check():
     """Health check da API"""
     try:
         conn = get_db()
-        total = conn.execute("SELECT COUNT(*) FROM movimentos").fetchone()[0]
+        total = conn.execute("SELECT COUNT(*) FROM movimentos_todos").fetchone()[0]
         conn.close()
         return {
             "status": "ok",
@@ -118,96 +122,16 @@ def get_kpis(
 ):
     """
     Retorna KPIs calculados (replica lógica do TUI)
+    Lidos das somas prefixadas (kpis_acumulados): duas linhas por request
     """
-    # Converte datas
     data_ini_iso = parse_date_br(data_inicio) if data_inicio else None
     data_fim_iso = parse_date_br(data_fim) if data_fim else None
 
-    # Query base com filtros
-    where_clauses = []
-    params = []
-
-    if data_ini_iso:
-        where_clauses.append("data_movimento >= ?")
-        params.append(data_ini_iso)
-    if data_fim_iso:
-        where_clauses.append("data_movimento <= ?")
-        params.append(data_fim_iso)
-    if driver and driver != "TODOS":
-        where_clauses.append("driver = ?")
-        params.append(driver)
-
-    where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
-
-    # KPIs de entregas (IDs distintos)
-    query_entregas = f"""
-        SELECT COUNT(DISTINCT endereco || '-' || data_movimento || '-' || driver) as total
-        FROM movimentos
-        WHERE tipo = 'entrega' AND {where_sql}
-    """
-    entregas_result = get_db().execute(query_entregas, params).fetchone()
-    kpi_entregas = entregas_result[0] if entregas_result else 0
-
-    # KPIs de retiradas (datas distintas com recarga)
-    query_retiradas = f"""
-        SELECT COUNT(DISTINCT data_movimento) as total
-        FROM movimentos
-        WHERE tipo = 'recarga' AND {where_sql}
-    """
-    retiradas_result = get_db().execute(query_retiradas, params).fetchone()
-    kpi_retiradas = retiradas_result[0] if retiradas_result else 0
-
-    # Totais por tipo
-    query_totais = f"""
-        SELECT
-            tipo,
-            SUM(quantidade) as total
-        FROM movimentos
-        WHERE {where_sql}
-        GROUP BY tipo
-    """
-    totais = get_db().execute(query_totais, params).fetchall()
-
-    total_estoque = 0
-    total_recarga = 0
-    total_entrega = 0
-
-    for tipo, total in totais:
-        if tipo == "estoque":
-            total_estoque = total or 0
-        elif tipo == "recarga" or tipo == "resgate_entrada":
-            total_recarga += total or 0
-        elif tipo == "entrega" or tipo == "resgate_saida":
-            total_entrega += total or 0
-
-    # Produtos negativos
-    query_negativos = f"""
-        SELECT COUNT(*) FROM (
-            SELECT
-                driver, produto,
-                SUM(CASE WHEN tipo IN ('estoque', 'recarga', 'resgate_entrada') THEN quantidade ELSE 0 END) -
-                SUM(CASE WHEN tipo IN ('entrega', 'resgate_saida') THEN quantidade ELSE 0 END) as saldo
-            FROM movimentos
-            WHERE {where_sql}
-            GROUP BY driver, produto
-            HAVING saldo < 0
-        )
-    """
-    negativos_result = get_db().execute(query_negativos, params).fetchone()
-    kpi_negativos = negativos_result[0] if negativos_result else 0
-
-    # Saldo total
-    saldo = total_estoque + total_recarga - total_entrega
-
-    return {
-        "entregas": kpi_entregas,
-        "retiradas": kpi_retiradas,
-        "negativos": kpi_negativos,
-        "total_recarga": total_recarga,
-        "total_entrega": total_entrega,
-        "total_estoque": total_estoque,
-        "saldo": saldo
-    }
+    db = GrowBotDB.snapshot(DB_PATH)
+    try:
+        return db.kpis_periodo(data_ini_iso, data_fim_iso, driver)
+    finally:
+        db.close()
 
 
 @app.get("/api/movimentos")
@@ -246,7 +170,7 @@ def get_movimentos(
             CAST(data_movimento AS VARCHAR) as data,
             tipo,
             SUM(quantidade) as total
-        FROM movimentos
+        FROM movimentos_diarios
         WHERE {where_sql}
         GROUP BY driver, produto, data_movimento, tipo
         ORDER BY driver, produto, data_movimento
@@ -357,20 +281,22 @@ def get_cards(
         where_clauses.append("driver = ?")
         params.append(driver)
 
-    where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
+    where_clauses.append(filtro_particao(data_ini_iso, data_fim_iso))  # poda partições do archive/
+    where_sql = " AND ".join(where_clauses)
 
-    # Busca entregas agrupadas
+    # Busca entregas agrupadas pela chave da entrega
     query_entregas = f"""
         SELECT
             CAST(data_movimento AS VARCHAR) as data,
             driver,
-            endereco,
+            entrega_id,
+            ANY_VALUE(endereco) as endereco,
             produto,
             SUM(quantidade) as total
-        FROM movimentos
+        FROM movimentos_todos
         WHERE tipo = 'entrega' AND {where_sql}
-        GROUP BY data_movimento, driver, endereco, produto
-        ORDER BY data_movimento DESC, driver
+        GROUP BY data_movimento, driver, entrega_id, produto
+        ORDER BY data_movimento DESC, driver, entrega_id
     """
 
     entregas = get_db().execute(query_entregas, params).fetchall()
@@ -382,7 +308,7 @@ def get_cards(
             driver,
             produto,
             SUM(quantidade) as total
-        FROM movimentos
+        FROM movimentos_todos
         WHERE tipo = 'recarga' AND {where_sql}
         GROUP BY data_movimento, driver, produto
         ORDER BY data_movimento DESC, driver
@@ -394,7 +320,7 @@ def get_cards(
     cards_dict = {}
 
     # Processa entregas
-    for data, drv, endereco, produto, total in entregas:
+    for data, drv, entrega_id, endereco, produto, total in entregas:
         key = (data, drv)
         if key not in cards_dict:
             cards_dict[key] = {
@@ -410,14 +336,14 @@ def get_cards(
                 "recargas": []
             }
 
-        # Agrupa por endereco (como ID proxy)
-        if endereco not in cards_dict[key]["entregas"]:
-            cards_dict[key]["entregas"][endereco] = []
-        cards_dict[key]["entregas"][endereco].append({
+        # Agrupa por entrega_id (uma entrega pode ter vários produtos)
+        if entrega_id not in cards_dict[key]["entregas"]:
+            cards_dict[key]["entregas"][entrega_id] = {"endereco": endereco, "produtos": []}
+            cards_dict[key]["resumo"]["total_entregas"] += 1
+        cards_dict[key]["entregas"][entrega_id]["produtos"].append({
             "produto": produto,
             "quantidade": total
         })
-        cards_dict[key]["resumo"]["total_entregas"] += 1
         cards_dict[key]["resumo"]["total_unidades"] += total
 
     # Processa recargas
@@ -448,10 +374,10 @@ def get_cards(
     for key in sorted(cards_dict.keys(), key=lambda x: x[0], reverse=True):
         card = cards_dict[key]
         entregas_list = []
-        for endereco, produtos in card["entregas"].items():
+        for entrega in card["entregas"].values():
             entregas_list.append({
-                "id": endereco or "sem-endereco",
-                "produtos": [f"{p['quantidade']} {p['produto']}" for p in produtos]
+                "id": entrega["endereco"] or "sem-endereco",
+                "produtos": [f"{p['quantidade']} {p['produto']}" for p in entrega["produtos"]]
             })
         card["entregas"] = entregas_list
         cards_list.append(card)
@@ -482,6 +408,7 @@ def get_detalhes(
         where_clauses.append("data_movimento <= ?")
         params.append(data_fim_iso)
 
+    where_clauses.append(filtro_particao(data_ini_iso, data_fim_iso))  # poda partições do archive/
     where_sql = " AND ".join(where_clauses)
 
     query = f"""
@@ -489,7 +416,7 @@ def get_detalhes(
             CAST(data_movimento AS VARCHAR) as data,
             endereco,
             quantidade
-        FROM movimentos
+        FROM movimentos_todos
         WHERE {where_sql}
         ORDER BY data_movimento DESC, endereco
     """
@@ -545,7 +472,7 @@ def get_saldo(driver: str = Query(None, description="Filtrar por driver")):
             SUM(CASE WHEN tipo = 'estoque' THEN quantidade ELSE 0 END) +
             SUM(CASE WHEN tipo = 'recarga' THEN quantidade ELSE 0 END) -
             SUM(CASE WHEN tipo = 'entrega' THEN quantidade ELSE 0 END) as saldo
-        FROM movimentos
+        FROM movimentos_diarios
     """
     params = []
     if driver and driver != "TODOS":
@@ -562,6 +489,88 @@ def get_saldo(driver: str = Query(None, description="Filtrar por driver")):
     return {"saldos": saldos}
 
 
+@app.get("/api/alertas")
+def get_alertas(driver: str = Query(None, description="Filtrar por driver")):
+    """
+    Pares (driver, produto) com saldo negativo agora (tabela alertas_saldo)
+    """
+    db = GrowBotDB.snapshot(DB_PATH)
+    try:
+        return {"alertas": db.alertas(driver)}
+    finally:
+        db.close()
+
+
+@app.get("/api/alertas/log")
+def get_alertas_log(
+    desde: int = Query(0, description="Eventos com id maior que este"),
+    limite: int = Query(100, description="Máximo de eventos")
+):
+    """
+    Log de quando cada (driver, produto) ficou negativo ou se recuperou
+    """
+    db = GrowBotDB.snapshot(DB_PATH)
+    try:
+        return {"eventos": db.alertas_log(desde, limite)}
+    finally:
+        db.close()
+
+
+@app.get("/api/alertas/stream")
+async def stream_alertas():
+    """
+    Server-Sent Events com os alertas novos, repassados do writer
+    (um evento por mudança; comentário de keepalive a cada 15s).
+    Lê o socket do writer com asyncio: cliente aberto não ocupa o threadpool
+    dos endpoints síncronos
+    """
+    if not writer.writer_ativo():
+        return JSONResponse({"error": "Writer parado"}, status_code=503)
+
+    async def eventos():
+        async for evento in writer.assinar_alertas_async(timeout=15):
+            if evento is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {evento['evento']}\ndata: {json.dumps(evento, default=str)}\n\n"
+
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
+
+@app.get("/api/enderecos")
+def get_enderecos(
+    q: str = Query(..., description="Endereço em qualquer grafia (ex: r. londres 913)"),
+    limite: int = Query(20, description="Máximo de endereços")
+):
+    """
+    Busca endereços de entrega pela chave normalizada (índice de trigramas)
+    """
+    db = GrowBotDB.snapshot(DB_PATH)
+    try:
+        return {"enderecos": db.buscar_enderecos(q, limite)}
+    finally:
+        db.close()
+
+
+@app.get("/api/enderecos/entregas")
+def get_entregas_endereco(
+    endereco: str = Query(..., description="Endereço em qualquer grafia"),
+    data_inicio: str = Query(None, description="Data início DD/MM/YYYY"),
+    data_fim: str = Query(None, description="Data fim DD/MM/YYYY")
+):
+    """
+    Todas as entregas num endereço (grafias do mesmo endereço batem)
+    """
+    db = GrowBotDB.snapshot(DB_PATH)
+    try:
+        entregas = db.entregas(parse_date_br(data_inicio) if data_inicio else None,
+                               parse_date_br(data_fim) if data_fim else None,
+                               endereco=endereco)
+    finally:
+        db.close()
+    return {"total": len(entregas), "entregas": entregas}
+
+
 # ============ ENDPOINTS LEGADOS (compatibilidade) ============
 
 def get_latest_output(provider: str) -> dict:
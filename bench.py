@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Benchmarks do GrowBot (DuckDB).
+Gera dados sintéticos no mesmo formato de output/*.json (ou direto num banco
+GrowBotDB) e mede o sync, o layout e as consultas de views, API e TUI.
+"""
+
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+from db import GrowBotDB
+
+DRIVERS = ["RAFA", "FRANCIS", "RODRIGO", "KAROL", "ARTHUR"]
+PRODUTOS = [
+    "afeghan", "bubba", "sower", "super lemon", "exporta", "ice khalifa", "ice nugg",
+    "dry", "bala cnn", "bala canadian", "bala elon musk", "arizona", "gold", "marmita",
+    "escama", "prensado", "abacaxi", "meleca", "seda", "md", "tabaco", "papel", "orange",
+]
+
+# Logradouros dos endereços sintéticos, já na forma normalizada (chave = rua + número)
+RUAS = [
+    "londres", "paris", "tapajos", "afonso pena", "rio branco", "joao pessoa", "landscape",
+    "bento goncalves", "cesario alvim", "paraiba", "uirapuru", "araguari", "patagonia",
+    "albatroz", "mutum", "las vegas", "carlos gomes", "nego amancio", "luiz fuad abib",
+    "bolonha", "cometa", "jacaranda", "oscarina cunha chaves", "pedro jose samora",
+]
+
+
+def gerar_jsons(destino: Path, movimentos: int, arquivos: int = 100, seed: int = 42) -> int:
+    """
+    Gera arquivos estoque_/recarga_/saidas_*.json com ~`movimentos` items no total.
+    Retorna quantidade de items gerados.
+    """
+    rnd = random.Random(seed)
+    destino.mkdir(parents=True, exist_ok=True)
+    inicio = date(2024, 1, 1)
+    por_arquivo = max(1, movimentos // arquivos)
+    total = 0
+
+    for n in range(arquivos):
+        driver = DRIVERS[n % len(DRIVERS)]
+        dia = inicio + timedelta(days=n // len(DRIVERS))
+        data_br = dia.strftime("%d/%m/%Y")
+        data_arq = dia.strftime("%Y%m%d")
+        qtd = por_arquivo if n < arquivos - 1 else movimentos - total
+
+        # ~10% estoque, ~20% recarga, ~70% saídas
+        sorteio = n % 10
+        if sorteio == 0:
+            nome = f"estoque_{data_arq}_{driver}_{n}.json"
+            items = [{"driver": driver, "produto": rnd.choice(PRODUTOS),
+                      "quantidade": rnd.randint(5, 50), "data_registro": data_br}
+                     for _ in range(qtd)]
+            data = {"tipo": "estoque", "items": items}
+        elif sorteio in (1, 2):
+            nome = f"recarga_{data_arq}_{driver}_{n}.json"
+            items = [{"driver": driver, "produto": rnd.choice(PRODUTOS),
+                      "quantidade": rnd.randint(10, 50), "data_recarga": data_br}
+                     for _ in range(qtd)]
+            data = {"tipo": "recarga", "items": items}
+        else:
+            nome = f"saidas_{data_arq}_{driver}_{n}.json"
+            items = [{"id_sale_delivery": f"{i // 2 + 1:03d}", "produto": rnd.choice(PRODUTOS),
+                      "quantidade": rnd.randint(1, 5), "endereco_1": f"Rua {rnd.randint(1, 500)} {i // 2}",
+                      "driver": driver, "data_entrega": data_br}
+                     for i in range(qtd)]
+            data = {"items": items}
+
+        with open(destino / nome, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        total += qtd
+
+    return total
+
+
+def _produtos(n: int) -> list:
+    """n nomes de produto: PRODUTOS e, passando deles, variações numeradas"""
+    return [
+        PRODUTOS[i % len(PRODUTOS)] + (f" {i // len(PRODUTOS) + 1}" if i >= len(PRODUTOS) else "")
+        for i in range(n)
+    ]
+
+
+def gerar_banco(db_path: Path, movimentos: int, anos: int = 2, produtos: int = 30,
+                fim: date = None, seed: int = 42) -> dict:
+    """
+    Preenche um banco GrowBotDB com ~`movimentos` linhas sintéticas em `anos`
+    anos até `fim` (default: hoje), 5 drivers e `produtos` produtos:
+    recarga de todos os produtos a cada 3 dias (repõe o consumo médio),
+    contagem de estoque todo dia 1º e entregas com o resto das linhas
+    (2 itens cada, poucos produtos concentram as vendas, clientes se repetem).
+    Linhas entram em ordem de data, como no import diário; as derivadas são
+    recalculadas no fim. Retorna contagens e tempos
+    """
+    fim = fim or date.today()
+    dias = anos * 365
+    inicio = fim - timedelta(days=dias - 1)
+    nomes = _produtos(produtos)
+
+    recargas = produtos * sum(1 for k in range(len(DRIVERS)) for d in range(dias) if (d + k) % 3 == 0)
+    estoques = produtos * len(DRIVERS) * sum(1 for d in range(dias) if (inicio + timedelta(days=d)).day == 1)
+    entregas = movimentos - recargas - estoques
+    if entregas < dias * len(DRIVERS):
+        raise ValueError(f"{movimentos} movimentos não cobrem {anos} anos x {produtos} produtos "
+                         f"(mínimo {recargas + estoques + dias * len(DRIVERS)})")
+
+    # Unidades por driver/dia/produto: itens do dia x 2 unidades em média x peso do produto
+    # (produto = floor(n * u²): o peso do i-ésimo é sqrt((i+1)/n) - sqrt(i/n))
+    consumo = f"{entregas} * 2.0 / ({dias} * {len(DRIVERS)}) * (sqrt((p + 1) / {produtos}) - sqrt(p / {produtos}))"
+    params = {"inicio": inicio, "drivers": DRIVERS, "produtos": nomes, "ruas": RUAS, "seed": seed}
+
+    db = GrowBotDB(db_path, read_only=False)
+    try:
+        t0 = time.perf_counter()
+        db.conn.execute(f"""
+            INSERT INTO movimentos (tipo, driver, produto, quantidade, data_movimento, endereco,
+                                    arquivo_origem, entrega_id, id_sale_delivery,
+                                    endereco_chave, endereco_numero)
+            WITH itens AS (
+                SELECT
+                    i,
+                    hash(i, $seed) as h,
+                    hash(i // 2, $seed) as h_entrega,
+                    CAST(i * {dias} // {entregas} AS INTEGER) as dia
+                FROM range({entregas}) t(i)
+            ),
+            entregas AS (
+                SELECT
+                    'entrega' as tipo,
+                    $drivers[1 + (i // 2) % {len(DRIVERS)}] as driver,
+                    $produtos[1 + CAST(floor({produtos} * pow((h >> 16) % 1000000 / 1000000.0, 2)) AS INTEGER)] as produto,
+                    CAST(1 + (h >> 8) % 3 AS INTEGER) as quantidade,
+                    CAST($inicio AS DATE) + dia as data_movimento,
+                    CAST((h_entrega >> 24) % {max(50, entregas // 40)} AS BIGINT) as cliente,
+                    CAST(h_entrega >> 1 AS BIGINT) as entrega_id,
+                    lpad(CAST((i // 10) % 1000 + 1 AS VARCHAR), 3, '0') as id_sale_delivery
+                FROM itens
+            ),
+            grade AS (
+                SELECT
+                    CAST(d AS INTEGER) as dia, CAST(k AS INTEGER) as k, CAST(p AS INTEGER) as p,
+                    CAST($inicio AS DATE) + CAST(d AS INTEGER) as data_movimento,
+                    hash(d, k, p, $seed) as h
+                FROM range({dias}) t1(d), range({len(DRIVERS)}) t2(k), range({produtos}) t3(p)
+            )
+            SELECT * FROM (
+                SELECT
+                    tipo, driver, produto, quantidade, data_movimento,
+                    'Rua ' || $ruas[1 + cliente % {len(RUAS)}] || ' ' || (cliente // {len(RUAS)} + 1),
+                    'entregas_bench_' || strftime(data_movimento, '%Y%m%d') || '.json',
+                    entrega_id, id_sale_delivery,
+                    $ruas[1 + cliente % {len(RUAS)}] || ' ' || (cliente // {len(RUAS)} + 1),
+                    CAST(cliente // {len(RUAS)} + 1 AS VARCHAR)
+                FROM entregas
+                UNION ALL
+                SELECT
+                    'recarga', $drivers[1 + k], $produtos[1 + p],
+                    GREATEST(1, CAST(round(3 * {consumo} * (0.9 + h % 30 / 100.0)) AS INTEGER)),
+                    data_movimento, NULL,
+                    'recarga_' || strftime(data_movimento, '%Y%m%d') || '_' || $drivers[1 + k] || '.json',
+                    NULL, NULL, NULL, NULL
+                FROM grade
+                WHERE (dia + k) % 3 = 0
+                UNION ALL
+                SELECT
+                    'estoque', $drivers[1 + k], $produtos[1 + p],
+                    CAST(round({consumo} * (h % 3)) AS INTEGER),
+                    data_movimento, NULL,
+                    'estoque_' || strftime(data_movimento, '%Y%m%d') || '_' || $drivers[1 + k] || '.json',
+                    NULL, NULL, NULL, NULL
+                FROM grade
+                WHERE day(data_movimento) = 1
+            )
+            ORDER BY 5, 7
+        """, params)
+        gerar_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        db.conn.begin()
+        try:
+            db._atualizar_derivados()
+            db.conn.commit()
+        except Exception:
+            db.conn.rollback()
+            raise
+        db.conn.execute("CHECKPOINT")
+        derivadas_s = time.perf_counter() - t0
+    finally:
+        db.close()
+
+    return {
+        "registros": entregas + recargas + estoques,
+        "entregas": entregas,
+        "recargas": recargas,
+        "estoques": estoques,
+        "itens_por_driver_dia": entregas / (dias * len(DRIVERS)),
+        "inicio": inicio,
+        "fim": fim,
+        "gerar_s": gerar_s,
+        "derivadas_s": derivadas_s,
+    }
+
+
+def bench_sync(movimentos: int, arquivos: int = 100, workers: int = None) -> dict:
+    """Mede sync_all sobre JSONs sintéticos num banco novo."""
+    tmp = Path(tempfile.mkdtemp(prefix="growbot_bench_"))
+    try:
+        output = tmp / "output"
+        gerar_jsons(output, movimentos, arquivos)
+
+        db = GrowBotDB(tmp / "bench.duckdb", read_only=False)
+        inicio = time.perf_counter()
+        resultado = db.sync_all(output_path=output, workers=workers)
+        duracao = time.perf_counter() - inicio
+        db.close()
+
+        registros = resultado["registros_importados"]
+        return {
+            "registros": registros,
+            "arquivos": resultado["arquivos_processados"],
+            "segundos": duracao,
+            "registros_por_s": registros / duracao if duracao else 0.0,
+        }
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _tamanho_banco(db: GrowBotDB) -> int:
+    """Bytes em blocos usados do arquivo (sem os blocos livres)"""
+    usados, bloco = db.conn.execute(
+        "SELECT used_blocks, block_size FROM pragma_database_size()"
+    ).fetchone()
+    return usados * bloco
+
+
+def _medir_funcao(funcao, repeticoes: int = 5) -> float:
+    """Melhor tempo (ms) de `repeticoes` chamadas, depois de uma de aquecimento"""
+    funcao()
+    melhor = float("inf")
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return melhor * 1000
+
+
+def _medir(db: GrowBotDB, sql: str, params: list, repeticoes: int = 5) -> float:
+    """Melhor tempo (ms) de `repeticoes` execuções"""
+    return _medir_funcao(lambda: db.conn.execute(sql, params).fetchall(), repeticoes)
+
+
+# Consultas que filtram movimentos por período (rollup de uma semana, entregas
+# de um driver no mês, recargas da aba de cards)
+CONSULTAS_PERIODO = {
+    "rollup_semana": ("""
+        SELECT data_movimento, driver, produto, tipo, SUM(quantidade), COUNT(*), COUNT(DISTINCT entrega_id)
+        FROM movimentos
+        WHERE data_movimento BETWEEN ? AND CAST(? AS DATE) + 6
+        GROUP BY data_movimento, driver, produto, tipo
+    """, 2),
+    "entregas_driver_mes": ("""
+        SELECT id_sale_delivery, produto, quantidade, endereco
+        FROM movimentos
+        WHERE tipo = 'entrega' AND driver = 'RODRIGO'
+          AND data_movimento BETWEEN ? AND CAST(? AS DATE) + 30
+    """, 2),
+    "recargas_mes": ("""
+        SELECT data_movimento, driver, produto, quantidade
+        FROM movimentos
+        WHERE tipo = 'recarga' AND data_movimento BETWEEN ? AND CAST(? AS DATE) + 30
+    """, 2),
+}
+
+
+def bench_layout(movimentos: int, dias: int = 2000) -> dict:
+    """
+    Mede tamanho e consultas por período em movimentos antes e depois de
+    GrowBotDB.reorganizar(). As linhas sintéticas entram em ordem aleatória
+    de data (pior caso de import)
+    """
+    tmp = Path(tempfile.mkdtemp(prefix="growbot_bench_"))
+    try:
+        db = GrowBotDB(tmp / "bench.duckdb", read_only=False)
+        drivers = ", ".join(f"'{d}'" for d in DRIVERS)
+        produtos = ", ".join(f"'{p}'" for p in PRODUTOS)
+        db.conn.execute(f"""
+            INSERT INTO movimentos (tipo, driver, produto, quantidade, data_movimento,
+                                    endereco, arquivo_origem, entrega_id, id_sale_delivery)
+            SELECT
+                CASE WHEN h % 10 = 0 THEN 'estoque' WHEN h % 10 < 3 THEN 'recarga' ELSE 'entrega' END,
+                ([{drivers}])[1 + (h >> 8) % {len(DRIVERS)}],
+                ([{produtos}])[1 + (h >> 16) % {len(PRODUTOS)}],
+                1 + (h >> 24) % 20,
+                DATE '2020-01-01' + CAST((h >> 32) % {dias} AS INTEGER),
+                'Rua ' || (h >> 40) % 5000,
+                'bench_' || (h >> 32) % {dias} || '.json',
+                h >> 1,
+                CAST(i AS VARCHAR)
+            FROM (SELECT i, CAST(hash(i) & 9223372036854775807 AS BIGINT) as h FROM range(?) t(i))
+        """, [movimentos])
+        db.conn.execute("CHECKPOINT")
+
+        inicio_periodo = date(2020, 1, 1) + timedelta(days=dias // 2)
+        resultado = {"registros": movimentos}
+        for fase in ("antes", "depois"):
+            if fase == "depois":
+                t0 = time.perf_counter()
+                db.reorganizar()
+                resultado["reorganizar_s"] = time.perf_counter() - t0
+            resultado[fase] = {"bytes": _tamanho_banco(db)}
+            for nome, (sql, n) in CONSULTAS_PERIODO.items():
+                resultado[fase][nome] = _medir(db, sql, [inicio_periodo] * n)
+        db.close()
+        return resultado
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def bench_consultas(movimentos: int, anos: int = 2, produtos: int = 30, repeticoes: int = 3) -> dict:
+    """
+    Gera um banco sintético (gerar_banco) e mede cada view v_*, cada endpoint
+    da API que lê o banco (chamando a função do endpoint, com o pós-processamento)
+    e as consultas do refresh da tabela da TUI. Períodos: última semana
+    (default da TUI) e último mês. Retorna {"geracao": ..., "tempos": {consulta: ms}}
+    """
+    import api
+    import tui
+
+    tmp = Path(tempfile.mkdtemp(prefix="growbot_bench_"))
+    try:
+        banco = tmp / "bench.duckdb"
+        geracao = gerar_banco(banco, movimentos, anos, produtos)
+
+        fim = geracao["fim"]
+        semana, mes = fim - timedelta(days=6), fim - timedelta(days=29)
+        br = lambda d: d.strftime("%d/%m/%Y")
+        driver, produto = DRIVERS[2], _produtos(produtos)[0]
+        endereco = f"R. {RUAS[0].title()}, nº 1"
+
+        db = GrowBotDB(banco)
+        tempos = {}
+        views = db.conn.execute("""
+            SELECT view_name FROM duckdb_views()
+            WHERE NOT internal AND starts_with(view_name, 'v_')
+            ORDER BY view_name
+        """).fetchall()
+        for (view,) in views:
+            tempos[f"view {view}"] = _medir(db, f"SELECT * FROM {view}", [], repeticoes)
+
+        # Endpoints chamados direto: sem snapshot publicado, get_db() abre o próprio banco
+        api.DB_PATH = banco
+        endpoints = {
+            "/api/health": lambda: api.health_check(),
+            "/api/kpis (semana)": lambda: api.get_kpis(br(semana), br(fim), "TODOS"),
+            "/api/kpis (tudo)": lambda: api.get_kpis(None, None, "TODOS"),
+            "/api/movimentos (semana)": lambda: api.get_movimentos(br(semana), br(fim), "TODOS"),
+            "/api/cards (semana)": lambda: api.get_cards(br(semana), br(fim), "TODOS"),
+            "/api/detalhes (mês)": lambda: api.get_detalhes(driver, produto, br(mes), br(fim)),
+            "/api/saldo": lambda: api.get_saldo(None),
+            "/api/alertas": lambda: api.get_alertas(None),
+            "/api/alertas/log": lambda: api.get_alertas_log(0, 100),
+            "/api/enderecos": lambda: api.get_enderecos(endereco, 20),
+            "/api/enderecos/entregas": lambda: api.get_entregas_endereco(endereco, None, None),
+        }
+        for nome, funcao in endpoints.items():
+            tempos[nome] = _medir_funcao(funcao, repeticoes)
+
+        # GrowBotTUI._refresh_table: tabela, KPIs e alertas
+        for nome, filtro in (("tui tabela (semana)", "TODOS"), ("tui tabela (semana, driver)", driver)):
+            sql, params = tui.consulta_tabela(semana.isoformat(), fim.isoformat(), filtro)
+            tempos[nome] = _medir(db, sql, params, repeticoes)
+        tempos["tui kpis (semana)"] = _medir_funcao(
+            lambda: db.kpis_periodo(semana.isoformat(), fim.isoformat(), "TODOS"), repeticoes
+        )
+        tempos["tui alertas"] = _medir_funcao(lambda: db.alertas("TODOS"), repeticoes)
+        db.close()
+
+        return {"geracao": geracao, "tempos": tempos}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _rotulo(n: int) -> str:
+    """100000 -> 100k, 10000000 -> 10M"""
+    for divisor, sufixo in ((1_000_000, "M"), (1_000, "k")):
+        if n >= divisor and n % divisor == 0:
+            return f"{n // divisor}{sufixo}"
+    return str(n)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks do GrowBot")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p_sync = sub.add_parser("sync", help="Mede sync_all em JSONs sintéticos")
+    p_sync.add_argument("--movimentos", type=int, default=1_000_000)
+    p_sync.add_argument("--arquivos", type=int, default=100)
+    p_sync.add_argument("--workers", type=int, default=None,
+                        help="Processos de decode (default: nº de CPUs)")
+
+    p_layout = sub.add_parser("layout", help="Tamanho e consultas por período antes/depois de reorganizar")
+    p_layout.add_argument("--movimentos", type=int, default=10_000_000)
+
+    p_gerar = sub.add_parser("gerar", help="Gera um banco sintético no formato do GrowBotDB")
+    p_gerar.add_argument("banco", type=Path)
+    p_gerar.add_argument("--movimentos", type=int, default=1_000_000)
+    p_gerar.add_argument("--anos", type=int, default=2)
+    p_gerar.add_argument("--produtos", type=int, default=30)
+
+    p_consultas = sub.add_parser("consultas", help="Tempo das views, endpoints da API e tabela da TUI")
+    p_consultas.add_argument("--movimentos", type=int, nargs="+",
+                             default=[100_000, 1_000_000, 10_000_000])
+    p_consultas.add_argument("--anos", type=int, default=2)
+    p_consultas.add_argument("--produtos", type=int, default=30)
+    p_consultas.add_argument("--repeticoes", type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.cmd == "sync":
+        r = bench_sync(args.movimentos, args.arquivos, args.workers)
+        print(f"sync_all: {r['registros']} registros de {r['arquivos']} arquivos "
+              f"em {r['segundos']:.2f}s ({r['registros_por_s']:,.0f} registros/s)")
+
+    elif args.cmd == "layout":
+        r = bench_layout(args.movimentos)
+        print(f"movimentos: {r['registros']:,} registros (reorganizar: {r['reorganizar_s']:.1f}s)")
+        print(f"{'':26} {'antes':>12} {'depois':>12}")
+        for chave in r["antes"]:
+            antes, depois = r["antes"][chave], r["depois"][chave]
+            if chave == "bytes":
+                print(f"{'tamanho (MB)':26} {antes / 1e6:12.1f} {depois / 1e6:12.1f}")
+            else:
+                print(f"{chave + ' (ms)':26} {antes:12.1f} {depois:12.1f}")
+
+    elif args.cmd == "gerar":
+        if args.banco.exists():
+            parser.error(f"{args.banco} já existe")
+        r = gerar_banco(args.banco, args.movimentos, args.anos, args.produtos)
+        print(f"{args.banco}: {r['registros']:,} movimentos de {r['inicio']} a {r['fim']} "
+              f"({r['entregas']:,} itens de entrega, {r['itens_por_driver_dia']:.0f} por driver/dia; "
+              f"{r['recargas']:,} recargas; {r['estoques']:,} estoques)")
+        print(f"geração: {r['gerar_s']:.1f}s, derivadas: {r['derivadas_s']:.1f}s")
+
+    elif args.cmd == "consultas":
+        resultados = {}
+        for n in args.movimentos:
+            resultados[n] = bench_consultas(n, args.anos, args.produtos, args.repeticoes)
+            g = resultados[n]["geracao"]
+            print(f"{_rotulo(n)}: gerado em {g['gerar_s']:.1f}s + derivadas {g['derivadas_s']:.1f}s "
+                  f"({g['itens_por_driver_dia']:.0f} itens de entrega por driver/dia)", file=sys.stderr)
+
+        print(f"{'consulta (ms)':34}" + "".join(f"{_rotulo(n):>10}" for n in args.movimentos))
+        for nome in resultados[args.movimentos[0]]["tempos"]:
+            print(f"{nome:34}" + "".join(f"{resultados[n]['tempos'][nome]:10.1f}" for n in args.movimentos))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Cache de blocos quase duplicados.
+Pedidos recorrentes ("2 dry 1 ice, Rua X 123") mudam só timestamp, autor e 🏎️ id;
+normalizamos o conteúdo para reaproveitar a extração anterior sem chamar o LLM.
+"""
+
+import copy
+import hashlib
+import json
+import re
+import unicodedata
+from pathlib import Path
+
+from validator import validar_item
+
+CACHE_PATH = Path(__file__).parent / ".cache" / "blocos.json"
+
+# Prefixos de mensagem do WhatsApp (timestamp + autor)
+RE_PREFIXOS = [
+    re.compile(r'^‎?\[[^\]]*\]\s*[^:]*:\s*'),                      # [21/12/25, 00:48:00] Nome:
+    re.compile(r'^\d{1,2}/\d{1,2}/\d{2,4},?\s+\d{1,2}:\d{2}\s*-\s*[^:]*:\s*'),  # 21/12/2025 00:48 - Nome:
+]
+# Linha só com o marcador (id antes ou depois) sai inteira; no fim de uma linha
+# com texto sai só "🏎️N": o número antes dele pode ser o da casa
+RE_MARCADOR_LINHA = re.compile(r'^\s*\d*\s*🏎️\s*\d*\s*$')
+RE_MARCADOR = re.compile(r'🏎️\s*\d*')
+RE_NAO_ALFANUM = re.compile(r'[^a-z0-9\s]')
+
+NUMEROS_EXTENSO = {"um": 1, "uma": 1, "dois": 2, "duas": 2, "tres": 3, "quatro": 4, "cinco": 5}
+
+
+def _sem_acentos(texto: str) -> str:
+    return "".join(
+        c for c in unicodedata.normalize("NFKD", texto)
+        if not unicodedata.combining(c)
+    )
+
+
+def _normalizar_termo(texto: str) -> str:
+    """lowercase, sem acento, sem pontuação, espaços colapsados."""
+    texto = _sem_acentos(texto.lower())
+    texto = RE_NAO_ALFANUM.sub(" ", texto)
+    return " ".join(texto.split())
+
+
+def carregar_aliases(aliases_path: str = None) -> list:
+    """Retorna [(alias, canonical)] normalizados, do maior alias para o menor."""
+    if not aliases_path or not Path(aliases_path).exists():
+        return []
+    with open(aliases_path, 'r', encoding='utf-8') as f:
+        aliases = json.load(f)
+    pares = {
+        (_normalizar_termo(a["alias"]), _normalizar_termo(a["canonical"]))
+        for a in aliases if a.get("alias") and a.get("canonical")
+    }
+    return sorted(pares, key=lambda p: -len(p[0]))
+
+
+def normalizar_bloco(texto: str, aliases: list) -> str:
+    """Remove timestamps, autores e 🏎️ id; canoniza produtos via aliases."""
+    linhas = []
+    for linha in texto.splitlines():
+        for regex in RE_PREFIXOS:
+            linha = regex.sub("", linha)
+        if RE_MARCADOR_LINHA.match(linha):
+            continue
+        linha = RE_MARCADOR.sub(" ", linha)
+        linha = _normalizar_termo(linha)
+        if not linha:
+            continue
+        for alias, canonical in aliases:
+            linha = re.sub(rf'\b{re.escape(alias)}\b', canonical, linha)
+        linhas.append(linha)
+    return "\n".join(linhas)
+
+
+def chave_bloco(texto_normalizado: str) -> str:
+    return hashlib.sha256(texto_normalizado.encode("utf-8")).hexdigest()
+
+
+def confirmar_reuso(items: list, texto_normalizado: str, aliases: list) -> bool:
+    """
+    Validação barata antes de reaproveitar: campos válidos, e cada produto,
+    quantidade e número dos endereços do cache aparecem no texto normalizado
+    do novo bloco.
+    """
+    if not items:
+        return False
+
+    tokens = set(texto_normalizado.split())
+    canonicos = dict(aliases)
+
+    for idx, item in enumerate(items):
+        if validar_item(item, idx):
+            return False
+
+        produto = item.get("produto")
+        if not produto:
+            return False
+        produto = _normalizar_termo(produto)
+        produto = canonicos.get(produto, produto)
+        if not re.search(rf'\b{re.escape(produto)}\b', texto_normalizado):
+            return False
+
+        quantidade = item.get("quantidade")
+        if isinstance(quantidade, (int, float)) and quantidade != 1:
+            qtd = str(int(quantidade)) if float(quantidade).is_integer() else str(quantidade)
+            extenso = {k for k, v in NUMEROS_EXTENSO.items() if v == quantidade}
+            if not re.search(rf'(?<!\d){re.escape(qtd)}(?!\d)', texto_normalizado) and not (extenso & tokens):
+                return False
+
+        for campo in ("endereco_1", "endereco_2"):
+            numeros = re.findall(r'\d+', item.get(campo) or "")
+            if any(numero not in tokens for numero in numeros):
+                return False
+
+    return True
+
+
+class CacheBlocos:
+    """Cache persistente: hash do bloco normalizado -> items extraídos."""
+
+    def __init__(self, caminho: Path = CACHE_PATH, aliases_path: str = None):
+        self.caminho = Path(caminho)
+        self.aliases = carregar_aliases(aliases_path)
+        self.entradas = {}
+        self.hits = 0
+        self.misses = 0
+        self.rejeitados = 0
+
+        if self.caminho.exists():
+            with open(self.caminho, 'r', encoding='utf-8') as f:
+                self.entradas = json.load(f)
+
+    def buscar(self, bloco) -> list:
+        """Retorna items reaproveitados (com id/driver/data do novo bloco) ou None."""
+        normalizado = normalizar_bloco(bloco.texto, self.aliases)
+        cacheados = self.entradas.get(chave_bloco(normalizado))
+
+        if cacheados is None:
+            self.misses += 1
+            return None
+
+        items = copy.deepcopy(cacheados)
+        for item in items:
+            item["id_sale_delivery"] = bloco.id_entrega
+            item["driver"] = bloco.driver
+            item["data_entrega"] = bloco.data_entrega
+            item["parse_mensagem_dia"] = bloco.texto
+            item["observacoes"] = ["[CACHE] reaproveitado de extração anterior"]
+
+        if not confirmar_reuso(items, normalizado, self.aliases):
+            self.rejeitados += 1
+            return None
+
+        self.hits += 1
+        return items
+
+    def guardar(self, bloco, items: list):
+        """Guarda items extraídos pelo LLM para o conteúdo normalizado do bloco."""
+        if not items:
+            return
+        normalizado = normalizar_bloco(bloco.texto, self.aliases)
+        self.entradas[chave_bloco(normalizado)] = copy.deepcopy(items)
+
+    def salvar(self):
+        self.caminho.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.caminho, 'w', encoding='utf-8') as f:
+            json.dump(self.entradas, f, ensure_ascii=False)
+
+    def resumo(self) -> str:
+        consultas = self.hits + self.misses + self.rejeitados
+        taxa = self.hits / consultas if consultas else 0.0
+        return (f"Cache: {self.hits}/{consultas} blocos reaproveitados ({taxa:.0%}), "
+                f"{self.rejeitados} rejeitados na validação")
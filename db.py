@@ -2,34 +2,451 @@
 GrowBot Database - DuckDB para consultas analíticas
 """
 import duckdb
+import hashlib
+import multiprocessing
+import os
+import re
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import json
 
 DB_PATH = Path(__file__).parent / "growbot.duckdb"
 OUTPUT_PATH = Path(__file__).parent / "output"
+ALIASES_PATH = Path(__file__).parent / "aliases.json"
+
+# Colunas preenchidas pela importação em lote (ordem do INSERT)
+COLUNAS_LOTE = [
+    "tipo", "driver", "driver_destino", "produto", "quantidade",
+    "data_movimento", "endereco", "observacao", "arquivo_origem", "entrega_id",
+    "id_sale_delivery", "endereco_2", "endereco_chave", "endereco_numero",
+]
+
+# Domínio fixo de movimentos.tipo (ENUM tipo_movimento no banco)
+TIPOS_MOVIMENTO = ["estoque", "recarga", "entrega", "resgate_saida", "resgate_entrada"]
+
+# Versão do schema (tabela schema_version). Cada GrowBotDB._migracao_N leva o
+# banco da versão N-1 para N; abrir um banco atualizado custa uma consulta
+SCHEMA_VERSION = 8
+
+# Snapshots publicados pelo writer (gerações mantidas em disco)
+SNAPSHOTS_MANTIDOS = 2
+
+# Sync: abaixo disso (soma dos JSONs alterados) o decode em linha (~20 MB/s)
+# termina antes de um pool de processos spawn subir (~0,5 s)
+BYTES_MIN_POOL = 16 * 1024 * 1024
+
+# Linhas por lote nos iteradores de resultado (iter_batches, iter_dicts, exportar)
+LINHAS_POR_LOTE = 100_000
+
+# Endereços: tipos de logradouro (saem da chave: o LLM ora escreve, ora omite)
+# e complementos padronizados ("ap 12" -> "apto 12"). Tokens sem acento/pontuação
+TIPOS_LOGRADOURO = {"r", "rua", "av", "avn", "avenida", "al", "alameda", "alamenda",
+                    "tv", "trav", "travessa", "pc", "pca", "praca", "rod", "rodovia",
+                    "estr", "estrada"}
+COMPLEMENTOS_ENDERECO = {"ap": "apto", "apt": "apto", "apto": "apto", "apartamento": "apto",
+                         "bl": "bloco", "bloco": "bloco", "cs": "casa", "casa": "casa",
+                         "lj": "loja", "loja": "loja", "sl": "sala", "sala": "sala"}
+
+# Colunas de partição do arquivo Parquet (archive/ano=YYYY/mes=MM/*.parquet)
+HIVE_TYPES = "{'ano': INTEGER, 'mes': INTEGER}"
+
+
+# ============ PREPARAÇÃO DE ARQUIVOS ============
+#
+# Funções de módulo (podem rodar em ProcessPoolExecutor): leem o JSON, fazem
+# hash, decodificam e montam a tabela Arrow do arquivo. Só o GrowBotDB
+# (processo principal) escreve no banco. Itens sem data, driver, produto ou
+# quantidade são ignorados (colunas NOT NULL).
+
+def parse_date(date_str: str) -> str:
+    """Converte DD/MM/YYYY para YYYY-MM-DD"""
+    if not date_str:
+        return None
+    try:
+        parts = date_str.split("/")
+        if len(parts) == 3:
+            day, month, year = parts
+            if len(year) == 2:
+                year = "20" + year
+            return f"{year}-{month.zfill(2)}-{day.zfill(2)}"
+    except:
+        pass
+    return None
+
+
+def detectar_tipo(arquivo: str) -> str:
+    """Detecta tipo pelo nome do arquivo"""
+    arquivo_lower = arquivo.lower()
+    if "estoque" in arquivo_lower:
+        return "estoque"
+    elif "recarga" in arquivo_lower or "retirada" in arquivo_lower:
+        return "recarga"
+    elif "resgate" in arquivo_lower:
+        return "resgate"
+    elif "entrega" in arquivo_lower:
+        return "entregas"
+    return None
+
+
+def _parse_int(valor) -> int:
+    """Converte quantidade para int (None se inválida)"""
+    try:
+        return int(round(float(valor)))
+    except (TypeError, ValueError):
+        return None
+
+
+def chave_entrega(driver: str, data_iso: str, id_sale_delivery, endereco: str) -> int:
+    """
+    Chave inteira (BIGINT) da entrega: driver + data + id_sale_delivery,
+    ou endereço normalizado quando não há id. None se não houver nenhum dos dois
+    """
+    if id_sale_delivery not in (None, ""):
+        ref = f"id:{str(id_sale_delivery).strip()}"
+    else:
+        chave_endereco = normalizar_endereco(endereco)[0]
+        if not chave_endereco:
+            return None
+        ref = "end:" + chave_endereco
+    digest = hashlib.blake2b(f"{driver}|{data_iso}|{ref}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def normalizar_endereco(endereco: str) -> tuple:
+    """
+    Endereço como veio do LLM -> (chave, número). Chave = logradouro sem o tipo
+    ("R."/"Rua"/"Av" saem), número e complemento padronizado ("apto 12"), em
+    minúsculas, sem acento e pontuação; o que vem depois do número (bairro) sai.
+    Número = último número fora do complemento. (None, None) se vazio
+    """
+    if not endereco:
+        return None, None
+    texto = unicodedata.normalize("NFKD", endereco.casefold()).encode("ascii", "ignore").decode()
+    tokens = re.findall(r"[a-z]+|\d+", texto)
+
+    base, complemento = [], []
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in COMPLEMENTOS_ENDERECO and i + 1 < len(tokens) and tokens[i + 1].isdigit():
+            complemento += [COMPLEMENTOS_ENDERECO[tokens[i]], tokens[i + 1]]
+            i += 2
+            continue
+        # "nº 100", "n 100", "numero 100"
+        if not (tokens[i] in ("n", "no", "num", "numero") and i + 1 < len(tokens) and tokens[i + 1].isdigit()):
+            base.append(tokens[i])
+        i += 1
+    if base and base[0] in TIPOS_LOGRADOURO:
+        base = base[1:]
+
+    numeros = [j for j, token in enumerate(base) if token.isdigit()]
+    if numeros:
+        j = numeros[-1]
+        numero = base[j]
+        # "328 Pacaembu": número antes do logradouro
+        logradouro = base[:j] or base[j + 1:]
+        chave = logradouro + [numero] + complemento
+    else:
+        numero = None
+        chave = base + complemento
+    return " ".join(chave) or None, numero
+
+
+def _juntar_observacoes(obs) -> str:
+    """observacoes da entrega (lista) -> texto separado por "; " (como no CSV)"""
+    if isinstance(obs, list):
+        return "; ".join(str(o) for o in obs if o) or None
+    return obs or None
+
+
+def montar_lote(linhas) -> dict:
+    """
+    Recebe tuplas (tipo, driver, driver_destino, produto, quantidade, data DD/MM/YYYY,
+    endereco, observacao, arquivo, id_sale_delivery, endereco_2) e devolve o lote
+    colunar (coluna -> lista) só com as linhas válidas
+    """
+    datas, enderecos = {}, {}
+    validas = []
+    for linha in linhas:
+        tipo, driver, destino, produto, quantidade, data, endereco, obs, arquivo, id_sale, endereco_2 = linha
+        if data not in datas:
+            datas[data] = parse_date(data)
+        data = datas[data]
+        if quantidade is not None and not isinstance(quantidade, int):
+            quantidade = _parse_int(quantidade)
+        if not data or not driver or not produto or quantidade is None:
+            continue
+        entrega_id = chave_entrega(driver, data, id_sale, endereco) if tipo == "entrega" else None
+        if id_sale is not None:
+            id_sale = str(id_sale).strip() or None
+        if endereco not in enderecos:
+            enderecos[endereco] = normalizar_endereco(endereco)
+        validas.append((tipo, driver, destino, produto, quantidade, data, endereco, obs, arquivo,
+                        entrega_id, id_sale, endereco_2, *enderecos[endereco]))
+
+    colunas = list(zip(*validas)) if validas else [()] * len(COLUNAS_LOTE)
+    return dict(zip(COLUNAS_LOTE, (list(c) for c in colunas)))
+
+
+def _linhas_resgate(items: list, arquivo: str):
+    """Resgate gera 2 movimentos: saída (driver_origem perde) e entrada (driver_destino ganha)"""
+    for i in items:
+        origem, destino = i.get("driver_origem"), i.get("driver_destino")
+        yield ("resgate_saida", origem, destino, i.get("produto"), i.get("quantidade"),
+               i.get("data_resgate"), None, i.get("motivo"), arquivo, None, None)
+        yield ("resgate_entrada", destino, origem, i.get("produto"), i.get("quantidade"),
+               i.get("data_resgate"), None, i.get("motivo"), arquivo, None, None)
+
+
+def lote_arquivo(data: dict, arquivo: str) -> tuple:
+    """Monta o lote de um JSON conforme o tipo. Retorna (tipo, lote)"""
+    tipo = data.get("tipo", detectar_tipo(arquivo))
+    items = data.get("items", [])
+
+    if tipo == "estoque":
+        linhas = (("estoque", i.get("driver"), None, i.get("produto"), i.get("quantidade"),
+                   i.get("data_registro"), None, None, arquivo, None, None) for i in items)
+    elif tipo == "recarga":
+        linhas = (("recarga", i.get("driver"), None, i.get("produto"), i.get("quantidade"),
+                   i.get("data_recarga"), None, i.get("observacao"), arquivo, None, None) for i in items)
+    elif tipo == "resgate":
+        linhas = _linhas_resgate(items, arquivo)
+    elif tipo in ("entregas", None) and "items" in data:
+        tipo = "entregas"
+        linhas = (("entrega", i.get("driver"), None, i.get("produto"), i.get("quantidade"),
+                   i.get("data_entrega"), i.get("endereco_1"), _juntar_observacoes(i.get("observacoes")),
+                   arquivo, i.get("id_sale_delivery"), i.get("endereco_2")) for i in items)
+    else:
+        linhas = []
+
+    return tipo, montar_lote(linhas)
+
+
+def tabela_lote(lote: dict):
+    """Lote colunar -> tabela Arrow (data_movimento vai como texto; o INSERT converte)"""
+    import pyarrow as pa
+
+    tipos = {"quantidade": pa.int32(), "entrega_id": pa.int64()}
+    return pa.table({
+        coluna: pa.array(lote[coluna], type=tipos.get(coluna, pa.string()))
+        for coluna in COLUNAS_LOTE
+    })
+
+
+def preparado_inalterado(json_path: Path, registro: dict = None) -> dict:
+    """
+    Checagem barata (stat) de preparar_arquivo: acao "ignorar" se tamanho e
+    mtime batem com o registro, senão "importar" (ainda sem ler o arquivo)
+    """
+    stat = json_path.stat()
+    inalterado = registro and registro["tamanho"] == stat.st_size and registro["mtime"] == stat.st_mtime
+    return {"arquivo": json_path.name, "acao": "ignorar" if inalterado else "importar",
+            "tamanho": stat.st_size, "mtime": stat.st_mtime}
+
+
+def preparar_arquivo(json_path: Path, registro: dict = None) -> dict:
+    """
+    Lê e prepara um JSON para importação, sem tocar no banco.
+    `registro` é o hash/tamanho/mtime já importado (None = importar).
+    Retorna dict com acao: "ignorar" (não mudou), "tocar" (só mtime mudou)
+    ou "importar" (com tipo, tabela e registros).
+    """
+    arquivo = json_path.name
+    preparado = preparado_inalterado(json_path, registro)
+    if preparado["acao"] == "ignorar":
+        return preparado
+
+    conteudo = json_path.read_bytes()
+    preparado["hash"] = hashlib.sha256(conteudo).hexdigest()
+
+    if registro and registro["hash"] == preparado["hash"]:
+        # Só o mtime mudou (ex: arquivo copiado/tocado)
+        preparado["acao"] = "tocar"
+        return preparado
+
+    tipo, lote = lote_arquivo(json.loads(conteudo), arquivo)
+    preparado.update(acao="importar", tipo=tipo, registros=len(lote["tipo"]))
+    if preparado["registros"]:
+        preparado["tabela"] = tabela_lote(lote)
+    return preparado
+
+
+def produtos_output(output_path: Path = None) -> dict:
+    """Nomes de produto como vieram nos JSONs de output/ -> ocorrências"""
+    contagem = {}
+    for json_file in sorted((output_path or OUTPUT_PATH).glob("*.json")):
+        with open(json_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for item in data.get("items", []) if isinstance(data, dict) else []:
+            produto = item.get("produto")
+            if produto:
+                contagem[produto] = contagem.get(produto, 0) + 1
+    return contagem
+
+
+# ============ SNAPSHOTS ============
+#
+# O writer (sync) publica uma cópia do banco por geração em <banco>_snapshots/
+# e troca o ponteiro CURRENT com os.replace. Leitores (API, TUI) abrem a
+# geração atual só leitura e nunca disputam o lock do arquivo principal.
+
+def pasta_snapshots(db_path: Path = DB_PATH) -> Path:
+    """Pasta dos snapshots do banco"""
+    return db_path.with_name(db_path.stem + "_snapshots")
+
+
+def snapshot_atual(db_path: Path = DB_PATH) -> Path:
+    """Arquivo da geração apontada por CURRENT (o próprio banco se não houver snapshot)"""
+    pasta = pasta_snapshots(db_path)
+    for _ in range(3):
+        try:
+            caminho = pasta / (pasta / "CURRENT").read_text().strip()
+        except FileNotFoundError:
+            return db_path
+        if caminho.exists():
+            return caminho
+        # Geração apagada entre a leitura do CURRENT e agora: relê
+    return db_path
+
+
+# ============ ARQUIVO FRIO ============
+#
+# Meses fechados saem de `movimentos` para Parquet particionado por ano/mês.
+# A view movimentos_todos junta as duas partes; filtros por período devem
+# incluir filtro_particao() para o DuckDB só abrir as partições do intervalo.
+# As tabelas derivadas (rollup, saldo, KPIs) continuam com todo o histórico.
+
+def pasta_archive(db_path: Path = DB_PATH) -> Path:
+    """Pasta do Parquet arquivado, ao lado do banco"""
+    return db_path.with_name("archive")
+
+
+def filtro_particao(data_inicio: str = None, data_fim: str = None) -> str:
+    """
+    Condição SQL em ano/mes para o intervalo [data_inicio, data_fim] (YYYY-MM-DD).
+    Comparações simples em ano e mes: é o formato que o DuckDB usa para
+    descartar partições (ano * 100 + mes não poda)
+    """
+    condicoes = []
+    if data_inicio:
+        ano, mes = int(data_inicio[:4]), int(data_inicio[5:7])
+        condicoes.append(f"(ano > {ano} OR (ano = {ano} AND mes >= {mes}))")
+    if data_fim:
+        ano, mes = int(data_fim[:4]), int(data_fim[5:7])
+        condicoes.append(f"(ano < {ano} OR (ano = {ano} AND mes <= {mes}))")
+    return " AND ".join(condicoes) or "TRUE"
 
 
 class GrowBotDB:
-    def __init__(self, db_path: Path = DB_PATH, read_only: bool = False):
+    def __init__(self, db_path: Path = DB_PATH, read_only: bool = True, migrar: bool = True):
+        """
+        Abre o banco (só leitura por padrão; quem importa passa read_only=False).
+        Banco inexistente ou com schema antigo é migrado antes por uma
+        conexão de escrita temporária. migrar=False abre como está e nunca cria
+        o arquivo (snapshots: só o banco principal é criado/migrado).
+        `migrado` = esta abertura aplicou migrações
+        """
         self.db_path = db_path
         self.read_only = read_only
+        self.migrado = False
+        self._derivados_pendentes = None  # dentro do sync_all: (datas, chaves, endereços) de cada gravação
+        if read_only and migrar and not Path(db_path).exists():
+            GrowBotDB(db_path, read_only=False).close()
+
         self.conn = duckdb.connect(str(db_path), read_only=read_only)
-        if not read_only:
-            self._init_schema()
+        if migrar and self._versao_schema() < SCHEMA_VERSION:
+            if read_only:
+                self.conn.close()
+                GrowBotDB(db_path, read_only=False).close()
+                self.conn = duckdb.connect(str(db_path), read_only=True)
+            else:
+                self._migrar()
 
-    def _init_schema(self):
-        """Cria tabelas e views se não existirem"""
+    @classmethod
+    def snapshot(cls, db_path: Path = DB_PATH) -> "GrowBotDB":
+        """
+        Conexão só leitura no snapshot atual do banco. A geração nunca é
+        migrada: se for de um schema antigo, migra o banco principal e publica
+        uma geração nova (com o writer rodando, ele já fez isso ao subir)
+        """
+        db = cls._abrir_geracao(db_path)
+        if db.db_path == db_path or db._versao_schema() >= SCHEMA_VERSION:
+            return db
+        db.close()
+        try:
+            principal = cls(db_path, read_only=False)
+        except duckdb.IOException:
+            # Banco principal com outra conexão de escrita: fica na geração atual
+            return cls._abrir_geracao(db_path)
+        try:
+            principal.publicar_snapshot()
+        finally:
+            principal.close()
+        return cls._abrir_geracao(db_path)
+
+    @classmethod
+    def _abrir_geracao(cls, db_path: Path) -> "GrowBotDB":
+        """
+        Abre só leitura a geração apontada por CURRENT (o banco principal se
+        não houver snapshot). Geração apagada entre ler o CURRENT e abrir
+        (publicação nova podou): relê o CURRENT e tenta de novo
+        """
+        for tentativa in range(3):
+            caminho = snapshot_atual(db_path)
+            if caminho == db_path:
+                return cls(db_path, read_only=True)
+            try:
+                return cls(caminho, read_only=True, migrar=False)
+            except duckdb.IOException:
+                if tentativa == 2:
+                    raise
+
+    # ============ MIGRAÇÕES ============
+
+    def _versao_schema(self) -> int:
+        """Versão gravada em schema_version (0 = banco novo ou anterior às migrações)"""
+        try:
+            return self.conn.execute("SELECT MAX(versao) FROM schema_version").fetchone()[0] or 0
+        except duckdb.CatalogException:
+            return 0
+
+    def _migrar(self):
+        """Aplica as migrações pendentes em ordem, gravando cada versão"""
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                versao INTEGER PRIMARY KEY,
+                aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        for versao in range(self._versao_schema() + 1, SCHEMA_VERSION + 1):
+            getattr(self, f"_migracao_{versao}")()
+            self.conn.execute("INSERT INTO schema_version (versao) VALUES (?)", [versao])
+            self.migrado = True
+        # DDL fora do WAL: o replay de ALTER em tabela com DEFAULT nextval falha no DuckDB
+        self.conn.execute("CHECKPOINT")
+
+    def _migracao_1(self):
+        """
+        Schema base: tabelas, derivadas e views. Idempotente, também atualiza
+        bancos criados antes do schema_version
+        """
 
         # Sequência para IDs
         self.conn.execute("CREATE SEQUENCE IF NOT EXISTS seq_movimentos START 1")
         self.conn.execute("CREATE SEQUENCE IF NOT EXISTS seq_aliases START 1")
 
+        # tipo tem domínio fixo: ENUM (1 byte por linha, comparação inteira)
+        tipos = ", ".join(f"'{t}'" for t in TIPOS_MOVIMENTO)
+        self.conn.execute(f"CREATE TYPE IF NOT EXISTS tipo_movimento AS ENUM ({tipos})")
+
         # Tabela principal de movimentos
         self.conn.execute("""
             CREATE TABLE IF NOT EXISTS movimentos (
                 id INTEGER DEFAULT nextval('seq_movimentos') PRIMARY KEY,
-                tipo VARCHAR NOT NULL,
+                tipo tipo_movimento NOT NULL,
                 driver VARCHAR NOT NULL,
                 driver_destino VARCHAR,
                 produto VARCHAR NOT NULL,
@@ -42,6 +459,25 @@ class GrowBotDB:
             )
         """)
 
+        # Colunas das entregas: chave inteira (driver + data + id_sale_delivery/endereço)
+        # e o detalhe que a TUI mostra (observacoes vão em `observacao`).
+        # Bancos antigos ganham as colunas e reimportam as entregas no próximo sync
+        colunas_entrega = {"entrega_id": "BIGINT", "id_sale_delivery": "VARCHAR", "endereco_2": "VARCHAR"}
+        reimportar_entregas = False
+        for coluna, tipo_sql in colunas_entrega.items():
+            if not self._coluna_existe("movimentos", coluna):
+                reimportar_entregas = True
+                self.conn.execute(f"ALTER TABLE movimentos ADD COLUMN {coluna} {tipo_sql}")
+
+        # Bancos antigos: tipo VARCHAR -> ENUM e reescrita ordenada por data
+        tipo_varchar = self.conn.execute("""
+            SELECT data_type = 'VARCHAR' FROM information_schema.columns
+            WHERE table_name = 'movimentos' AND column_name = 'tipo'
+        """).fetchone()[0]
+        if tipo_varchar:
+            self.conn.execute("ALTER TABLE movimentos ALTER tipo TYPE tipo_movimento")
+            self.reorganizar()
+
         # Tabela de aliases
         self.conn.execute("""
             CREATE TABLE IF NOT EXISTS aliases (
@@ -61,12 +497,271 @@ class GrowBotDB:
             )
         """)
 
+        # Hash/tamanho/mtime para detectar arquivos editados (bancos antigos ganham as colunas)
+        self.conn.execute("ALTER TABLE arquivos_importados ADD COLUMN IF NOT EXISTS hash VARCHAR")
+        self.conn.execute("ALTER TABLE arquivos_importados ADD COLUMN IF NOT EXISTS tamanho BIGINT")
+        self.conn.execute("ALTER TABLE arquivos_importados ADD COLUMN IF NOT EXISTS mtime DOUBLE")
+
+        if reimportar_entregas:
+            self.conn.execute(
+                "UPDATE arquivos_importados SET hash = NULL, mtime = NULL WHERE tipo = 'entregas'"
+            )
+
+        # Rollup diário: (data, driver, produto, tipo) -> quantidade, registros, entregas
+        # `entregas` = entrega_id distintos no dia; não soma entre produtos, por
+        # isso o total de entregas por (data, driver) fica em entregas_diarias
+        novo_rollup = not self._tabela_existe("movimentos_diarios")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS movimentos_diarios (
+                data_movimento DATE NOT NULL,
+                driver VARCHAR NOT NULL,
+                produto VARCHAR NOT NULL,
+                tipo VARCHAR NOT NULL,
+                quantidade BIGINT NOT NULL,
+                registros BIGINT NOT NULL,
+                entregas BIGINT NOT NULL,
+                PRIMARY KEY (data_movimento, driver, produto, tipo)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entregas_diarias (
+                data_movimento DATE NOT NULL,
+                driver VARCHAR NOT NULL,
+                entregas BIGINT NOT NULL,
+                PRIMARY KEY (data_movimento, driver)
+            )
+        """)
+
+        # Saldo acumulado por (driver, produto) nos dias com movimento.
+        # "Saldo em X" = linha mais recente com data <= X
+        novo_saldo = not self._tabela_existe("saldo_acumulado")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS saldo_acumulado (
+                driver VARCHAR NOT NULL,
+                produto VARCHAR NOT NULL,
+                data_movimento DATE NOT NULL,
+                entradas BIGINT NOT NULL,
+                saidas BIGINT NOT NULL,
+                entradas_acumuladas BIGINT NOT NULL,
+                saidas_acumuladas BIGINT NOT NULL,
+                saldo_acumulado BIGINT NOT NULL,
+                PRIMARY KEY (driver, produto, data_movimento)
+            )
+        """)
+
+
+        # Somas prefixadas de KPIs por driver (+ linha 'TODOS'), uma linha por dia
+        # corrido: KPI de [ini, fim] = linha(fim) - linha(ini - 1 dia)
+        novo_kpis = not self._tabela_existe("kpis_acumulados")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS kpis_acumulados (
+                driver VARCHAR NOT NULL,
+                data_movimento DATE NOT NULL,
+                recarga BIGINT NOT NULL,
+                entrega BIGINT NOT NULL,
+                estoque BIGINT NOT NULL,
+                entregas BIGINT NOT NULL,
+                retiradas BIGINT NOT NULL,
+                PRIMARY KEY (driver, data_movimento)
+            )
+        """)
+
+        if novo_rollup or novo_saldo or novo_kpis:
+            self._atualizar_derivados()
+
         # Views para relatórios
         self._create_views()
 
+    def _migracao_2(self):
+        """Arquivo frio: controle dos meses arquivados e view movimentos_todos"""
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS arquivamentos (
+                ate DATE PRIMARY KEY,
+                registros BIGINT NOT NULL,
+                arquivado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self._criar_view_movimentos_todos()
+
+    def _migracao_3(self):
+        """
+        Produtos canônicos: normalização (minúsculas, sem acento, espaços simples)
+        e aliases aplicados na importação; linhas existentes são reescritas
+        """
+        self.conn.execute("""
+            CREATE OR REPLACE MACRO normalizar_produto(p) AS
+            lower(strip_accents(trim(regexp_replace(p, '\\s+', ' ', 'g'))))
+        """)
+        # Um canônico por alias normalizado (o último cadastrado vence)
+        self.conn.execute("""
+            CREATE OR REPLACE VIEW aliases_normalizados AS
+            SELECT
+                normalizar_produto(alias) as alias,
+                arg_max(normalizar_produto(canonical), id) as canonical
+            FROM aliases
+            GROUP BY 1
+        """)
+        self._criar_view_movimentos_todos()
+        self.sync_aliases()
+        self.recanonicalizar()
+
+    def _migracao_4(self):
+        """
+        Alertas de saldo negativo mantidos por importação (só as chaves tocadas)
+        e log de quando cada (driver, produto) ficou negativo ou se recuperou
+        """
+        self.conn.execute("CREATE SEQUENCE IF NOT EXISTS seq_alertas START 1")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS alertas_saldo (
+                driver VARCHAR NOT NULL,
+                produto VARCHAR NOT NULL,
+                entradas BIGINT NOT NULL,
+                saidas BIGINT NOT NULL,
+                saldo BIGINT NOT NULL,
+                negativo_desde DATE NOT NULL,
+                ultimo_movimento DATE NOT NULL,
+                PRIMARY KEY (driver, produto)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS alertas_saldo_log (
+                id BIGINT DEFAULT nextval('seq_alertas') PRIMARY KEY,
+                driver VARCHAR NOT NULL,
+                produto VARCHAR NOT NULL,
+                evento VARCHAR NOT NULL,
+                saldo BIGINT NOT NULL,
+                data_movimento DATE,
+                registrado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self._atualizar_alertas()
+
+        # Alertas passam a ser lidos da tabela mantida
+        self.conn.execute("""
+            CREATE OR REPLACE VIEW v_produtos_negativos AS
+            SELECT driver, produto, entradas, saidas, saldo
+            FROM alertas_saldo
+            ORDER BY saldo ASC
+        """)
+
+    def _migracao_5(self):
+        """
+        Conciliação de estoque: cada contagem (driver, dia) comparada por produto
+        com o esperado pela contagem anterior e os movimentos desde ela
+        """
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS conciliacao_estoque (
+                driver VARCHAR NOT NULL,
+                data_movimento DATE NOT NULL,
+                produto VARCHAR NOT NULL,
+                contado BIGINT NOT NULL,
+                esperado BIGINT NOT NULL,
+                diferenca BIGINT NOT NULL,
+                PRIMARY KEY (driver, data_movimento, produto)
+            )
+        """)
+        self._atualizar_conciliacao()
+
+        self.conn.execute("""
+            CREATE OR REPLACE VIEW v_divergencias_estoque AS
+            SELECT *
+            FROM conciliacao_estoque
+            WHERE diferenca <> 0
+            ORDER BY data_movimento DESC, driver, abs(diferenca) DESC
+        """)
+
+    def _migracao_6(self):
+        """
+        Endereços normalizados nas entregas (chave/número), índice com uma linha
+        por chave e trigramas da chave para a busca por endereço
+        """
+        self.conn.execute("ALTER TABLE movimentos ADD COLUMN IF NOT EXISTS endereco_chave VARCHAR")
+        self.conn.execute("ALTER TABLE movimentos ADD COLUMN IF NOT EXISTS endereco_numero VARCHAR")
+        self.conn.execute("""
+            CREATE OR REPLACE MACRO trigramas(s) AS
+            list_distinct(list_transform(range(1, length(s) + 1), i -> substr(' ' || s || ' ', i, 3)))
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS enderecos (
+                chave VARCHAR PRIMARY KEY,
+                endereco VARCHAR NOT NULL,
+                numero VARCHAR,
+                entregas BIGINT NOT NULL,
+                primeira_entrega DATE NOT NULL,
+                ultima_entrega DATE NOT NULL
+            )
+        """)
+        # Sem PRIMARY KEY: a busca é hash join e o índice ART só pesaria nas escritas e no snapshot
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS enderecos_trigramas (
+                trigrama VARCHAR NOT NULL,
+                chave VARCHAR NOT NULL
+            )
+        """)
+
+        # Entregas gravadas: chave/número e entrega_id (sem id_sale_delivery a
+        # chave da entrega passou a usar o endereço normalizado)
+        entregas = self.conn.execute("""
+            SELECT DISTINCT driver, data_movimento, id_sale_delivery, endereco
+            FROM movimentos WHERE tipo = 'entrega'
+        """).fetchall()
+        mapa = []
+        for driver, data_movimento, id_sale, endereco in entregas:
+            chave, numero = normalizar_endereco(endereco)
+            mapa.append({"driver": driver, "data_movimento": data_movimento, "id_sale_delivery": id_sale,
+                         "endereco": endereco, "entrega_id": chave_entrega(driver, str(data_movimento), id_sale, endereco),
+                         "chave": chave, "numero": numero})
+        if mapa:
+            self.conn.execute("""
+                UPDATE movimentos SET
+                    entrega_id = m.entrega_id, endereco_chave = m.chave, endereco_numero = m.numero
+                FROM (
+                    SELECT unnest(?::STRUCT(driver VARCHAR, data_movimento DATE, id_sale_delivery VARCHAR,
+                                            endereco VARCHAR, entrega_id BIGINT, chave VARCHAR,
+                                            numero VARCHAR)[], recursive := true)
+                ) m
+                WHERE movimentos.tipo = 'entrega'
+                  AND movimentos.driver = m.driver
+                  AND movimentos.data_movimento = m.data_movimento
+                  AND movimentos.id_sale_delivery IS NOT DISTINCT FROM m.id_sale_delivery
+                  AND movimentos.endereco IS NOT DISTINCT FROM m.endereco
+            """, [mapa])
+        self._atualizar_derivados()
+
+    def _migracao_7(self):
+        """Conciliação recalculada: esperado parte da contagem anterior, não do saldo acumulado"""
+        self._atualizar_conciliacao()
+
+    def _migracao_8(self):
+        """
+        Arquivos gravados pelo sync_all cujas tabelas derivadas ainda não foram
+        recalculadas (o recálculo é um só, no fim do sync)
+        """
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS derivados_pendentes (
+                arquivo VARCHAR,
+                registrado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def _coluna_existe(self, tabela: str, coluna: str) -> bool:
+        """Verifica se coluna existe na tabela"""
+        return self.conn.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = ? AND column_name = ?",
+            [tabela, coluna]
+        ).fetchone() is not None
+
+    def _tabela_existe(self, nome: str) -> bool:
+        """Verifica se tabela existe no banco"""
+        return self.conn.execute(
+            "SELECT 1 FROM information_schema.tables WHERE table_name = ?", [nome]
+        ).fetchone() is not None
+
     def _create_views(self):
         """Cria views para relatórios"""
 
+        # Views leem o rollup diário (escala com dias x produtos, não com linhas)
+
         # View: Saldo por driver
         self.conn.execute("""
             CREATE OR REPLACE VIEW v_saldo_driver AS
@@ -88,25 +783,21 @@ class GrowBotDB:
                     WHEN tipo = 'resgate_entrada' THEN quantidade
                     ELSE 0
                 END) as saldo
-            FROM movimentos
+            FROM movimentos_diarios
             GROUP BY driver
             ORDER BY driver
         """)
 
-        # View: Saldo por produto por driver
+        # View: Saldo por produto por driver (último dia do saldo acumulado)
         self.conn.execute("""
             CREATE OR REPLACE VIEW v_saldo_produto AS
             SELECT
                 driver,
                 produto,
-                SUM(CASE WHEN tipo IN ('estoque', 'recarga', 'resgate_entrada') THEN quantidade ELSE 0 END) as entradas,
-                SUM(CASE WHEN tipo IN ('entrega', 'resgate_saida') THEN quantidade ELSE 0 END) as saidas,
-                SUM(CASE
-                    WHEN tipo IN ('estoque', 'recarga', 'resgate_entrada') THEN quantidade
-                    WHEN tipo IN ('entrega', 'resgate_saida') THEN -quantidade
-                    ELSE 0
-                END) as saldo
-            FROM movimentos
+                arg_max(entradas_acumuladas, data_movimento) as entradas,
+                arg_max(saidas_acumuladas, data_movimento) as saidas,
+                arg_max(saldo_acumulado, data_movimento) as saldo
+            FROM saldo_acumulado
             GROUP BY driver, produto
             ORDER BY driver, produto
         """)
@@ -132,226 +823,885 @@ class GrowBotDB:
                 data_movimento,
                 tipo,
                 driver,
-                COUNT(*) as qtd_registros,
+                SUM(registros) as qtd_registros,
                 SUM(quantidade) as total_unidades
-            FROM movimentos
+            FROM movimentos_diarios
             GROUP BY data_movimento, tipo, driver
             ORDER BY data_movimento DESC, driver
         """)
 
+    def _criar_view_movimentos_todos(self):
+        """
+        movimentos_todos = movimentos (quente) + Parquet arquivado, com tipo
+        em VARCHAR e as colunas de partição ano/mes nas duas partes. O Parquet
+        não é reescrito: o produto arquivado é canonizado na leitura
+        """
+        query = """
+            CREATE OR REPLACE VIEW movimentos_todos AS
+            SELECT
+                * REPLACE (CAST(tipo AS VARCHAR) AS tipo),
+                CAST(year(data_movimento) AS INTEGER) as ano,
+                CAST(month(data_movimento) AS INTEGER) as mes
+            FROM movimentos
+        """
+        if self.limite_arquivo():
+            padrao = str(pasta_archive(self.db_path) / "*" / "*" / "*.parquet").replace("'", "''")
+            arquivo = f"""read_parquet('{padrao}', hive_partitioning = true,
+                                       hive_types = {HIVE_TYPES}, union_by_name = true)"""
+            if self._tabela_existe("aliases_normalizados"):
+                query += f"""
+            UNION ALL BY NAME
+            SELECT p.* REPLACE (COALESCE(a.canonical, normalizar_produto(p.produto)) AS produto)
+            FROM {arquivo} p
+            LEFT JOIN aliases_normalizados a ON a.alias = normalizar_produto(p.produto)
+                """
+            else:
+                query += f"""
+            UNION ALL BY NAME
+            SELECT * FROM {arquivo}
+                """
+        self.conn.execute(query)
+
     def _parse_date(self, date_str: str) -> str:
         """Converte DD/MM/YYYY para YYYY-MM-DD"""
-        if not date_str:
-            return None
-        try:
-            parts = date_str.split("/")
-            if len(parts) == 3:
-                day, month, year = parts
-                if len(year) == 2:
-                    year = "20" + year
-                return f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-        except:
-            pass
-        return None
+        return parse_date(date_str)
 
-    def _arquivo_ja_importado(self, arquivo: str) -> bool:
-        """Verifica se arquivo já foi importado"""
+    def _registro_importado(self, arquivo: str) -> dict:
+        """Retorna hash/tamanho/mtime registrados do arquivo (None se nunca importado)"""
         result = self.conn.execute(
-            "SELECT 1 FROM arquivos_importados WHERE arquivo = ?",
+            "SELECT hash, tamanho, mtime FROM arquivos_importados WHERE arquivo = ?",
             [arquivo]
         ).fetchone()
-        return result is not None
+        if result is None:
+            return None
+        return {"hash": result[0], "tamanho": result[1], "mtime": result[2]}
 
-    def _marcar_importado(self, arquivo: str, tipo: str):
-        """Marca arquivo como importado"""
+    def _marcar_importado(self, arquivo: str, tipo: str, hash_: str = None,
+                          tamanho: int = None, mtime: float = None):
+        """Marca arquivo como importado (com hash e tamanho do conteúdo)"""
         self.conn.execute(
-            "INSERT OR REPLACE INTO arquivos_importados (arquivo, tipo) VALUES (?, ?)",
-            [arquivo, tipo]
+            """INSERT OR REPLACE INTO arquivos_importados (arquivo, tipo, hash, tamanho, mtime)
+               VALUES (?, ?, ?, ?, ?)""",
+            [arquivo, tipo, hash_, tamanho, mtime]
         )
 
-    def sync_json(self, json_path: Path, force: bool = False) -> int:
+    def sync_json(self, json_path: Path, force: bool = False, publicar: bool = True) -> int:
         """
         Importa JSON para o banco
+        Arquivo já importado só é reimportado se o conteúdo mudou (hash);
+        as linhas antigas dele são substituídas na mesma transação.
+        publicar=False deixa o snapshot para quem chamou (writer publica por lote).
         Retorna quantidade de registros importados
         """
-        arquivo = json_path.name
+        registro = None if force else self._registro_importado(json_path.name)
+        preparado = preparar_arquivo(json_path, registro)
+        count = self._gravar_preparado(preparado)
+        if not publicar:
+            return count
+        if preparado["acao"] == "importar" or not (pasta_snapshots(self.db_path) / "CURRENT").exists():
+            self.publicar_snapshot()
+        return count
+
+    def sync_jsons(self, json_paths: list, force: bool = False) -> list:
+        """
+        Importa vários JSONs numa transação só, com um único recálculo das
+        tabelas derivadas para a união das datas, chaves e endereços tocados
+        (group commit do writer). Não publica snapshot; qualquer erro desfaz
+        o grupo inteiro. Retorna registros importados por arquivo
+        """
+        preparados = [
+            preparar_arquivo(p, None if force else self._registro_importado(p.name))
+            for p in json_paths
+        ]
+        self._derivados_pendentes = []
+        self.conn.begin()
+        try:
+            contagens = [self._gravar_preparado(p, transacao=False) for p in preparados]
+            self._recalcular_pendentes()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._derivados_pendentes = None
+        return contagens
+
+    def _gravar_preparado(self, preparado: dict, transacao: bool = True) -> int:
+        """
+        Grava no banco um arquivo vindo de preparar_arquivo. Retorna registros importados
+        (transacao=False: quem chamou já abriu a transação)
+        """
+        arquivo = preparado["arquivo"]
 
-        if not force and self._arquivo_ja_importado(arquivo):
+        if preparado["acao"] == "ignorar":
             return 0
 
-        with open(json_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        if preparado["acao"] == "tocar":
+            self.conn.execute(
+                "UPDATE arquivos_importados SET mtime = ? WHERE arquivo = ?",
+                [preparado["mtime"], arquivo]
+            )
+            return 0
+
+        # Substitui as linhas do arquivo, atualiza o rollup dos dias afetados
+        # e marca como importado numa transação só
+        if transacao:
+            self.conn.begin()
+        try:
+            datas, chaves, enderecos = self._tocados_arquivo(arquivo)
+            self.conn.execute("DELETE FROM movimentos WHERE arquivo_origem = ?", [arquivo])
+            inseridos = self._inserir_tabela(preparado["tabela"]) if preparado["registros"] else 0
+            novos = self._tocados_arquivo(arquivo)
+            datas, chaves, enderecos = datas | novos[0], chaves | novos[1], enderecos | novos[2]
+            self._atualizar_derivados(sorted(datas), chaves, enderecos, arquivo)
+            self._marcar_importado(arquivo, preparado["tipo"], preparado["hash"],
+                                   preparado["tamanho"], preparado["mtime"])
+            if transacao:
+                self.conn.commit()
+        except Exception:
+            if transacao:
+                self.conn.rollback()
+            raise
+
+        return inseridos
+
+    def _inserir_tabela(self, tabela):
+        """
+        Insere a tabela Arrow do arquivo em um único statement, com o produto
+        canonizado por join com aliases_normalizados.
+        Linhas de meses já arquivados são descartadas (o arquivo é imutável).
+        Retorna linhas inseridas
+        """
+        colunas = ", ".join(COLUNAS_LOTE)
+        valores = ", ".join(
+            "COALESCE(a.canonical, normalizar_produto(l.produto))" if c == "produto" else f"l.{c}"
+            for c in COLUNAS_LOTE
+        )
+        limite = self.limite_arquivo()
+        filtro = "WHERE CAST(l.data_movimento AS DATE) >= ?" if limite else ""
+        self.conn.register("_lote", tabela)
+        try:
+            return self.conn.execute(
+                f"""INSERT INTO movimentos ({colunas})
+                    SELECT {valores}
+                    FROM _lote l
+                    LEFT JOIN aliases_normalizados a ON a.alias = normalizar_produto(l.produto)
+                    {filtro}""",
+                [limite] if limite else []
+            ).fetchone()[0]
+        finally:
+            self.conn.unregister("_lote")
+
+    def remover_arquivo(self, arquivo: str) -> int:
+        """Remove linhas e registro de um arquivo que saiu de output/. Retorna linhas removidas"""
+        self.conn.begin()
+        try:
+            datas, chaves, enderecos = self._tocados_arquivo(arquivo)
+            removidos = self.conn.execute(
+                "DELETE FROM movimentos WHERE arquivo_origem = ?", [arquivo]
+            ).fetchone()[0]
+            self._atualizar_derivados(sorted(datas), chaves, enderecos, arquivo)
+            self.conn.execute("DELETE FROM arquivos_importados WHERE arquivo = ?", [arquivo])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return removidos
 
-        tipo = data.get("tipo", self._detectar_tipo(arquivo))
-        items = data.get("items", [])
+    def _detectar_tipo(self, arquivo: str) -> str:
+        """Detecta tipo pelo nome do arquivo"""
+        return detectar_tipo(arquivo)
 
-        if not items:
+    def publicar_snapshot(self) -> Path:
+        """
+        Copia o banco para uma nova geração e aponta CURRENT para ela.
+        Chamado pelo writer depois de cada sync; apaga gerações antigas
+        """
+        pasta = pasta_snapshots(self.db_path)
+        pasta.mkdir(exist_ok=True)
+        geracoes = sorted(int(p.stem.split("_")[-1]) for p in pasta.glob("geracao_*.duckdb"))
+        geracao = geracoes[-1] + 1 if geracoes else 1
+        destino = pasta / f"geracao_{geracao:06d}.duckdb"
+        temporario = destino.with_suffix(".tmp")
+        temporario.unlink(missing_ok=True)
+
+        origem = self.conn.execute("SELECT current_database()").fetchone()[0]
+        caminho_sql = str(temporario).replace("'", "''")
+        self.conn.execute(f"ATTACH '{caminho_sql}' AS snapshot")
+        try:
+            self.conn.execute(f'COPY FROM DATABASE "{origem}" TO snapshot')
+        finally:
+            self.conn.execute("DETACH snapshot")
+        os.replace(temporario, destino)
+
+        ponteiro = pasta / "CURRENT.tmp"
+        ponteiro.write_text(destino.name)
+        os.replace(ponteiro, pasta / "CURRENT")
+
+        for antiga in geracoes:
+            if antiga <= geracao - SNAPSHOTS_MANTIDOS:
+                (pasta / f"geracao_{antiga:06d}.duckdb").unlink(missing_ok=True)
+        return destino
+
+    def reorganizar(self):
+        """
+        Reescreve movimentos ordenado por data_movimento (depois driver, produto).
+        Imports acrescentam linhas na ordem dos arquivos; com a tabela ordenada
+        os zonemaps de data descartam row groups inteiros nos filtros por período
+        """
+        # Cópia com o mesmo DDL (PK, defaults, colunas adicionadas) e troca de nome
+        ddl = self.conn.execute(
+            "SELECT sql FROM duckdb_tables() WHERE table_name = 'movimentos'"
+        ).fetchone()[0]
+        self.conn.begin()
+        try:
+            self.conn.execute(ddl.replace("CREATE TABLE movimentos(", "CREATE TABLE movimentos_ordenados(", 1))
+            self.conn.execute("""
+                INSERT INTO movimentos_ordenados
+                SELECT * FROM movimentos ORDER BY data_movimento, driver, produto
+            """)
+            self.conn.execute("DROP TABLE movimentos")
+            self.conn.execute("ALTER TABLE movimentos_ordenados RENAME TO movimentos")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        # Devolve os blocos da tabela antiga para reuso
+        self.conn.execute("CHECKPOINT")
+
+    def limite_arquivo(self) -> date:
+        """Primeiro dia ainda em `movimentos` (None = nada arquivado)"""
+        return self.conn.execute("SELECT MAX(ate) FROM arquivamentos").fetchone()[0]
+
+    def arquivar(self, ate: date = None) -> int:
+        """
+        Move os movimentos anteriores a `ate` (default: 1º dia do mês atual) para
+        archive/ano=YYYY/mes=MM/*.parquet e apaga da tabela quente. `ate` é
+        arredondado para o 1º dia do mês. Retorna registros arquivados
+        """
+        ate = (ate or date.today()).replace(day=1)
+        limite = self.limite_arquivo()
+        if limite and ate <= limite:
             return 0
 
-        count = 0
+        pasta = pasta_archive(self.db_path)
+        pasta.mkdir(exist_ok=True)
+        # Token no nome dos arquivos: permite desfazer esta cópia se a transação falhar
+        token = datetime.now().strftime("%Y%m%d%H%M%S")
+        destino = str(pasta).replace("'", "''")
 
-        if tipo == "estoque":
-            count = self._import_estoque(items, arquivo)
-        elif tipo == "recarga":
-            count = self._import_recarga(items, arquivo)
-        elif tipo == "resgate":
-            count = self._import_resgate(items, arquivo)
-        elif tipo in ("entregas", None) and "items" in data:
-            count = self._import_entregas(items, arquivo)
+        registros = self.conn.execute(
+            "SELECT COUNT(*) FROM movimentos WHERE data_movimento < ?", [ate]
+        ).fetchone()[0]
+        try:
+            if registros:
+                self.conn.execute(f"""
+                    COPY (
+                        SELECT
+                            * REPLACE (CAST(tipo AS VARCHAR) AS tipo),
+                            strftime(data_movimento, '%Y') as ano,
+                            strftime(data_movimento, '%m') as mes
+                        FROM movimentos
+                        WHERE data_movimento < ?
+                        ORDER BY data_movimento, driver, produto
+                    ) TO '{destino}' (
+                        FORMAT PARQUET, PARTITION_BY (ano, mes), APPEND,
+                        FILENAME_PATTERN 'movimentos_{token}_{{uuid}}'
+                    )
+                """, [ate])
+
+            self.conn.begin()
+            try:
+                self.conn.execute("DELETE FROM movimentos WHERE data_movimento < ?", [ate])
+                self.conn.execute("INSERT INTO arquivamentos (ate, registros) VALUES (?, ?)",
+                                  [ate, registros])
+                self._criar_view_movimentos_todos()
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        except Exception:
+            for parquet in pasta.glob(f"*/*/movimentos_{token}_*.parquet"):
+                parquet.unlink()
+            raise
+
+        # Libera os blocos das linhas movidas
+        self.conn.execute("CHECKPOINT")
+        return registros
+
+    # ============ TABELAS DERIVADAS ============
+
+    def _tocados_arquivo(self, arquivo: str) -> tuple:
+        """
+        Datas, chaves (driver, produto) e chaves de endereço com movimentos
+        vindos do arquivo, numa consulta só. Retorna (datas, chaves, enderecos)
+        """
+        datas, chaves, enderecos = self.conn.execute("""
+            SELECT
+                list(DISTINCT data_movimento),
+                list(DISTINCT [driver, produto]),
+                list(DISTINCT endereco_chave) FILTER (WHERE endereco_chave IS NOT NULL)
+            FROM movimentos
+            WHERE arquivo_origem = ?
+        """, [arquivo]).fetchone()
+        return set(datas or []), {tuple(c) for c in chaves or []}, set(enderecos or [])
 
-        if count > 0:
-            self._marcar_importado(arquivo, tipo or "entregas")
+    def _atualizar_derivados(self, datas: list = None, chaves: set = None, enderecos: set = None,
+                             arquivo: str = None):
+        """
+        Recalcula as tabelas derivadas de movimentos para as datas afetadas
+        (None = todas), os alertas das chaves (driver, produto) tocadas e o
+        índice dos endereços tocados (None = todos). Chamado dentro da
+        transação de cada importação; dentro do sync_all só acumula e registra
+        a pendência (`arquivo` gravado) em derivados_pendentes: o recálculo é
+        um só, no fim
+        """
+        if self._derivados_pendentes is None:
+            self._recalcular_derivados(datas, chaves, enderecos)
+            return
+        self._derivados_pendentes.append((datas, chaves, enderecos))
+        self.conn.execute("INSERT INTO derivados_pendentes (arquivo) VALUES (?)", [arquivo])
+
+    def _recalcular_derivados(self, datas: list = None, chaves: set = None, enderecos: set = None):
+        """Recálculo de _atualizar_derivados (lista de datas vazia = nada a recalcular por data)"""
+        if datas is None or datas:
+            desde = min(datas) if datas else None
+            self._atualizar_rollup(datas)
+            self._atualizar_saldo_acumulado(desde)
+            self._atualizar_kpis(desde)
+            if self._tabela_existe("conciliacao_estoque"):
+                self._atualizar_conciliacao(desde)
+        if self._tabela_existe("alertas_saldo"):
+            self._atualizar_alertas(chaves)
+        if self._tabela_existe("enderecos"):
+            self._atualizar_enderecos(enderecos)
+
+    def _atualizar_enderecos(self, chaves: set = None):
+        """
+        Recalcula enderecos e enderecos_trigramas para as chaves de endereço
+        dadas (None = todas). Lê movimentos_todos: o índice cobre o arquivo
+        """
+        if chaves is not None and not chaves:
+            return
 
-        return count
+        filtro = "IS NOT NULL"
+        if chaves is not None:
+            import pyarrow as pa
 
-    def _detectar_tipo(self, arquivo: str) -> str:
-        """Detecta tipo pelo nome do arquivo"""
-        arquivo_lower = arquivo.lower()
-        if "estoque" in arquivo_lower:
-            return "estoque"
-        elif "recarga" in arquivo_lower or "retirada" in arquivo_lower:
-            return "recarga"
-        elif "resgate" in arquivo_lower:
-            return "resgate"
-        elif "entrega" in arquivo_lower:
-            return "entregas"
-        return None
+            # Chaves vão como tabela Arrow: lista como parâmetro custa ~0,1 ms por item no bind
+            self.conn.register("_enderecos_tocados", pa.table({"chave": sorted(chaves)}))
+            filtro = "IN (SELECT chave FROM _enderecos_tocados)"
+        try:
+            self._recalcular_enderecos(filtro)
+        finally:
+            if chaves is not None:
+                self.conn.unregister("_enderecos_tocados")
+
+    def _recalcular_enderecos(self, filtro: str):
+        """Reescreve enderecos e enderecos_trigramas das chaves que passam em `filtro`"""
+        self.conn.execute(f"DELETE FROM enderecos_trigramas WHERE chave {filtro}")
+        self.conn.execute(f"DELETE FROM enderecos WHERE chave {filtro}")
+        # Endereço exibido = grafia mais usada (empate: a mais recente)
+        self.conn.execute(f"""
+            INSERT INTO enderecos
+            WITH grafias AS (
+                SELECT
+                    endereco_chave, endereco, COUNT(*) as vezes, MAX(endereco_numero) as numero,
+                    list(DISTINCT entrega_id) as entregas,
+                    MIN(data_movimento) as primeira, MAX(data_movimento) as ultima
+                FROM movimentos_todos
+                WHERE tipo = 'entrega' AND endereco_chave {filtro}
+                GROUP BY endereco_chave, endereco
+            )
+            SELECT
+                endereco_chave,
+                arg_max(endereco, (vezes, ultima, endereco)),
+                MAX(numero),
+                length(list_distinct(flatten(list(entregas)))),
+                MIN(primeira), MAX(ultima)
+            FROM grafias
+            GROUP BY endereco_chave
+        """)
+        self.conn.execute(f"""
+            INSERT INTO enderecos_trigramas
+            SELECT DISTINCT unnest(trigramas(chave)), chave
+            FROM enderecos
+            WHERE chave {filtro}
+        """)
 
-    def _import_estoque(self, items: list, arquivo: str) -> int:
-        """Importa registros de estoque"""
-        count = 0
-        for item in items:
-            data = self._parse_date(item.get("data_registro"))
-            if not data:
-                continue
-            self.conn.execute("""
-                INSERT INTO movimentos (tipo, driver, produto, quantidade, data_movimento, arquivo_origem)
-                VALUES ('estoque', ?, ?, ?, ?, ?)
-            """, [
-                item.get("driver"),
-                item.get("produto"),
-                item.get("quantidade"),
-                data,
-                arquivo
-            ])
-            count += 1
-        return count
+    def _atualizar_alertas(self, chaves: set = None):
+        """
+        Recalcula alertas_saldo para as chaves (driver, produto) dadas (None = todas)
+        a partir do saldo acumulado, registrando em alertas_saldo_log quem ficou
+        negativo ou se recuperou
+        """
+        if chaves is not None and not chaves:
+            return
 
-    def _import_recarga(self, items: list, arquivo: str) -> int:
-        """Importa registros de recarga"""
-        count = 0
-        for item in items:
-            data = self._parse_date(item.get("data_recarga"))
-            if not data:
-                continue
+        if chaves is None:
+            filtro, filtro_alertas = "", ""
+        else:
             self.conn.execute("""
-                INSERT INTO movimentos (tipo, driver, produto, quantidade, data_movimento, observacao, arquivo_origem)
-                VALUES ('recarga', ?, ?, ?, ?, ?, ?)
-            """, [
-                item.get("driver"),
-                item.get("produto"),
-                item.get("quantidade"),
-                data,
-                item.get("observacao"),
-                arquivo
-            ])
-            count += 1
-        return count
+                CREATE OR REPLACE TEMP TABLE _chaves_alerta AS
+                SELECT unnest(?::STRUCT(driver VARCHAR, produto VARCHAR)[], recursive := true)
+            """, [[{"driver": d, "produto": p} for d, p in chaves]])
+            filtro = "JOIN _chaves_alerta USING (driver, produto)"
+            filtro_alertas = "WHERE (driver, produto) IN (SELECT (driver, produto) FROM _chaves_alerta)"
+
+        # Estado novo das chaves: saldo atual e início da sequência negativa
+        self.conn.execute(f"""
+            CREATE OR REPLACE TEMP TABLE _saldo_alerta AS
+            WITH base AS (
+                SELECT
+                    s.*,
+                    MAX(CASE WHEN saldo_acumulado >= 0 THEN data_movimento END)
+                        OVER (PARTITION BY driver, produto) as ultimo_ok
+                FROM saldo_acumulado s {filtro}
+            )
+            SELECT
+                driver, produto,
+                arg_max(entradas_acumuladas, data_movimento) as entradas,
+                arg_max(saidas_acumuladas, data_movimento) as saidas,
+                arg_max(saldo_acumulado, data_movimento) as saldo,
+                MIN(data_movimento) FILTER (WHERE ultimo_ok IS NULL OR data_movimento > ultimo_ok) as negativo_desde,
+                MAX(data_movimento) as ultimo_movimento
+            FROM base
+            GROUP BY driver, produto
+        """)
 
-    def _import_resgate(self, items: list, arquivo: str) -> int:
-        """Importa registros de resgate (gera 2 movimentos: saída e entrada)"""
-        count = 0
-        for item in items:
-            data = self._parse_date(item.get("data_resgate"))
-            if not data:
-                continue
+        # Recuperados: eram alerta e agora têm saldo >= 0 (ou não têm mais movimentos)
+        self.conn.execute(f"""
+            INSERT INTO alertas_saldo_log (driver, produto, evento, saldo, data_movimento)
+            SELECT a.driver, a.produto, 'recuperado', COALESCE(n.saldo, 0), n.ultimo_movimento
+            FROM (SELECT * FROM alertas_saldo {filtro_alertas}) a
+            LEFT JOIN _saldo_alerta n USING (driver, produto)
+            WHERE n.saldo IS NULL OR n.saldo >= 0
+            ORDER BY a.driver, a.produto
+        """)
+        self.conn.execute("""
+            INSERT INTO alertas_saldo_log (driver, produto, evento, saldo, data_movimento)
+            SELECT n.driver, n.produto, 'negativo', n.saldo, n.negativo_desde
+            FROM _saldo_alerta n
+            ANTI JOIN alertas_saldo a USING (driver, produto)
+            WHERE n.saldo < 0
+            ORDER BY n.driver, n.produto
+        """)
 
-            # Movimento de saída (driver_origem perde)
-            self.conn.execute("""
-                INSERT INTO movimentos (tipo, driver, driver_destino, produto, quantidade, data_movimento, observacao, arquivo_origem)
-                VALUES ('resgate_saida', ?, ?, ?, ?, ?, ?, ?)
-            """, [
-                item.get("driver_origem"),
-                item.get("driver_destino"),
-                item.get("produto"),
-                item.get("quantidade"),
-                data,
-                item.get("motivo"),
-                arquivo
-            ])
-
-            # Movimento de entrada (driver_destino ganha)
-            self.conn.execute("""
-                INSERT INTO movimentos (tipo, driver, driver_destino, produto, quantidade, data_movimento, observacao, arquivo_origem)
-                VALUES ('resgate_entrada', ?, ?, ?, ?, ?, ?, ?)
-            """, [
-                item.get("driver_destino"),
-                item.get("driver_origem"),
-                item.get("produto"),
-                item.get("quantidade"),
-                data,
-                item.get("motivo"),
-                arquivo
-            ])
-            count += 2
-        return count
+        self.conn.execute(f"DELETE FROM alertas_saldo {filtro_alertas}")
+        self.conn.execute("""
+            INSERT INTO alertas_saldo
+            SELECT driver, produto, entradas, saidas, saldo, negativo_desde, ultimo_movimento
+            FROM _saldo_alerta
+            WHERE saldo < 0
+        """)
+        self.conn.execute("DROP TABLE _saldo_alerta")
+        if chaves is not None:
+            self.conn.execute("DROP TABLE _chaves_alerta")
 
-    def _import_entregas(self, items: list, arquivo: str) -> int:
-        """Importa registros de entregas"""
-        count = 0
-        for item in items:
-            data = self._parse_date(item.get("data_entrega"))
-            if not data:
-                continue
-            self.conn.execute("""
-                INSERT INTO movimentos (tipo, driver, produto, quantidade, data_movimento, endereco, arquivo_origem)
-                VALUES ('entrega', ?, ?, ?, ?, ?, ?)
-            """, [
-                item.get("driver"),
-                item.get("produto"),
-                item.get("quantidade"),
-                data,
-                item.get("endereco_1"),
-                arquivo
-            ])
-            count += 1
-        return count
+    def _atualizar_rollup(self, datas: list = None):
+        """
+        Recalcula movimentos_diarios e entregas_diarias nas datas dadas (None = tudo).
+        Datas de importação são sempre do período quente; o recálculo completo
+        lê também o arquivo
+        """
+        if datas is not None and not datas:
+            return
+
+        filtro = "data_movimento IN (SELECT unnest(?::DATE[]))" if datas is not None else "1=1"
+        params = [datas] if datas is not None else []
+        arquivo = datas is None and self._tabela_existe("movimentos_todos")  # view nasce na migração 2
+        origem = "movimentos_todos" if arquivo else "movimentos"
+
+        self.conn.execute(f"DELETE FROM movimentos_diarios WHERE {filtro}", params)
+        self.conn.execute(f"""
+            INSERT INTO movimentos_diarios
+            SELECT
+                data_movimento, driver, produto, tipo,
+                SUM(quantidade), COUNT(*), COUNT(DISTINCT entrega_id)
+            FROM {origem}
+            WHERE {filtro}
+            GROUP BY data_movimento, driver, produto, tipo
+        """, params)
+
+        self.conn.execute(f"DELETE FROM entregas_diarias WHERE {filtro}", params)
+        self.conn.execute(f"""
+            INSERT INTO entregas_diarias
+            SELECT data_movimento, driver, COUNT(DISTINCT entrega_id)
+            FROM {origem}
+            WHERE tipo = 'entrega' AND {filtro}
+            GROUP BY data_movimento, driver
+        """, params)
+
+    def _preparados(self, arquivos: list, registros: dict, workers: int):
+        """
+        Gera os arquivos preparados: primeiro os inalterados (só stat, neste
+        processo), depois os demais na ordem de `arquivos`.
+        Com workers > 1 e BYTES_MIN_POOL ou mais a ler, o decode roda num pool
+        de processos, com no máximo 2*workers arquivos em voo, enquanto o
+        chamador grava o anterior.
+        """
+        alterados = []
+        for json_file in arquivos:
+            preparado = preparado_inalterado(json_file, registros.get(json_file.name))
+            if preparado["acao"] == "ignorar":
+                yield preparado
+            else:
+                alterados.append((json_file, preparado["tamanho"]))
+        arquivos = [f for f, _ in alterados]
+
+        if workers <= 1 or len(arquivos) <= 1 or sum(t for _, t in alterados) < BYTES_MIN_POOL:
+            for json_file in arquivos:
+                yield preparar_arquivo(json_file, registros.get(json_file.name))
+            return
+
+        # spawn: não herda a conexão DuckDB do processo principal
+        contexto = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=contexto) as pool:
+            fila = iter(arquivos)
+            pendentes = deque(
+                pool.submit(preparar_arquivo, f, registros.get(f.name))
+                for f in islice(fila, workers * 2)
+            )
+            while pendentes:
+                preparado = pendentes.popleft().result()
+                proximo = next(fila, None)
+                if proximo is not None:
+                    pendentes.append(pool.submit(preparar_arquivo, proximo, registros.get(proximo.name)))
+                yield preparado
+
+    def _atualizar_saldo_acumulado(self, desde=None):
+        """
+        Recalcula saldo_acumulado a partir da data `desde` (None = tudo),
+        partindo do último saldo anterior de cada (driver, produto)
+        """
+        if desde is None:
+            self.conn.execute("DELETE FROM saldo_acumulado")
+            desde = "0001-01-01"
+        else:
+            self.conn.execute("DELETE FROM saldo_acumulado WHERE data_movimento >= ?", [desde])
+
+        self.conn.execute("""
+            INSERT INTO saldo_acumulado
+            WITH base AS (
+                SELECT
+                    driver, produto,
+                    arg_max(entradas_acumuladas, data_movimento) as entradas,
+                    arg_max(saidas_acumuladas, data_movimento) as saidas
+                FROM saldo_acumulado
+                GROUP BY driver, produto
+            ),
+            dia AS (
+                SELECT
+                    driver, produto, data_movimento,
+                    SUM(CASE WHEN tipo IN ('estoque', 'recarga', 'resgate_entrada') THEN quantidade ELSE 0 END) as entradas,
+                    SUM(CASE WHEN tipo IN ('entrega', 'resgate_saida') THEN quantidade ELSE 0 END) as saidas
+                FROM movimentos_diarios
+                WHERE data_movimento >= ?
+                GROUP BY driver, produto, data_movimento
+            ),
+            acumulado AS (
+                SELECT
+                    d.driver, d.produto, d.data_movimento, d.entradas, d.saidas,
+                    COALESCE(b.entradas, 0) + SUM(d.entradas) OVER w as entradas_acumuladas,
+                    COALESCE(b.saidas, 0) + SUM(d.saidas) OVER w as saidas_acumuladas
+                FROM dia d
+                LEFT JOIN base b ON b.driver = d.driver AND b.produto = d.produto
+                WINDOW w AS (PARTITION BY d.driver, d.produto ORDER BY d.data_movimento)
+            )
+            SELECT *, entradas_acumuladas - saidas_acumuladas
+            FROM acumulado
+        """, [desde])
+
+    def _atualizar_conciliacao(self, desde=None):
+        """
+        Recalcula conciliacao_estoque para as contagens a partir da data `desde`
+        (None = todas). Esperado = contagem anterior do driver (produto fora
+        dela = 0) + recargas/resgates - entregas do dia dessa contagem até a
+        véspera da atual. Entram os produtos contados e os que deveriam estar
+        no estoque e não foram contados; a primeira contagem do driver é a
+        base (esperado = contado)
+        """
+        if desde is None:
+            self.conn.execute("DELETE FROM conciliacao_estoque")
+            desde = "0001-01-01"
+        else:
+            self.conn.execute("DELETE FROM conciliacao_estoque WHERE data_movimento >= ?", [desde])
+
+        self.conn.execute("""
+            INSERT INTO conciliacao_estoque
+            WITH contagens AS (
+                SELECT driver, data_movimento, produto, SUM(quantidade) as contado
+                FROM movimentos_diarios
+                WHERE tipo = 'estoque'
+                GROUP BY driver, data_movimento, produto
+            ),
+            datas AS (
+                SELECT
+                    driver, data_movimento,
+                    lag(data_movimento) OVER (PARTITION BY driver ORDER BY data_movimento) as anterior
+                FROM (SELECT DISTINCT driver, data_movimento FROM contagens)
+            ),
+            alvo AS (
+                SELECT * FROM datas WHERE data_movimento >= ?
+            ),
+            previsto AS (
+                SELECT a.driver, a.data_movimento, c.produto, c.contado as quantidade
+                FROM alvo a
+                JOIN contagens c ON c.driver = a.driver AND c.data_movimento = a.anterior
+                UNION ALL
+                SELECT
+                    a.driver, a.data_movimento, m.produto,
+                    CASE WHEN m.tipo IN ('recarga', 'resgate_entrada') THEN m.quantidade ELSE -m.quantidade END
+                FROM alvo a
+                JOIN movimentos_diarios m
+                    ON m.driver = a.driver
+                    AND m.data_movimento >= a.anterior AND m.data_movimento < a.data_movimento
+                WHERE m.tipo <> 'estoque'
+            ),
+            esperados AS (
+                SELECT driver, data_movimento, produto, SUM(quantidade) as esperado
+                FROM previsto
+                GROUP BY driver, data_movimento, produto
+            ),
+            conciliado AS (
+                SELECT
+                    COALESCE(c.driver, e.driver) as driver,
+                    COALESCE(c.data_movimento, e.data_movimento) as data_movimento,
+                    COALESCE(c.produto, e.produto) as produto,
+                    c.contado,
+                    COALESCE(e.esperado, 0) as esperado
+                FROM (SELECT c.* FROM contagens c JOIN alvo a USING (driver, data_movimento)) c
+                FULL JOIN esperados e
+                    ON e.driver = c.driver AND e.data_movimento = c.data_movimento AND e.produto = c.produto
+            )
+            SELECT
+                c.driver, c.data_movimento, c.produto, COALESCE(c.contado, 0),
+                CASE WHEN a.anterior IS NULL THEN c.contado ELSE c.esperado END as esperado,
+                COALESCE(c.contado, 0) - CASE WHEN a.anterior IS NULL THEN c.contado ELSE c.esperado END
+            FROM conciliado c
+            JOIN alvo a USING (driver, data_movimento)
+            WHERE c.contado IS NOT NULL OR c.esperado <> 0
+        """, [desde])
+
+    def _atualizar_kpis(self, desde=None):
+        """
+        Recalcula kpis_acumulados a partir da data `desde` (None = tudo) até o
+        último dia com movimento, partindo da última linha anterior de cada driver
+        """
+        inicio, fim = self.conn.execute(
+            "SELECT MIN(data_movimento), MAX(data_movimento) FROM movimentos_diarios"
+        ).fetchone()
+
+        if desde is None:
+            self.conn.execute("DELETE FROM kpis_acumulados")
+            desde = inicio
+        else:
+            self.conn.execute("DELETE FROM kpis_acumulados WHERE data_movimento >= ?", [desde])
+
+        if fim is None or str(desde) > str(fim):
+            return
 
-    def sync_all(self, force: bool = False) -> dict:
+        # Totais seguem /api/kpis: resgate_entrada conta como recarga, resgate_saida
+        # como entrega; retiradas = dias com recarga
+        self.conn.execute("""
+            INSERT INTO kpis_acumulados
+            WITH diario AS (
+                SELECT
+                    driver, data_movimento,
+                    SUM(CASE WHEN tipo IN ('recarga', 'resgate_entrada') THEN quantidade ELSE 0 END) as recarga,
+                    SUM(CASE WHEN tipo IN ('entrega', 'resgate_saida') THEN quantidade ELSE 0 END) as entrega,
+                    SUM(CASE WHEN tipo = 'estoque' THEN quantidade ELSE 0 END) as estoque,
+                    MAX(CASE WHEN tipo = 'recarga' THEN 1 ELSE 0 END) as retiradas
+                FROM movimentos_diarios
+                WHERE data_movimento >= $desde
+                GROUP BY GROUPING SETS ((driver, data_movimento), (data_movimento))
+            ),
+            entregas AS (
+                SELECT driver, data_movimento, SUM(entregas) as entregas
+                FROM entregas_diarias
+                WHERE data_movimento >= $desde
+                GROUP BY GROUPING SETS ((driver, data_movimento), (data_movimento))
+            ),
+            grade AS (
+                SELECT d.driver, CAST(t.dia AS DATE) as data_movimento
+                FROM (SELECT DISTINCT driver FROM movimentos_diarios UNION SELECT 'TODOS') d
+                CROSS JOIN generate_series(CAST($desde AS TIMESTAMP), CAST($fim AS TIMESTAMP), INTERVAL 1 DAY) t(dia)
+            ),
+            base AS (
+                SELECT
+                    driver,
+                    arg_max(recarga, data_movimento) as recarga,
+                    arg_max(entrega, data_movimento) as entrega,
+                    arg_max(estoque, data_movimento) as estoque,
+                    arg_max(entregas, data_movimento) as entregas,
+                    arg_max(retiradas, data_movimento) as retiradas
+                FROM kpis_acumulados
+                GROUP BY driver
+            )
+            SELECT
+                g.driver,
+                g.data_movimento,
+                COALESCE(b.recarga, 0) + SUM(COALESCE(x.recarga, 0)) OVER w,
+                COALESCE(b.entrega, 0) + SUM(COALESCE(x.entrega, 0)) OVER w,
+                COALESCE(b.estoque, 0) + SUM(COALESCE(x.estoque, 0)) OVER w,
+                COALESCE(b.entregas, 0) + SUM(COALESCE(e.entregas, 0)) OVER w,
+                COALESCE(b.retiradas, 0) + SUM(COALESCE(x.retiradas, 0)) OVER w
+            FROM grade g
+            LEFT JOIN diario x
+                ON COALESCE(x.driver, 'TODOS') = g.driver AND x.data_movimento = g.data_movimento
+            LEFT JOIN entregas e
+                ON COALESCE(e.driver, 'TODOS') = g.driver AND e.data_movimento = g.data_movimento
+            LEFT JOIN base b ON b.driver = g.driver
+            WINDOW w AS (PARTITION BY g.driver ORDER BY g.data_movimento)
+        """, {"desde": desde, "fim": fim})
+
+    def sync_all(self, force: bool = False, output_path: Path = None, workers: int = None,
+                 publicar: bool = True) -> dict:
         """
         Sincroniza todos os JSONs de output/
-        Retorna resumo da importação
+        Reimporta só arquivos novos ou alterados e remove os que foram apagados.
+        O decode dos JSONs roda em `workers` processos (default: nº de CPUs);
+        a gravação é feita só por esta conexão, um arquivo por transação.
+        Retorna resumo da importação (`alterado` = algo foi gravado/removido)
         """
-        if not OUTPUT_PATH.exists():
+        output_path = output_path or OUTPUT_PATH
+        if not output_path.exists():
             return {"error": "Pasta output/ não encontrada"}
 
+        # Tabelas derivadas, alertas e índice de endereços são recalculados uma
+        # vez no fim, a partir da menor data e só para as chaves tocadas: o custo
+        # não cresce com o nº de arquivos e o log de alertas compara o estado
+        # publicado antes e depois do sync
+        self._derivados_pendentes = []
+        try:
+            resultado, mudou = self._importar_output(force, output_path, workers)
+        finally:
+            self._aplicar_pendentes()
+
+        # Leitores só enxergam o novo estado quando a geração é publicada
+        resultado["alterado"] = mudou
+        if publicar and (mudou or not (pasta_snapshots(self.db_path) / "CURRENT").exists()):
+            self.publicar_snapshot()
+            resultado["snapshot"] = snapshot_atual(self.db_path).name
+
+        return resultado
+
+    def _aplicar_pendentes(self):
+        """
+        Recalcula numa transação as tabelas derivadas acumuladas no sync_all
+        (união das datas, chaves e endereços) e limpa derivados_pendentes
+        """
+        if not self._derivados_pendentes:
+            self._derivados_pendentes = None
+            return
+        self.conn.begin()
+        try:
+            self._recalcular_pendentes()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self._derivados_pendentes = None
+
+    def _recalcular_pendentes(self):
+        """Recálculo de _aplicar_pendentes, na transação de quem chamou"""
+        pendentes = self._derivados_pendentes
+        if not pendentes:
+            return
+
+        def unir(conjuntos):
+            return None if any(c is None for c in conjuntos) else set().union(*conjuntos)
+
+        datas = unir([p[0] for p in pendentes])
+        self._recalcular_derivados(
+            None if datas is None else sorted(datas),
+            unir([p[1] for p in pendentes]),
+            unir([p[2] for p in pendentes]),
+        )
+        self.conn.execute("DELETE FROM derivados_pendentes")
+
+    def _concluir_sync_interrompido(self) -> bool:
+        """
+        Sync anterior gravou arquivos e parou antes do recálculo final: refaz
+        todas as tabelas derivadas. Retorna True se havia pendência
+        """
+        if not self.conn.execute("SELECT COUNT(*) FROM derivados_pendentes").fetchone()[0]:
+            return False
+        self.conn.begin()
+        try:
+            self._recalcular_derivados()
+            self.conn.execute("DELETE FROM derivados_pendentes")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return True
+
+    def _importar_output(self, force: bool, output_path: Path, workers: int) -> tuple:
+        """Importa/remove os arquivos de output/. Retorna (resumo, algo mudou)"""
+        interrompido = self._concluir_sync_interrompido()
+
+        # aliases.json mudou: reescreve os produtos já gravados antes de importar
+        aliases = self._assinatura_aliases()
+        self.sync_aliases()
+        realiasado = self._assinatura_aliases() != aliases
+        if realiasado and not force:
+            self.recanonicalizar()
+
         if force:
-            # Limpa dados existentes
+            # Limpa dados existentes (meses arquivados ficam: o Parquet não é reimportado)
             self.conn.execute("DELETE FROM movimentos")
             self.conn.execute("DELETE FROM arquivos_importados")
+            self._atualizar_derivados()
 
         resultado = {
             "arquivos_processados": 0,
             "registros_importados": 0,
             "arquivos_ignorados": 0,
+            "arquivos_removidos": 0,
             "detalhes": []
         }
 
-        for json_file in OUTPUT_PATH.glob("*.json"):
-            count = self.sync_json(json_file, force=force)
+        arquivos = sorted(output_path.glob("*.json"))
+        registros = {} if force else {
+            r[0]: {"hash": r[1], "tamanho": r[2], "mtime": r[3]}
+            for r in self.conn.execute(
+                "SELECT arquivo, hash, tamanho, mtime FROM arquivos_importados"
+            ).fetchall()
+        }
+
+        mudou = force or realiasado or interrompido
+        for preparado in self._preparados(arquivos, registros, workers or os.cpu_count() or 1):
+            mudou = mudou or preparado["acao"] == "importar"
+            count = self._gravar_preparado(preparado)
             if count > 0:
                 resultado["arquivos_processados"] += 1
                 resultado["registros_importados"] += count
-                resultado["detalhes"].append(f"{json_file.name}: {count} registros")
+                resultado["detalhes"].append(f"{preparado['arquivo']}: {count} registros")
             else:
                 resultado["arquivos_ignorados"] += 1
 
-        return resultado
+        # Arquivos importados que não existem mais em output/
+        presentes = {f.name for f in arquivos}
+        importados = [r[0] for r in self.conn.execute("SELECT arquivo FROM arquivos_importados").fetchall()]
+        for arquivo in importados:
+            if arquivo not in presentes:
+                removidos = self.remover_arquivo(arquivo)
+                mudou = True
+                resultado["arquivos_removidos"] += 1
+                resultado["detalhes"].append(f"{arquivo}: removido ({removidos} registros)")
+
+        # Reimportação completa entra na ordem dos arquivos, não das datas
+        if force:
+            self.reorganizar()
+
+        return resultado, mudou
 
     def sync_aliases(self, aliases_path: Path = None):
-        """Sincroniza aliases.json para o banco"""
+        """Espelha aliases.json na tabela aliases (apaga os que saíram do arquivo)"""
         if aliases_path is None:
-            aliases_path = Path(__file__).parent / "aliases.json"
+            aliases_path = ALIASES_PATH
 
         if not aliases_path.exists():
             return 0
@@ -359,22 +1709,58 @@ class GrowBotDB:
         with open(aliases_path, "r", encoding="utf-8") as f:
             aliases = json.load(f)
 
-        count = 0
-        for item in aliases:
-            try:
-                self.conn.execute("""
-                    INSERT OR REPLACE INTO aliases (alias, canonical, reason)
-                    VALUES (?, ?, ?)
-                """, [
-                    item.get("alias"),
-                    item.get("canonical"),
-                    item.get("reason")
-                ])
-                count += 1
-            except:
-                pass
-
-        return count
+        itens = [
+            [item["alias"], item["canonical"], item.get("reason")]
+            for item in aliases if item.get("alias") and item.get("canonical")
+        ]
+        self.conn.begin()
+        try:
+            self.conn.execute(
+                "DELETE FROM aliases WHERE alias NOT IN (SELECT unnest(?::VARCHAR[]))",
+                [[i[0] for i in itens]]
+            )
+            self.conn.executemany("""
+                INSERT INTO aliases (alias, canonical, reason) VALUES (?, ?, ?)
+                ON CONFLICT (alias) DO UPDATE SET canonical = excluded.canonical, reason = excluded.reason
+            """, itens)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        return len(itens)
+
+    def _assinatura_aliases(self) -> str:
+        """Hash do mapeamento alias -> canônico (detecta mudança no aliases.json)"""
+        return self.conn.execute("""
+            SELECT md5(COALESCE(string_agg(alias || '=' || canonical, ',' ORDER BY alias), ''))
+            FROM aliases_normalizados
+        """).fetchone()[0]
+
+    def recanonicalizar(self) -> int:
+        """
+        Reescreve movimentos.produto com a forma canônica atual num único UPDATE
+        (join dos produtos distintos com aliases_normalizados) e recalcula as
+        derivadas. Retorna linhas alteradas
+        """
+        self.conn.begin()
+        try:
+            alteradas = self.conn.execute("""
+                UPDATE movimentos SET produto = mapa.canonico
+                FROM (
+                    SELECT p.produto, COALESCE(a.canonical, normalizar_produto(p.produto)) as canonico
+                    FROM (SELECT DISTINCT produto FROM movimentos) p
+                    LEFT JOIN aliases_normalizados a ON a.alias = normalizar_produto(p.produto)
+                ) mapa
+                WHERE movimentos.produto = mapa.produto AND mapa.canonico <> mapa.produto
+            """).fetchone()[0]
+            # Arquivo frio é canonizado na leitura: as derivadas mudam mesmo sem linhas quentes
+            self._atualizar_derivados()
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return alteradas
 
     # ============ MÉTODOS DE CONSULTA ============
 
@@ -385,6 +1771,90 @@ class GrowBotDB:
         rows = result.fetchall()
         return [dict(zip(columns, row)) for row in rows]
 
+    # Resultados grandes: Arrow (colunar, sem objeto Python por valor) ou
+    # iteradores em lotes de LINHAS_POR_LOTE (memória limitada ao lote)
+
+    def fetch_arrow(self, query: str, params: list = None):
+        """Executa query e retorna o resultado inteiro como tabela Arrow"""
+        result = self.conn.execute(query, params or [])
+        # to_arrow_* nas versões novas do DuckDB; fetch_* (depreciado) nas antigas
+        if hasattr(result, "to_arrow_table"):
+            return result.to_arrow_table()
+        return result.fetch_arrow_table()
+
+    def _leitor_arrow(self, cursor, query: str, params: list = None, linhas: int = LINHAS_POR_LOTE):
+        """Executa query no cursor e retorna o RecordBatchReader (lotes de até `linhas`)"""
+        result = cursor.execute(query, params or [])
+        if hasattr(result, "to_arrow_reader"):
+            return result.to_arrow_reader(linhas)
+        return result.fetch_record_batch(linhas)
+
+    # Os iteradores leem de um cursor próprio: outra consulta em self.conn entre
+    # dois lotes substituiria o resultado pendente da conexão
+
+    def iter_batches(self, query: str, params: list = None, linhas: int = LINHAS_POR_LOTE):
+        """Executa query e gera RecordBatches Arrow de até `linhas` linhas"""
+        cursor = self.conn.cursor()
+        try:
+            yield from self._leitor_arrow(cursor, query, params, linhas)
+        finally:
+            cursor.close()
+
+    def iter_dicts(self, query: str, params: list = None, linhas: int = LINHAS_POR_LOTE):
+        """Executa query e gera um dict por linha, lendo `linhas` por vez (fetchmany)"""
+        cursor = self.conn.cursor()
+        try:
+            result = cursor.execute(query, params or [])
+            columns = [desc[0] for desc in result.description]
+            while True:
+                rows = result.fetchmany(linhas)
+                if not rows:
+                    return
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            cursor.close()
+
+    def exportar(self, query: str, destino: Path, params: list = None) -> int:
+        """
+        Grava o resultado em .parquet, .csv ou .jsonl lote a lote.
+        Resultado vazio gera o arquivo só com o schema (cabeçalho no CSV).
+        Retorna linhas exportadas
+        """
+        destino = Path(destino)
+        formato = destino.suffix.lower()
+        total = 0
+
+        if formato == ".jsonl":
+            with open(destino, "w", encoding="utf-8") as f:
+                for row in self.iter_dicts(query, params):
+                    f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+                    total += 1
+            return total
+
+        if formato == ".parquet":
+            import pyarrow.parquet as pq
+            abrir = pq.ParquetWriter
+        elif formato == ".csv":
+            import pyarrow.csv as pcsv
+            abrir = pcsv.CSVWriter
+        else:
+            raise ValueError(f"Formato não suportado: {destino.suffix} (use .parquet, .csv ou .jsonl)")
+
+        cursor = self.conn.cursor()
+        try:
+            leitor = self._leitor_arrow(cursor, query, params)
+            escritor = abrir(str(destino), leitor.schema)
+            try:
+                for lote in leitor:
+                    escritor.write_batch(lote)
+                    total += lote.num_rows
+            finally:
+                escritor.close()
+        finally:
+            cursor.close()
+        return total
+
     def saldo_driver(self, driver: str = None) -> list:
         """Retorna saldo por driver"""
         if driver:
@@ -407,6 +1877,294 @@ class GrowBotDB:
 
         return self._fetchall_dict(query, params)
 
+    def saldo_em(self, data: str, driver: str = None, produto: str = None) -> list:
+        """
+        Saldo de cada (driver, produto) ao fim do dia `data` (DD/MM/YYYY ou YYYY-MM-DD),
+        lido do saldo acumulado
+        """
+        data_iso = self._parse_date(data) if "/" in data else data
+        query = """
+            SELECT
+                driver,
+                produto,
+                arg_max(entradas_acumuladas, data_movimento) as entradas,
+                arg_max(saidas_acumuladas, data_movimento) as saidas,
+                arg_max(saldo_acumulado, data_movimento) as saldo
+            FROM saldo_acumulado
+            WHERE data_movimento <= ?
+        """
+        params = [data_iso]
+        if driver:
+            query += " AND driver = ?"
+            params.append(driver)
+        if produto:
+            query += " AND produto = ?"
+            params.append(produto)
+        query += " GROUP BY driver, produto ORDER BY driver, produto"
+
+        return self._fetchall_dict(query, params)
+
+    def kpis_periodo(self, data_inicio: str = None, data_fim: str = None, driver: str = None) -> dict:
+        """
+        KPIs de [data_inicio, data_fim] (YYYY-MM-DD; None = sem limite) como
+        diferença de duas linhas de kpis_acumulados. Mesmo formato de /api/kpis
+        """
+        driver = driver if driver and driver != "TODOS" else "TODOS"
+        kpis = {"entregas": 0, "retiradas": 0, "negativos": 0, "total_recarga": 0,
+                "total_entrega": 0, "total_estoque": 0, "saldo": 0}
+
+        inicio, fim = self.conn.execute(
+            "SELECT MIN(data_movimento), MAX(data_movimento) FROM kpis_acumulados WHERE driver = ?",
+            [driver]
+        ).fetchone()
+        if fim is None:
+            return kpis
+
+        ate = min(date.fromisoformat(data_fim), fim) if data_fim else fim
+        antes = date.fromisoformat(data_inicio) - timedelta(days=1) if data_inicio else None
+        if ate < inicio or (antes is not None and antes >= ate):
+            return kpis
+
+        colunas = "recarga, entrega, estoque, entregas, retiradas"
+        linha = "SELECT " + colunas + " FROM kpis_acumulados WHERE driver = ? AND data_movimento = ?"
+        total = self.conn.execute(linha, [driver, ate]).fetchone()
+        anterior = (0, 0, 0, 0, 0)
+        if antes is not None and antes >= inicio:
+            anterior = self.conn.execute(linha, [driver, antes]).fetchone()
+
+        recarga, entrega, estoque, entregas, retiradas = (t - a for t, a in zip(total, anterior))
+        kpis.update(
+            entregas=entregas, retiradas=retiradas, total_recarga=recarga,
+            total_entrega=entrega, total_estoque=estoque, saldo=estoque + recarga - entrega,
+        )
+
+        # Sem início e até o último dia: negativos = alertas atuais (tabela mantida)
+        if antes is None and ate == fim:
+            filtro_driver = "" if driver == "TODOS" else "WHERE driver = ?"
+            kpis["negativos"] = self.conn.execute(
+                f"SELECT COUNT(*) FROM alertas_saldo {filtro_driver}", [] if driver == "TODOS" else [driver]
+            ).fetchone()[0]
+            return kpis
+
+        # Negativos: saldo do período por (driver, produto) = saldo_acumulado(fim) - saldo_acumulado(ini - 1)
+        filtro_driver = "" if driver == "TODOS" else "WHERE driver = ?"
+        params = [ate, antes or date.min] + ([] if driver == "TODOS" else [driver])
+        kpis["negativos"] = self.conn.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT
+                    arg_max(saldo_acumulado, data_movimento) FILTER (WHERE data_movimento <= $1)
+                    - COALESCE(arg_max(saldo_acumulado, data_movimento) FILTER (WHERE data_movimento <= $2), 0)
+                    as saldo,
+                    COUNT(*) FILTER (WHERE data_movimento > $2 AND data_movimento <= $1) as dias
+                FROM saldo_acumulado
+                {filtro_driver.replace("?", "$3")}
+                GROUP BY driver, produto
+            )
+            WHERE dias > 0 AND saldo < 0
+        """, params).fetchone()[0]
+
+        return kpis
+
+    def entregas(self, data_inicio: str = None, data_fim: str = None,
+                 driver: str = None, produto: str = None, endereco: str = None) -> list:
+        """
+        Itens de entrega no mesmo formato do JSON (data_entrega em DD/MM/YYYY,
+        observacoes como lista). Datas em YYYY-MM-DD; None = sem filtro.
+        `endereco` é comparado pela chave normalizada (grafias diferentes batem).
+        Inclui os meses arquivados (só as partições do período)
+        """
+        query = f"""
+            SELECT
+                id_sale_delivery,
+                produto,
+                quantidade,
+                endereco as endereco_1,
+                endereco_2,
+                driver,
+                strftime(data_movimento, '%d/%m/%Y') as data_entrega,
+                observacao
+            FROM movimentos_todos
+            WHERE tipo = 'entrega' AND {filtro_particao(data_inicio, data_fim)}
+        """
+        params = []
+        for condicao, valor in (("data_movimento >= ?", data_inicio), ("data_movimento <= ?", data_fim),
+                                ("driver = ?", driver), ("produto = ?", produto),
+                                ("endereco_chave = ?", normalizar_endereco(endereco)[0] if endereco else None)):
+            if valor:
+                query += f" AND {condicao}"
+                params.append(valor)
+        query += " ORDER BY data_movimento, driver, id_sale_delivery, produto"
+
+        entregas = self._fetchall_dict(query, params)
+        for e in entregas:
+            obs = e.pop("observacao")
+            e["observacoes"] = obs.split("; ") if obs else []
+        return entregas
+
+    def buscar_enderecos(self, texto: str, limite: int = 20, minimo: float = 0.5) -> list:
+        """
+        Endereços do índice parecidos com `texto` (normalizado como na importação).
+        Candidatos = chaves com trigramas em comum; similaridade = fração dos
+        trigramas da busca presentes na chave (>= minimo), desempate por
+        jaro_winkler e nº de entregas
+        """
+        chave = normalizar_endereco(texto)[0]
+        if not chave:
+            return []
+        return self._fetchall_dict("""
+            WITH busca AS (
+                SELECT unnest(trigramas($chave)) as trigrama
+            ),
+            candidatos AS (
+                SELECT t.chave, COUNT(*) / (SELECT COUNT(*) FROM busca) as similaridade
+                FROM enderecos_trigramas t
+                JOIN busca USING (trigrama)
+                GROUP BY t.chave
+            )
+            SELECT e.*, round(c.similaridade, 3) as similaridade
+            FROM candidatos c
+            JOIN enderecos e USING (chave)
+            WHERE c.similaridade >= $minimo
+            ORDER BY c.similaridade DESC, jaro_winkler_similarity(e.chave, $chave) DESC, e.entregas DESC
+            LIMIT $limite
+        """, {"chave": chave, "minimo": minimo, "limite": limite})
+
+    def descobrir_aliases(self, extras: dict = None, limiar: float = 0.85) -> list:
+        """
+        Propõe aliases por similaridade entre os produtos distintos de
+        movimentos_todos e `extras` (nome -> ocorrências, ex: produtos_output()).
+        Só pares que dividem 2+ trigramas são comparados (blocking no DuckDB);
+        par similar = jaro_winkler >= limiar e até 1 edição a cada 4 letras.
+        Nome sem alias vai para o canônico mais parecido; os que não chegam a
+        nenhum canônico formam grupos novos em torno do mais frequente.
+        Retorna [{alias, canonical, similaridade, edicoes, ocorrencias, novo}]
+        """
+        extras = extras or {}
+        pares = self.conn.execute("""
+            WITH brutos AS (
+                SELECT 'banco' as fonte, produto as nome, COUNT(*) as n FROM movimentos_todos GROUP BY 2
+                UNION ALL
+                SELECT 'json', unnest($nomes::VARCHAR[]), unnest($contagens::BIGINT[])
+            ),
+            -- Mesmo item aparece no banco e no JSON: conta a fonte com mais ocorrências
+            nomes AS (
+                SELECT nome, MAX(n) as n FROM (
+                    SELECT fonte, normalizar_produto(nome) as nome, SUM(n) as n FROM brutos GROUP BY 1, 2
+                ) GROUP BY nome
+            ),
+            canonicos AS (SELECT DISTINCT canonical as nome FROM aliases_normalizados),
+            termos AS (
+                SELECT COALESCE(n.nome, c.nome) as nome, COALESCE(n.n, 0) as n, c.nome IS NOT NULL as canonico
+                FROM nomes n FULL JOIN canonicos c ON c.nome = n.nome
+                WHERE COALESCE(n.nome, c.nome) NOT IN (
+                    SELECT alias FROM aliases_normalizados WHERE alias <> canonical
+                )
+            ),
+            trigramas AS (
+                SELECT nome, unnest(list_distinct(list_transform(
+                    range(1, length(nome) + 1), i -> substr(' ' || nome || ' ', i, 3)
+                ))) as tri
+                FROM termos
+            ),
+            candidatos AS (
+                SELECT a.nome as a, b.nome as b
+                FROM trigramas a JOIN trigramas b ON a.tri = b.tri AND a.nome < b.nome
+                GROUP BY 1, 2
+                HAVING COUNT(*) >= 2
+            )
+            SELECT
+                c.a, ta.n, ta.canonico, c.b, tb.n, tb.canonico,
+                jaro_winkler_similarity(c.a, c.b) as similaridade,
+                levenshtein(c.a, c.b) as edicoes
+            FROM candidatos c
+            JOIN termos ta ON ta.nome = c.a
+            JOIN termos tb ON tb.nome = c.b
+            WHERE NOT (ta.canonico AND tb.canonico)
+              AND jaro_winkler_similarity(c.a, c.b) >= $limiar
+              AND levenshtein(c.a, c.b) <= GREATEST(1, LEAST(length(c.a), length(c.b)) // 4)
+            ORDER BY similaridade DESC
+        """, {"nomes": list(extras), "contagens": list(extras.values()), "limiar": limiar}).fetchall()
+
+        ocorrencias, canonicos, vizinhos = {}, set(), {}
+        for a, na, ca, b, nb, cb, sim, edicoes in pares:
+            ocorrencias[a], ocorrencias[b] = na, nb
+            canonicos.update(nome for nome, canonico in ((a, ca), (b, cb)) if canonico)
+            vizinhos.setdefault(a, []).append((b, sim, edicoes))
+            vizinhos.setdefault(b, []).append((a, sim, edicoes))
+
+        propostas = []
+        soltos = []
+        for nome in sorted(vizinhos):
+            if nome in canonicos:
+                continue
+            # Pares vêm ordenados por similaridade: o primeiro canônico é o melhor
+            melhor = next((v for v in vizinhos[nome] if v[0] in canonicos), None)
+            if melhor:
+                propostas.append({"alias": nome, "canonical": melhor[0], "similaridade": round(melhor[1], 3),
+                                  "edicoes": melhor[2], "ocorrencias": ocorrencias[nome], "novo": False})
+            else:
+                soltos.append(nome)
+
+        # Grupos novos: componentes conexos entre os soltos, centro = mais frequente
+        grupo = {nome: nome for nome in soltos}
+
+        def raiz(nome):
+            while grupo[nome] != nome:
+                grupo[nome] = grupo[grupo[nome]]
+                nome = grupo[nome]
+            return nome
+
+        for nome in soltos:
+            for outro, _, _ in vizinhos[nome]:
+                if outro in grupo:
+                    grupo[raiz(nome)] = raiz(outro)
+        membros = {}
+        for nome in soltos:
+            membros.setdefault(raiz(nome), []).append(nome)
+        for nomes in membros.values():
+            centro = max(nomes, key=lambda n: (ocorrencias[n], -len(n)))
+            for nome in sorted(nomes):
+                if nome == centro:
+                    continue
+                sim, edicoes = next(((s, e) for v, s, e in vizinhos[nome] if v == centro),
+                                    (None, None))
+                propostas.append({"alias": nome, "canonical": centro,
+                                  "similaridade": round(sim, 3) if sim else None,
+                                  "edicoes": edicoes, "ocorrencias": ocorrencias[nome], "novo": True})
+
+        return sorted(propostas, key=lambda p: (p["novo"], p["canonical"], p["alias"]))
+
+    def alertas(self, driver: str = None) -> list:
+        """Pares (driver, produto) com saldo negativo agora, mais negativo primeiro"""
+        query = "SELECT * FROM alertas_saldo"
+        params = []
+        if driver and driver != "TODOS":
+            query += " WHERE driver = ?"
+            params.append(driver)
+        return self._fetchall_dict(query + " ORDER BY saldo, driver, produto", params)
+
+    def alertas_log(self, desde_id: int = 0, limite: int = 100) -> list:
+        """Eventos do log de alertas com id > desde_id (mais antigos primeiro)"""
+        return self._fetchall_dict(
+            "SELECT * FROM alertas_saldo_log WHERE id > ? ORDER BY id LIMIT ?", [desde_id, limite]
+        )
+
+    def conciliacao(self, driver: str = None, data: str = None, divergentes: bool = True) -> list:
+        """Contagens de estoque x saldo esperado por produto (só divergências por default)"""
+        query = "SELECT * FROM conciliacao_estoque WHERE 1=1"
+        params = []
+        if divergentes:
+            query += " AND diferenca <> 0"
+        if driver and driver != "TODOS":
+            query += " AND driver = ?"
+            params.append(driver)
+        if data:
+            query += " AND data_movimento = ?"
+            params.append(self._parse_date(data))
+        return self._fetchall_dict(
+            query + " ORDER BY data_movimento DESC, driver, abs(diferenca) DESC, produto", params
+        )
+
     def produtos_negativos(self) -> list:
         """Retorna produtos com saldo negativo"""
         return self._fetchall_dict("SELECT * FROM v_produtos_negativos")
@@ -425,15 +2183,18 @@ class GrowBotDB:
         return self._fetchall_dict(sql)
 
     def stats(self) -> dict:
-        """Retorna estatísticas do banco"""
-        total = self.conn.execute("SELECT COUNT(*) FROM movimentos").fetchone()[0]
+        """Retorna estatísticas do banco (quente + arquivado)"""
+        total = self.conn.execute("SELECT COUNT(*) FROM movimentos_todos").fetchone()[0]
+        quentes = self.conn.execute("SELECT COUNT(*) FROM movimentos").fetchone()[0]
         por_tipo = self._fetchall_dict("""
             SELECT tipo, COUNT(*) as qtd, SUM(quantidade) as total
-            FROM movimentos GROUP BY tipo
+            FROM movimentos_todos GROUP BY tipo
         """)
 
         return {
             "total_registros": total,
+            "registros_arquivados": total - quentes,
+            "arquivado_ate": self.limite_arquivo(),
             "por_tipo": por_tipo,
             "db_path": str(self.db_path)
         }
@@ -447,18 +2208,29 @@ class GrowBotDB:
 if __name__ == "__main__":
     import sys
 
-    db = GrowBotDB()
+    import writer
+
+    # Escritas vão pelo writer (ou por uma conexão de escrita local se ele não
+    # estiver rodando); leituras abrem o snapshot atual
+    db = None if len(sys.argv) > 1 and sys.argv[1] in writer.COMANDOS_ESCRITA else GrowBotDB.snapshot()
 
     if len(sys.argv) > 1:
         cmd = sys.argv[1]
 
         if cmd == "sync":
             force = "--force" in sys.argv
-            result = db.sync_all(force=force)
+            workers = int(sys.argv[sys.argv.index("--workers") + 1]) if "--workers" in sys.argv else None
+            result = writer.sincronizar(force=force, workers=workers)
+            if not result["ok"]:
+                print(f"Erro no sync: {result['erro']}")
+                sys.exit(1)
             print(f"Sincronização concluída:")
             print(f"  Arquivos processados: {result['arquivos_processados']}")
             print(f"  Registros importados: {result['registros_importados']}")
             print(f"  Arquivos ignorados: {result['arquivos_ignorados']}")
+            print(f"  Arquivos removidos: {result['arquivos_removidos']}")
+            if result.get("snapshot"):
+                print(f"  Snapshot publicado: {result['snapshot']}")
             if result['detalhes']:
                 print("\nDetalhes:")
                 for d in result['detalhes']:
@@ -469,6 +2241,12 @@ if __name__ == "__main__":
             for row in db.saldo_driver(driver):
                 print(f"{row['driver']}: estoque={row['estoque']} recargas={row['recargas']} saidas={row['saidas']} saldo={row['saldo']}")
 
+        elif cmd == "saldo-em":
+            data = sys.argv[2]
+            driver = sys.argv[3] if len(sys.argv) > 3 else None
+            for row in db.saldo_em(data, driver):
+                print(f"{row['driver']} - {row['produto']}: {row['saldo']}")
+
         elif cmd == "negativos":
             negs = db.produtos_negativos()
             if negs:
@@ -478,29 +2256,114 @@ if __name__ == "__main__":
             else:
                 print("Nenhum produto com saldo negativo!")
 
+        elif cmd == "conciliacao":
+            driver = sys.argv[2] if len(sys.argv) > 2 else None
+            divergencias = db.conciliacao(driver)
+            if not divergencias:
+                print("Contagens de estoque batem com o saldo esperado")
+            contagem = None
+            for row in divergencias:
+                if (row['driver'], row['data_movimento']) != contagem:
+                    contagem = (row['driver'], row['data_movimento'])
+                    print(f"{row['driver']} - contagem de {row['data_movimento'].strftime('%d/%m/%Y')}:")
+                print(f"  {row['produto']}: contado={row['contado']} esperado={row['esperado']} diferença={row['diferenca']:+d}")
+
+        elif cmd == "enderecos":
+            busca = " ".join(sys.argv[2:])
+            encontrados = db.buscar_enderecos(busca)
+            if not encontrados:
+                print(f"Nenhum endereço parecido com '{busca}'")
+            for row in encontrados:
+                print(f"{row['endereco']} [{row['chave']}]: {row['entregas']} entregas, "
+                      f"última em {row['ultima_entrega'].strftime('%d/%m/%Y')} (similaridade {row['similaridade']})")
+
         elif cmd == "stats":
             stats = db.stats()
             print(f"Total de registros: {stats['total_registros']}")
+            if stats['arquivado_ate']:
+                print(f"Arquivados (antes de {stats['arquivado_ate']}): {stats['registros_arquivados']}")
             print(f"DB: {stats['db_path']}")
             print("\nPor tipo:")
             for t in stats['por_tipo']:
                 print(f"  {t['tipo']}: {t['qtd']} registros, {t['total']} unidades")
 
+        elif cmd in ("reorganizar", "snapshot"):
+            result = writer.executar(cmd)
+            if not result["ok"]:
+                print(f"Erro: {result['erro']}")
+                sys.exit(1)
+            print(f"Snapshot publicado: {result['snapshot']}")
+
+        elif cmd == "recanonicalizar":
+            result = writer.executar(cmd)
+            if not result["ok"]:
+                print(f"Erro: {result['erro']}")
+                sys.exit(1)
+            print(f"Produtos reescritos: {result['registros']} linhas")
+            print(f"Snapshot publicado: {result['snapshot']}")
+
+        elif cmd == "arquivar":
+            # AAAA-MM = primeiro mês que continua na tabela quente (default: mês atual)
+            ate = f"{sys.argv[2]}-01" if len(sys.argv) > 2 else None
+            result = writer.executar("arquivar", ate=ate)
+            if not result["ok"]:
+                print(f"Erro: {result['erro']}")
+                sys.exit(1)
+            print(f"Registros arquivados: {result['registros']} (archive/ até {result['limite']})")
+            if result.get("snapshot"):
+                print(f"Snapshot publicado: {result['snapshot']}")
+
+        elif cmd == "aliases" and sys.argv[2:3] == ["descobrir"]:
+            limiar = float(sys.argv[sys.argv.index("--limiar") + 1]) if "--limiar" in sys.argv else 0.85
+            propostas = db.descobrir_aliases(produtos_output(), limiar)
+            if not propostas:
+                print("Nenhum alias novo proposto")
+            for canonical in dict.fromkeys(p["canonical"] for p in propostas):
+                grupo = [p for p in propostas if p["canonical"] == canonical]
+                print(f"{canonical}{' (grupo novo)' if grupo[0]['novo'] else ''}")
+                for p in grupo:
+                    similaridade = f"similaridade {p['similaridade']}, " if p["similaridade"] else ""
+                    print(f"  + {p['alias']} ({p['ocorrencias']}x, {similaridade}{p['edicoes'] or '-'} edições)")
+            if "--json" in sys.argv:
+                # Formato do aliases.json, para revisar e juntar
+                destino = Path(sys.argv[sys.argv.index("--json") + 1])
+                with open(destino, "w", encoding="utf-8") as f:
+                    json.dump([
+                        {"alias": p["alias"], "canonical": p["canonical"],
+                         "reason": f"similaridade {p['similaridade']}" if p["similaridade"] else "grupo por similaridade"}
+                        for p in propostas
+                    ], f, indent=2, ensure_ascii=False)
+                print(f"\n{len(propostas)} propostas salvas em {destino}")
+
         elif cmd == "query":
             sql = " ".join(sys.argv[2:])
-            result = db.query(sql)
-            for row in result:
+            for row in db.iter_dicts(sql):
                 print(row)
 
+        elif cmd == "export":
+            destino, sql = Path(sys.argv[2]), " ".join(sys.argv[3:])
+            total = db.exportar(sql, destino)
+            print(f"{total} linhas exportadas para {destino}")
+
         else:
-            print("Comandos: sync [--force], saldo [DRIVER], negativos, stats, query <SQL>")
+            print("Comandos: sync [--force] [--workers N], saldo [DRIVER], saldo-em DATA [DRIVER], negativos, conciliacao [DRIVER], enderecos BUSCA, stats, reorganizar, snapshot, arquivar [AAAA-MM], recanonicalizar, aliases descobrir [--limiar X] [--json ARQUIVO], query <SQL>, export ARQUIVO <SQL>")
 
     else:
         print("GrowBot DB - Comandos disponíveis:")
-        print("  python db.py sync [--force]  - Sincroniza JSONs")
+        print("  python db.py sync [--force] [--workers N] - Sincroniza JSONs")
         print("  python db.py saldo [DRIVER]  - Mostra saldo")
+        print("  python db.py saldo-em DATA [DRIVER] - Saldo por produto em uma data")
         print("  python db.py negativos       - Mostra alertas")
+        print("  python db.py conciliacao [DRIVER] - Divergências das contagens de estoque")
+        print("  python db.py enderecos BUSCA - Busca endereços de entrega (normalizados)")
         print("  python db.py stats           - Estatísticas")
+        print("  python db.py reorganizar     - Reordena movimentos por data")
+        print("  python db.py snapshot        - Publica snapshot para API/TUI")
+        print("  python db.py arquivar [AAAA-MM] - Move meses anteriores para Parquet")
+        print("  python db.py recanonicalizar - Reaplica aliases.json nos produtos gravados")
+        print("  python db.py aliases descobrir [--json ARQUIVO] - Propõe aliases por similaridade")
         print("  python db.py query <SQL>     - Query livre")
+        print("  python db.py export ARQUIVO <SQL> - Exporta query (.parquet/.csv/.jsonl)")
 
-    db.close()
+    if db:
+        db.close()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Avaliação da extração contra o golden set (saidas_*.json validados à mão).
+Mede precisão/recall por campo, itens/s, latência p95 e tokens por entrega
+para cada combinação de provider, modelo e variante de prompt.
+"""
+
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from parser import parsear_arquivo
+from llm import DEFAULT_MODELS, SYSTEM_PROMPT_PATH, adicionar_args_cassete, configurar_cassete
+from main import extrair_bloco
+
+OUTPUT_PATH = Path(__file__).parent / "output"
+EXPORTS_PATH = Path(__file__).parent / "exports"
+
+# Campos avaliados (cada um comparado por entrega: driver + data + id_sale_delivery)
+CAMPOS = ["produto", "quantidade", "endereco_1", "driver", "data_entrega"]
+
+
+def _normalizar_valor(campo: str, valor):
+    """Normaliza valor para comparação (case/espaços, números)."""
+    if valor is None:
+        return None
+    if campo == "quantidade":
+        try:
+            return float(valor)
+        except (TypeError, ValueError):
+            return None
+    return " ".join(str(valor).lower().split())
+
+
+def _sessao(item: dict) -> tuple:
+    return (item.get("driver"), item.get("data_entrega"))
+
+
+def carregar_golden(output_dir: Path = OUTPUT_PATH) -> dict:
+    """Carrega saidas_*.json e agrupa items por sessão (driver, data_entrega)."""
+    golden = defaultdict(list)
+    for arquivo in sorted(output_dir.glob("saidas_*.json")):
+        with open(arquivo, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for item in data.get("items", []):
+            golden[_sessao(item)].append(item)
+    return dict(golden)
+
+
+def contar_campos(items: list) -> dict:
+    """Multiconjunto por campo: (driver, data, id_sale_delivery, valor)."""
+    contagens = {campo: Counter() for campo in CAMPOS}
+    for item in items:
+        chave = (item.get("driver"), item.get("data_entrega"), item.get("id_sale_delivery"))
+        for campo in CAMPOS:
+            valor = _normalizar_valor(campo, item.get(campo))
+            if valor is not None:
+                contagens[campo][chave + (valor,)] += 1
+    return contagens
+
+
+def precisao_recall(previstos: list, esperados: list) -> dict:
+    """Precisão/recall por campo comparando multiconjuntos."""
+    prev = contar_campos(previstos)
+    esp = contar_campos(esperados)
+
+    metricas = {}
+    for campo in CAMPOS:
+        acertos = sum((prev[campo] & esp[campo]).values())
+        total_prev = sum(prev[campo].values())
+        total_esp = sum(esp[campo].values())
+        metricas[campo] = {
+            "precisao": acertos / total_prev if total_prev else 0.0,
+            "recall": acertos / total_esp if total_esp else 0.0,
+        }
+    return metricas
+
+
+def percentil(valores: list, p: float) -> float:
+    """Percentil por interpolação linear (p entre 0 e 100)."""
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    pos = (len(ordenados) - 1) * p / 100
+    base = int(pos)
+    frac = pos - base
+    if base + 1 < len(ordenados):
+        return ordenados[base] + (ordenados[base + 1] - ordenados[base]) * frac
+    return ordenados[base]
+
+
+def avaliar_variante(blocos: list, golden: dict, provider: str, model: str,
+                     prompt_path: str, aliases_path: str, estruturado: bool = True) -> dict:
+    """Roda a extração nos blocos do golden set e calcula as métricas."""
+    previstos = []
+    latencias = []
+    tokens = 0
+    falhas = 0
+
+    inicio = time.perf_counter()
+    for bloco in blocos:
+        try:
+            items, _, metricas = extrair_bloco(
+                bloco, provider, aliases_path, estruturado, model, prompt_path
+            )
+        except Exception as e:
+            print(f"  ERRO no bloco {bloco.id_entrega} ({bloco.driver} {bloco.data_entrega}): {e}")
+            falhas += 1
+            continue
+        previstos.extend(items)
+        latencias.append(metricas["latencia_s"])
+        tokens += metricas["input_tokens"] + metricas["output_tokens"]
+    duracao = time.perf_counter() - inicio
+
+    sessoes = {(b.driver, b.data_entrega) for b in blocos}
+    esperados = [item for sessao in sessoes for item in golden.get(sessao, [])]
+    entregas = len({(b.driver, b.data_entrega, b.id_entrega) for b in blocos})
+
+    return {
+        "provider": provider,
+        "model": model,
+        "prompt": Path(prompt_path).name,
+        "blocos": len(blocos),
+        "falhas": falhas,
+        "campos": precisao_recall(previstos, esperados),
+        "itens_por_s": len(previstos) / duracao if duracao else 0.0,
+        "latencia_p95_s": percentil(latencias, 95),
+        "tokens_por_entrega": tokens / entregas if entregas else 0.0,
+    }
+
+
+def imprimir_relatorio(resultados: list):
+    """Imprime tabela comparativa das variantes."""
+    for r in resultados:
+        print(f"\n{r['provider']} | {r['model']} | {r['prompt']}")
+        print(f"  Blocos: {r['blocos']} (falhas: {r['falhas']})")
+        print(f"  Itens/s: {r['itens_por_s']:.2f}  p95: {r['latencia_p95_s']:.2f}s  "
+              f"tokens/entrega: {r['tokens_por_entrega']:.0f}")
+        for campo, m in r["campos"].items():
+            print(f"  {campo:<14} P={m['precisao']:.1%}  R={m['recall']:.1%}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Avalia extração contra o golden set")
+    parser.add_argument("--input", default=str(EXPORTS_PATH),
+                        help="Pasta com exports .txt (default: exports)")
+    parser.add_argument("--provider", nargs="+", choices=list(DEFAULT_MODELS), default=["claude"],
+                        help="Providers a avaliar")
+    parser.add_argument("--model", action="append", default=[], metavar="PROVIDER:MODELO",
+                        help="Modelo por provider (repetível), ex: claude:claude-3-5-haiku-latest")
+    parser.add_argument("--prompt", action="append", default=[], metavar="ARQUIVO",
+                        help="Variante de system prompt (repetível; default: system_prompt.md)")
+    parser.add_argument("--aliases", default="aliases.json", help="Arquivo de aliases")
+    parser.add_argument("--texto", action="store_true",
+                        help="Modo legado: resposta em texto + parse de markdown")
+    parser.add_argument("--json", metavar="ARQUIVO", help="Salva resultados em JSON")
+    adicionar_args_cassete(parser)
+    args = parser.parse_args()
+
+    configurar_cassete(args.record, args.replay, args.replay_tempo_real)
+
+    golden = carregar_golden()
+    if not golden:
+        print("Nenhum saidas_*.json encontrado em output/")
+        sys.exit(1)
+
+    blocos = []
+    for arquivo in sorted(Path(args.input).glob("*.txt")):
+        blocos.extend(b for b in parsear_arquivo(str(arquivo))
+                      if (b.driver, b.data_entrega) in golden)
+
+    if not blocos:
+        print("Nenhum bloco dos exports cobre as sessões do golden set")
+        sys.exit(1)
+
+    sessoes = sorted({(b.driver, b.data_entrega) for b in blocos}, key=str)
+    print(f"Golden set: {len(sessoes)}/{len(golden)} sessões cobertas, {len(blocos)} blocos")
+
+    modelos = defaultdict(list)
+    for spec in args.model:
+        provider, _, model = spec.partition(":")
+        modelos[provider].append(model)
+
+    prompts = args.prompt or [str(SYSTEM_PROMPT_PATH)]
+
+    resultados = []
+    for provider in args.provider:
+        for model in modelos.get(provider) or [DEFAULT_MODELS[provider]]:
+            for prompt_path in prompts:
+                print(f"\nAvaliando {provider} / {model} / {Path(prompt_path).name}...")
+                resultados.append(avaliar_variante(
+                    blocos, golden, provider, model, prompt_path, args.aliases, not args.texto
+                ))
+
+    imprimir_relatorio(resultados)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+        print(f"\nResultados salvos: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,11 @@ Wrapper para LLMs (Claude e OpenAI).
 Envia blocos de texto e recebe JSON estruturado.
 """
 
+import hashlib
 import json
 import os
 import sys
+import time
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -15,10 +17,71 @@ load_dotenv(override=True)
 # Carrega system prompt
 SYSTEM_PROMPT_PATH = Path(__file__).parent / "system_prompt.md"
 
-
-def carregar_system_prompt(aliases_path: str = None) -> str:
-    """Carrega o system prompt e adiciona aliases se existirem."""
-    with open(SYSTEM_PROMPT_PATH, 'r', encoding='utf-8') as f:
+# Schema de saída (espelha a seção "Saída (OBRIGATÓRIA)" do system_prompt.md).
+# Todos os campos são obrigatórios e anuláveis: exigência do strict mode da OpenAI.
+TOOL_NAME = "registrar_entregas"
+
+DEFAULT_MODELS = {
+    "claude": "claude-sonnet-4-20250514",
+    "openai": "gpt-4o",
+}
+
+DRIVERS_ENUM = ["RAFA", "FRANCIS", "RODRIGO", "KAROL", "ARTHUR"]
+
+ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id_pedido_item": {"type": "integer"},
+        "id_sale_delivery": {"type": ["string", "null"], "description": "3 dígitos, ex: 001"},
+        "produto": {"type": ["string", "null"], "description": "Nome canônico do produto"},
+        "quantidade": {"type": ["number", "null"]},
+        "endereco_1": {"type": ["string", "null"]},
+        "endereco_2": {"type": ["string", "null"]},
+        "driver": {"type": ["string", "null"], "enum": DRIVERS_ENUM + [None]},
+        "data_entrega": {"type": ["string", "null"], "description": "DD/MM/YYYY"},
+        "parse_mensagem_dia": {"type": ["string", "null"]},
+        "observacoes": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": [
+        "id_pedido_item", "id_sale_delivery", "produto", "quantidade",
+        "endereco_1", "endereco_2", "driver", "data_entrega",
+        "parse_mensagem_dia", "observacoes"
+    ],
+    "additionalProperties": False,
+}
+
+ALIAS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "alias": {"type": "string"},
+        "canonical": {"type": "string"},
+        "reason": {"type": "string"},
+    },
+    "required": ["alias", "canonical", "reason"],
+    "additionalProperties": False,
+}
+
+EXTRACAO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "items": {"type": "array", "items": ITEM_SCHEMA},
+        "suggested_rule_updates": {
+            "type": "object",
+            "properties": {
+                "produto_aliases_to_add": {"type": "array", "items": ALIAS_SCHEMA},
+            },
+            "required": ["produto_aliases_to_add"],
+            "additionalProperties": False,
+        },
+    },
+    "required": ["items", "suggested_rule_updates"],
+    "additionalProperties": False,
+}
+
+
+def carregar_system_prompt(aliases_path: str = None, prompt_path: str = None) -> str:
+    """Carrega o system prompt (ou uma variante) e adiciona aliases se existirem."""
+    with open(prompt_path or SYSTEM_PROMPT_PATH, 'r', encoding='utf-8') as f:
         prompt = f.read()
 
     # Adiciona aliases aprendidos, se existirem
@@ -53,64 +116,360 @@ def extrair_json(texto: str) -> dict:
     return json.loads(texto.strip())
 
 
-def extract_claude(bloco: str, aliases_path: str = None) -> dict:
-    """Extrai dados usando Claude API."""
+def validar_schema(resultado: dict) -> list[str]:
+    """Confere se o resultado segue EXTRACAO_SCHEMA. Retorna lista de problemas."""
+    problemas = []
+    if not isinstance(resultado, dict):
+        return ["resultado não é um objeto"]
+
+    items = resultado.get("items")
+    if not isinstance(items, list):
+        return ["campo 'items' ausente ou não é lista"]
+
+    campos = ITEM_SCHEMA["properties"]
+    for idx, item in enumerate(items):
+        if not isinstance(item, dict):
+            problemas.append(f"item {idx} não é um objeto")
+            continue
+        for campo in ITEM_SCHEMA["required"]:
+            if campo not in item:
+                problemas.append(f"item {idx}: campo '{campo}' ausente")
+        driver = item.get("driver")
+        if driver is not None and driver not in campos["driver"]["enum"]:
+            problemas.append(f"item {idx}: driver '{driver}' fora do ENUM")
+        quantidade = item.get("quantidade")
+        if quantidade is not None and not isinstance(quantidade, (int, float)):
+            problemas.append(f"item {idx}: quantidade '{quantidade}' não é número")
+
+    return problemas
+
+
+def _chamar_claude(bloco: str, system_prompt: str, model: str, estruturado: bool) -> tuple[dict, dict]:
+    """Chama Claude API (tool use com input_schema). Retorna (resposta, usage)."""
     import anthropic
 
     client = anthropic.Anthropic()
-    system_prompt = carregar_system_prompt(aliases_path)
+
+    kwargs = {}
+    if estruturado:
+        kwargs["tools"] = [{
+            "name": TOOL_NAME,
+            "description": "Registra os itens de entrega extraídos do bloco.",
+            "input_schema": EXTRACAO_SCHEMA,
+        }]
+        kwargs["tool_choice"] = {"type": "tool", "name": TOOL_NAME}
 
     response = client.messages.create(
-        model="claude-sonnet-4-20250514",
+        model=model,
         max_tokens=4096,
         system=system_prompt,
         messages=[
             {"role": "user", "content": bloco}
-        ]
+        ],
+        **kwargs
     )
 
-    texto = response.content[0].text
-    return extrair_json(texto)
+    usage = {
+        "input_tokens": response.usage.input_tokens,
+        "output_tokens": response.usage.output_tokens,
+    }
+
+    for content in response.content:
+        if content.type == "tool_use" and content.name == TOOL_NAME:
+            return {"provider": "claude", "modo": "estruturado", "conteudo": content.input}, usage
 
+    # Sem tool_use (ex: modo texto): cai no parse de markdown
+    texto = "".join(c.text for c in response.content if c.type == "text")
+    return {"provider": "claude", "modo": "texto", "conteudo": texto}, usage
 
-def extract_openai(bloco: str, aliases_path: str = None) -> dict:
-    """Extrai dados usando OpenAI API."""
+
+def _chamar_openai(bloco: str, system_prompt: str, model: str, estruturado: bool) -> tuple[dict, dict]:
+    """Chama OpenAI API (structured outputs com JSON schema). Retorna (resposta, usage)."""
     from openai import OpenAI
 
     client = OpenAI()
-    system_prompt = carregar_system_prompt(aliases_path)
+
+    kwargs = {}
+    if estruturado:
+        kwargs["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {
+                "name": TOOL_NAME,
+                "strict": True,
+                "schema": EXTRACAO_SCHEMA,
+            },
+        }
 
     response = client.chat.completions.create(
-        model="gpt-4o",
+        model=model,
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": bloco}
-        ]
+        ],
+        **kwargs
     )
 
-    texto = response.choices[0].message.content
-    return extrair_json(texto)
+    message = response.choices[0].message
+    if getattr(message, "refusal", None):
+        raise ValueError(f"OpenAI recusou o bloco: {message.refusal}")
 
+    usage = {
+        "input_tokens": response.usage.prompt_tokens,
+        "output_tokens": response.usage.completion_tokens,
+    }
 
-def extract(bloco: str, provider: str = "claude", aliases_path: str = None) -> dict:
-    """Wrapper que escolhe o provider."""
-    if provider == "claude":
-        return extract_claude(bloco, aliases_path)
-    elif provider == "openai":
-        return extract_openai(bloco, aliases_path)
+    if estruturado:
+        # Structured outputs garante JSON puro, sem markdown. Vai como texto: o
+        # parse fica em interpretar_resposta e a falha entra na gravação/medição
+        return {"provider": "openai", "modo": "estruturado", "conteudo": message.content}, usage
+    return {"provider": "openai", "modo": "texto", "conteudo": message.content}, usage
+
+
+def interpretar_resposta(resposta: dict) -> dict:
+    """Converte uma resposta ({provider, modo, conteudo}) no dict de items."""
+    if resposta.get("modo") == "texto":
+        return extrair_json(resposta["conteudo"])
+    if isinstance(resposta["conteudo"], str):
+        return json.loads(resposta["conteudo"])
+    return resposta["conteudo"]
+
+
+class Cassete:
+    """
+    Grava/reproduz chamadas ao LLM em um diretório (um .json por request).
+
+    Cada gravação guarda fingerprint, request, resposta, usage e latência medida.
+    No replay, `tempo_real=True` dorme a latência gravada (reproduz a
+    distribuição original); senão responde na hora.
+    """
+
+    def __init__(self, diretorio: str, modo: str, tempo_real: bool = False):
+        if modo not in ("record", "replay"):
+            raise ValueError(f"Modo de cassete desconhecido: {modo}")
+        self.diretorio = Path(diretorio)
+        self.modo = modo
+        self.tempo_real = tempo_real
+        if modo == "record":
+            self.diretorio.mkdir(parents=True, exist_ok=True)
+        elif not self.diretorio.exists():
+            raise FileNotFoundError(f"Diretório de gravações não encontrado: {diretorio}")
+
+    @staticmethod
+    def fingerprint(provider: str, model: str, estruturado: bool, system_prompt: str, bloco: str) -> str:
+        """Hash estável da request (provider, modelo, modo, prompt e bloco)."""
+        chave = json.dumps(
+            [provider, model, estruturado, system_prompt, bloco],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(chave.encode("utf-8")).hexdigest()
+
+    def _caminho(self, fp: str) -> Path:
+        return self.diretorio / f"{fp[:16]}.json"
+
+    def carregar(self, fp: str) -> dict:
+        """Retorna a gravação de uma request (KeyError se não existir)."""
+        caminho = self._caminho(fp)
+        if not caminho.exists():
+            raise KeyError(f"Request sem gravação em {self.diretorio} (fingerprint {fp[:16]})")
+        with open(caminho, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def gravar(self, fp: str, registro: dict):
+        """Salva a gravação de uma request."""
+        with open(self._caminho(fp), 'w', encoding='utf-8') as f:
+            json.dump({"fingerprint": fp, **registro}, f, indent=2, ensure_ascii=False)
+
+
+# Cassete ativa (None = chamadas reais sem gravação)
+_cassete = None
+
+
+def configurar_cassete(record: str = None, replay: str = None, tempo_real: bool = False):
+    """Ativa gravação (--record DIR) ou reprodução (--replay DIR) das chamadas."""
+    global _cassete
+    if record and replay:
+        raise ValueError("Use --record ou --replay, não os dois")
+    if record:
+        _cassete = Cassete(record, "record")
+    elif replay:
+        _cassete = Cassete(replay, "replay", tempo_real)
     else:
+        _cassete = None
+
+
+def adicionar_args_cassete(parser):
+    """Adiciona --record/--replay/--replay-tempo-real a um argparse."""
+    parser.add_argument("--record", metavar="DIR",
+                        help="Grava requests/respostas/latência das chamadas em DIR")
+    parser.add_argument("--replay", metavar="DIR",
+                        help="Reproduz respostas gravadas em DIR (sem rede)")
+    parser.add_argument("--replay-tempo-real", action="store_true",
+                        help="No replay, respeita a latência gravada de cada chamada")
+
+
+def extract_com_metricas(bloco: str, provider: str = "claude", aliases_path: str = None,
+                         estruturado: bool = True, model: str = None,
+                         prompt_path: str = None) -> tuple[dict, dict]:
+    """
+    Extrai dados e retorna (resultado, metricas).
+    metricas = {model, latencia_s, input_tokens, output_tokens, replay}
+    """
+    if provider not in DEFAULT_MODELS:
         raise ValueError(f"Provider desconhecido: {provider}")
 
+    model = model or DEFAULT_MODELS[provider]
+    system_prompt = carregar_system_prompt(aliases_path, prompt_path)
+    fp = Cassete.fingerprint(provider, model, estruturado, system_prompt, bloco)
+
+    if _cassete and _cassete.modo == "replay":
+        registro = _cassete.carregar(fp)
+        latencia = registro["latencia_s"]
+        if _cassete.tempo_real:
+            time.sleep(latencia)
+        resposta, usage = registro["resposta"], registro["usage"]
+    else:
+        chamar = _chamar_claude if provider == "claude" else _chamar_openai
+        inicio = time.perf_counter()
+        resposta, usage = chamar(bloco, system_prompt, model, estruturado)
+        latencia = time.perf_counter() - inicio
+
+        if _cassete:
+            _cassete.gravar(fp, {
+                "request": {"provider": provider, "model": model, "estruturado": estruturado, "bloco": bloco},
+                "resposta": resposta,
+                "usage": usage,
+                "latencia_s": latencia,
+            })
+
+    metricas = {
+        "model": model,
+        "latencia_s": latencia,
+        "input_tokens": usage.get("input_tokens", 0),
+        "output_tokens": usage.get("output_tokens", 0),
+        "replay": bool(_cassete and _cassete.modo == "replay"),
+    }
+    return interpretar_resposta(resposta), metricas
+
+
+def extract_claude(bloco: str, aliases_path: str = None, estruturado: bool = True) -> dict:
+    """Extrai dados usando Claude API."""
+    return extract_com_metricas(bloco, "claude", aliases_path, estruturado)[0]
+
+
+def extract_openai(bloco: str, aliases_path: str = None, estruturado: bool = True) -> dict:
+    """Extrai dados usando OpenAI API."""
+    return extract_com_metricas(bloco, "openai", aliases_path, estruturado)[0]
+
+
+def extract(bloco: str, provider: str = "claude", aliases_path: str = None,
+            estruturado: bool = True) -> dict:
+    """Wrapper que escolhe o provider."""
+    return extract_com_metricas(bloco, provider, aliases_path, estruturado)[0]
+
+
+def medir_falhas(diretorio: str) -> dict:
+    """
+    Mede taxa de falha de parse sobre respostas gravadas.
+
+    Cada arquivo .json em `diretorio` é uma resposta no formato
+    {"provider": ..., "modo": "texto"|"estruturado", "conteudo": ...}
+    (ou uma gravação de Cassete, que guarda isso em "resposta"):
+    - modo "texto": conteudo é o texto bruto do modelo (passa por extrair_json)
+    - modo "estruturado": conteudo é o objeto do tool_use / json_schema
+    """
+    resumo = {}
+    for arquivo in sorted(Path(diretorio).glob("*.json")):
+        with open(arquivo, 'r', encoding='utf-8') as f:
+            resposta = json.load(f)
+        resposta = resposta.get("resposta", resposta)
+
+        chave = f"{resposta.get('provider', '?')}/{resposta.get('modo', 'texto')}"
+        stats = resumo.setdefault(chave, {"total": 0, "falhas": 0})
+        stats["total"] += 1
+
+        try:
+            if validar_schema(interpretar_resposta(resposta)):
+                stats["falhas"] += 1
+        except (KeyError, TypeError, ValueError):
+            stats["falhas"] += 1
+
+    for stats in resumo.values():
+        stats["taxa_falha"] = stats["falhas"] / stats["total"] if stats["total"] else 0.0
+
+    return resumo
+
+
+def gravar_amostra(blocos: list, diretorio: str, provider: str = "claude",
+                   aliases_path: str = None) -> int:
+    """
+    Grava em `diretorio` a resposta de cada bloco nos dois modos (texto e
+    estruturado): uma chamada por bloco e modo, sem retry, para medir_falhas
+    comparar os mesmos blocos. Bloco já gravado é pulado (retoma execução
+    interrompida). Retorna chamadas feitas.
+    """
+    global _cassete
+    anterior, _cassete = _cassete, Cassete(diretorio, "record")
+    model = DEFAULT_MODELS[provider]
+    system_prompt = carregar_system_prompt(aliases_path)
+    chamadas = 0
+    try:
+        for i, bloco in enumerate(blocos, 1):
+            for estruturado in (False, True):
+                fp = Cassete.fingerprint(provider, model, estruturado, system_prompt, bloco.texto)
+                if _cassete._caminho(fp).exists():
+                    continue
+                modo = "estruturado" if estruturado else "texto"
+                print(f"Bloco {i}/{len(blocos)} ({modo})...")
+                chamadas += 1
+                try:
+                    extract_com_metricas(bloco.texto, provider, aliases_path, estruturado)
+                except Exception as e:
+                    # Falha de parse já ficou gravada; erro da API não entra na medição
+                    print(f"  {type(e).__name__}: {e}")
+    finally:
+        _cassete = anterior
+    return chamadas
+
 
 def main():
     import argparse
 
     parser = argparse.ArgumentParser(description="Extrai dados de entregas via LLM")
-    parser.add_argument("arquivo", help="Arquivo .txt com export do WhatsApp")
+    parser.add_argument("arquivo", nargs="?", help="Arquivo .txt com export do WhatsApp")
     parser.add_argument("--provider", choices=["claude", "openai"], default="claude")
     parser.add_argument("--aliases", default="aliases.json", help="Arquivo de aliases")
+    parser.add_argument("--texto", action="store_true",
+                        help="Modo legado: resposta em texto + parse de markdown")
+    parser.add_argument("--medir-falhas", metavar="DIR",
+                        help="Mede taxa de falha de parse nas respostas gravadas em DIR")
+    parser.add_argument("--gravar-amostra", metavar="DIR",
+                        help="Grava os blocos do arquivo nos dois modos em DIR e mede as falhas")
+    parser.add_argument("--blocos", type=int, default=0,
+                        help="Com --gravar-amostra: usa só os N primeiros blocos (0 = todos)")
+    adicionar_args_cassete(parser)
     args = parser.parse_args()
 
+    if args.medir_falhas:
+        for chave, stats in medir_falhas(args.medir_falhas).items():
+            print(f"{chave}: {stats['falhas']}/{stats['total']} falhas ({stats['taxa_falha']:.1%})")
+        return
+
+    if not args.arquivo:
+        parser.error("informe o arquivo .txt")
+
+    if args.gravar_amostra:
+        from parser import parsear_arquivo
+        blocos = parsear_arquivo(args.arquivo)
+        if args.blocos > 0:
+            blocos = blocos[:args.blocos]
+        chamadas = gravar_amostra(blocos, args.gravar_amostra, args.provider, args.aliases)
+        print(f"\n{chamadas} chamadas gravadas em {args.gravar_amostra}")
+        for chave, stats in medir_falhas(args.gravar_amostra).items():
+            print(f"{chave}: {stats['falhas']}/{stats['total']} falhas ({stats['taxa_falha']:.1%})")
+        return
+
+    configurar_cassete(args.record, args.replay, args.replay_tempo_real)
+
     if not Path(args.arquivo).exists():
         print(f"Arquivo não encontrado: {args.arquivo}")
         sys.exit(1)
@@ -131,7 +490,7 @@ def main():
 
     for i, bloco in enumerate(blocos, 1):
         print(f"Bloco {i}/{len(blocos)}...")
-        resultado = extract(bloco.texto, args.provider, args.aliases)
+        resultado = extract(bloco.texto, args.provider, args.aliases, not args.texto)
 
         if "items" in resultado:
             todos_items.extend(resultado["items"])
@@ -6,56 +6,206 @@ Pipeline completo: parse -> LLM -> validação -> export
 
 import csv
 import json
+import re
 import sys
+import time
 from datetime import datetime
+from functools import partial
 from pathlib import Path
 
 from parser import parsear_arquivo
-from llm import extract
+from llm import extract_com_metricas, adicionar_args_cassete, configurar_cassete, validar_schema
 from validator import validar_output
-
-
-def processar_arquivo(caminho: str, provider: str, aliases_path: str, limit: int = 0) -> dict:
-    """Processa um arquivo de export."""
-    blocos = parsear_arquivo(caminho)
+from cache import CacheBlocos
+
+# Tentativas por bloco (erro da API ou resposta fora do schema) e espera
+# crescente entre elas, em segundos
+TENTATIVAS_BLOCO = 3
+ESPERA_TENTATIVA = 2
+
+
+def extrair_bloco(bloco, provider: str, aliases_path: str, estruturado: bool = True,
+                  model: str = None, prompt_path: str = None) -> tuple[list, list, dict]:
+    """
+    Extrai um bloco via LLM e preenche driver/data do parser em cada item.
+    Retorna (items, sugestoes, metricas).
+    """
+    resultado, metricas = extract_com_metricas(
+        bloco.texto, provider, aliases_path, estruturado, model, prompt_path
+    )
+
+    items = resultado.get("items", [])
+    for item in items:
+        if not item.get("driver") and bloco.driver:
+            item["driver"] = bloco.driver
+        if not item.get("data_entrega") and bloco.data_entrega:
+            item["data_entrega"] = bloco.data_entrega
+
+    sugestoes = resultado.get("suggested_rule_updates", {}).get("produto_aliases_to_add", [])
+    return items, sugestoes, metricas
+
+
+def _data_ordenavel(data_entrega: str) -> str:
+    """DD/MM/YYYY -> YYYYMMDD ('' se ausente/inválida)."""
+    try:
+        dia, mes, ano = data_entrega.split("/")
+        return f"{ano}{mes.zfill(2)}{dia.zfill(2)}"
+    except (AttributeError, ValueError):
+        return ""
+
+
+def agendar_blocos(blocos: list, politica: str = "recentes",
+                   drivers_prioritarios: list = None) -> list:
+    """
+    Agrupa blocos por dia (data_entrega) e ordena pela política:
+    - "recentes": dia mais recente primeiro; dentro do dia, drivers_prioritarios
+      na ordem dada e depois os demais; blocos sem data por último
+    - "arquivo": ordem do export
+    Retorna [(data_entrega, [blocos])].
+    """
+    dias = {}
+    for bloco in blocos:
+        dias.setdefault(bloco.data_entrega, []).append(bloco)
+
+    if politica == "arquivo":
+        return list(dias.items())
+
+    prioridade = {d: i for i, d in enumerate(drivers_prioritarios or [])}
+
+    def chave_driver(bloco):
+        return (prioridade.get(bloco.driver, len(prioridade)), bloco.driver or "")
+
+    agenda = []
+    for data in sorted(dias, key=lambda d: (d is not None, _data_ordenavel(d)), reverse=True):
+        # sorted é estável: dentro do driver mantém a ordem do export
+        agenda.append((data, sorted(dias[data], key=chave_driver)))
+    return agenda
+
+
+def processar_arquivo(caminho: str, provider: str, aliases_path: str, limit: int = 0,
+                      estruturado: bool = True, cache: CacheBlocos = None,
+                      politica: str = "recentes", drivers_prioritarios: list = None,
+                      ao_concluir_dia=None) -> dict:
+    """
+    Processa um arquivo de export (reaproveitando blocos do cache, se houver).
+    Blocos são extraídos dia a dia conforme a política de prioridade;
+    `ao_concluir_dia(data_entrega, items)` é chamado quando cada dia termina.
+    Bloco com erro da API ou fora do schema é tentado até TENTATIVAS_BLOCO vezes;
+    os que esgotam vão para `blocos_perdidos` (erro) ou `blocos_fora_schema`
+    (items da última tentativa mantidos).
+    """
+    agenda = agendar_blocos(parsear_arquivo(caminho), politica, drivers_prioritarios)
 
     if limit > 0:
-        blocos = blocos[:limit]
-
-    if not blocos:
-        return {"items": [], "suggested_rule_updates": {"produto_aliases_to_add": []}}
+        restantes = limit
+        agenda_limitada = []
+        for data, blocos_dia in agenda:
+            if restantes <= 0:
+                break
+            agenda_limitada.append((data, blocos_dia[:restantes]))
+            restantes -= len(blocos_dia)
+        agenda = agenda_limitada
+
+    total_blocos = sum(len(blocos_dia) for _, blocos_dia in agenda)
+    if not total_blocos:
+        return {"items": [], "suggested_rule_updates": {"produto_aliases_to_add": []},
+                "blocos_perdidos": [], "blocos_fora_schema": []}
 
     todos_items = []
     todas_sugestoes = []
-
-    for i, bloco in enumerate(blocos, 1):
-        print(f"  Bloco {i}/{len(blocos)}...")
-        try:
-            resultado = extract(bloco.texto, provider, aliases_path)
-
-            if "items" in resultado:
-                # Preenche driver/data do parser em cada item
-                for item in resultado["items"]:
-                    if not item.get("driver") and bloco.driver:
-                        item["driver"] = bloco.driver
-                    if not item.get("data_entrega") and bloco.data_entrega:
-                        item["data_entrega"] = bloco.data_entrega
-                todos_items.extend(resultado["items"])
-
-            if "suggested_rule_updates" in resultado:
-                sugestoes = resultado["suggested_rule_updates"].get("produto_aliases_to_add", [])
-                todas_sugestoes.extend(sugestoes)
-        except Exception as e:
-            print(f"  ERRO no bloco {i}: {e}")
+    perdidos = []
+    fora_schema = []
+    i = 0
+
+    for data, blocos_dia in agenda:
+        print(f"  Dia {data or 'sem data'}: {len(blocos_dia)} blocos")
+        items_dia = []
+
+        for bloco in blocos_dia:
+            i += 1
+            if cache:
+                items = cache.buscar(bloco)
+                if items is not None:
+                    print(f"  Bloco {i}/{total_blocos}... (cache)")
+                    items_dia.extend(items)
+                    continue
+
+            print(f"  Bloco {i}/{total_blocos}...")
+            falha = {"bloco": i, "data_entrega": data, "driver": bloco.driver}
+            resultado, problemas = None, []
+            for tentativa in range(1, TENTATIVAS_BLOCO + 1):
+                if tentativa > 1:
+                    time.sleep(ESPERA_TENTATIVA * (tentativa - 1))
+                    print(f"  Bloco {i}/{total_blocos}... (tentativa {tentativa})")
+                try:
+                    items, sugestoes, _ = extrair_bloco(bloco, provider, aliases_path, estruturado)
+                except Exception as e:
+                    print(f"  ERRO no bloco {i}: {e}")
+                    falha["erro"] = f"{type(e).__name__}: {e}"
+                    continue
+                resultado = (items, sugestoes)
+                problemas = validar_schema({"items": items})
+                if not problemas:
+                    break
+                print(f"  Bloco {i} fora do schema: {'; '.join(problemas[:3])}")
+                falha["erro"] = "; ".join(problemas)
+
+            if resultado is None:
+                perdidos.append(falha)
+                continue
+            items, sugestoes = resultado
+            if problemas:
+                fora_schema.append(falha)
+            elif cache:
+                cache.guardar(bloco, items)
+            items_dia.extend(items)
+            todas_sugestoes.extend(sugestoes)
+
+        if ao_concluir_dia and items_dia:
+            ao_concluir_dia(data, items_dia)
+        todos_items.extend(items_dia)
 
     return {
         "items": todos_items,
         "suggested_rule_updates": {
             "produto_aliases_to_add": todas_sugestoes
-        }
+        },
+        "blocos_perdidos": perdidos,
+        "blocos_fora_schema": fora_schema,
     }
 
 
+def publicar_dia(items: list, caminho: Path, publicar: bool = True) -> int:
+    """
+    Salva o JSON de um dia concluído e importa no DuckDB. Retorna registros importados.
+    publicar=False importa sem publicar snapshot (ver publicar_snapshot).
+    """
+    with open(caminho, 'w', encoding='utf-8') as f:
+        json.dump({"items": items}, f, indent=2, ensure_ascii=False)
+
+    try:
+        import writer
+        resposta = writer.importar(caminho, publicar=publicar)
+        if not resposta["ok"]:
+            raise RuntimeError(resposta["erro"])
+        return resposta["registros"]
+    except Exception as e:
+        print(f"  Aviso: não foi possível importar no DB ({e}) - rode 'python db.py sync' depois")
+        return 0
+
+
+def publicar_snapshot():
+    """Publica o snapshot com os dias importados sem publicar (fim do run)."""
+    try:
+        import writer
+        resposta = writer.executar("snapshot")
+        if not resposta["ok"]:
+            raise RuntimeError(resposta["erro"])
+        print(f"\nSnapshot publicado: {resposta['snapshot']}")
+    except Exception as e:
+        print(f"  Aviso: não foi possível publicar o snapshot ({e}) - rode 'python db.py snapshot' depois")
+
+
 def exportar_csv(items: list, caminho: str):
     """Exporta items para CSV."""
     if not items:
@@ -114,8 +264,25 @@ def main():
                         help="Arquivo de aliases (default: aliases.json)")
     parser.add_argument("--limit", type=int, default=0,
                         help="Limitar número de blocos (0 = todos)")
+    parser.add_argument("--texto", action="store_true",
+                        help="Modo legado: resposta em texto + parse de markdown")
+    parser.add_argument("--sem-cache", action="store_true",
+                        help="Não reaproveita extrações de blocos quase idênticos")
+    parser.add_argument("--prioridade", choices=["recentes", "arquivo"], default="recentes",
+                        help="Ordem de extração: dia mais recente primeiro ou ordem do export")
+    parser.add_argument("--drivers-prioritarios", default="",
+                        help="Drivers extraídos primeiro dentro de cada dia (ex: RODRIGO,KAROL)")
+    parser.add_argument("--sem-flush", action="store_true",
+                        help="Não publica cada dia concluído (salva um JSON único no final)")
+    parser.add_argument("--intervalo-snapshot", type=float, default=30,
+                        help="Segundos mínimos entre snapshots publicados durante o run (default: 30)")
+    adicionar_args_cassete(parser)
     args = parser.parse_args()
 
+    configurar_cassete(args.record, args.replay, args.replay_tempo_real)
+    cache = None if args.sem_cache else CacheBlocos(aliases_path=args.aliases)
+    drivers_prioritarios = [d.strip().upper() for d in args.drivers_prioritarios.split(",") if d.strip()]
+
     input_dir = Path(args.input)
     output_dir = Path(args.output)
     output_dir.mkdir(exist_ok=True)
@@ -129,42 +296,104 @@ def main():
 
     print(f"Processando {len(arquivos)} arquivo(s) com {args.provider}...\n")
 
-    todos_items = []
-    todas_sugestoes = []
-
-    for arquivo in arquivos:
-        print(f"Arquivo: {arquivo.name}")
-        resultado = processar_arquivo(str(arquivo), args.provider, args.aliases, args.limit)
-        todos_items.extend(resultado["items"])
-        todas_sugestoes.extend(resultado["suggested_rule_updates"]["produto_aliases_to_add"])
-
-    # Valida output
-    output_completo = {"items": todos_items}
-    erros, output_validado = validar_output(output_completo)
-
-    if erros:
-        print(f"\nValidação: {len(erros)} campos corrigidos")
-
     # Gera timestamp para output
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    # Exporta JSON
-    json_path = output_dir / f"entregas_{args.provider}_{ts}.json"
-    with open(json_path, 'w', encoding='utf-8') as f:
-        json.dump(output_validado, f, indent=2, ensure_ascii=False)
-    print(f"\nJSON salvo: {json_path}")
+    todos_items = []
+    todas_sugestoes = []
+    blocos_perdidos = []
+    blocos_fora_schema = []
+    total_erros = 0
+
+    # Dias publicados vão para a pasta que o sync lê, mesmo com --output em
+    # outro lugar: fora dela o próximo sync apagaria as linhas importadas
+    pasta_dias = output_dir
+    if not args.sem_flush:
+        try:
+            from db import OUTPUT_PATH as pasta_dias
+        except ImportError:
+            pass  # sem DuckDB: publicar_dia só grava o JSON
+        pasta_dias.mkdir(exist_ok=True)
+
+    # Cada dia é importado assim que termina, mas o snapshot (cópia do banco
+    # inteiro) sai no máximo a cada --intervalo-snapshot e uma vez no fim
+    ultimo_snapshot = None
+    snapshot_pendente = False
+
+    def ao_concluir_dia(arquivo, data_entrega, items):
+        # Valida e publica o dia assim que termina (TUI/app veem antes do fim do run).
+        # Nome leva o .txt de origem: o mesmo dia em dois exports não se sobrescreve
+        nonlocal total_erros, ultimo_snapshot, snapshot_pendente
+        erros, _ = validar_output({"items": items})
+        total_erros += len(erros)
+        sufixo = _data_ordenavel(data_entrega) or "semdata"
+        origem = re.sub(r"[^\w-]+", "_", arquivo.stem).strip("_") or "export"
+        caminho = pasta_dias / f"entregas_{args.provider}_{ts}_{origem}_{sufixo}.json"
+        publicar = ultimo_snapshot is None or time.monotonic() - ultimo_snapshot >= args.intervalo_snapshot
+        count = publicar_dia(items, caminho, publicar)
+        if publicar:
+            ultimo_snapshot = time.monotonic()
+        snapshot_pendente = not publicar
+        print(f"  Dia {data_entrega or 'sem data'} publicado: {caminho.name} ({count} registros no DB"
+              f"{'' if publicar else ', snapshot adiado'})")
+
+    try:
+        for arquivo in arquivos:
+            print(f"Arquivo: {arquivo.name}")
+            concluir_dia = None if args.sem_flush else partial(ao_concluir_dia, arquivo)
+            resultado = processar_arquivo(str(arquivo), args.provider, args.aliases, args.limit,
+                                          estruturado=not args.texto, cache=cache,
+                                          politica=args.prioridade,
+                                          drivers_prioritarios=drivers_prioritarios,
+                                          ao_concluir_dia=concluir_dia)
+            todos_items.extend(resultado["items"])
+            todas_sugestoes.extend(resultado["suggested_rule_updates"]["produto_aliases_to_add"])
+            blocos_perdidos.extend({"arquivo": arquivo.name, **b} for b in resultado["blocos_perdidos"])
+            blocos_fora_schema.extend({"arquivo": arquivo.name, **b} for b in resultado["blocos_fora_schema"])
+    finally:
+        # Dias importados com snapshot adiado (inclusive se o run parar no meio)
+        if snapshot_pendente:
+            publicar_snapshot()
+
+    if args.sem_flush:
+        # Valida output
+        erros, _ = validar_output({"items": todos_items})
+        total_erros = len(erros)
+
+        # Exporta JSON
+        json_path = output_dir / f"entregas_{args.provider}_{ts}.json"
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({"items": todos_items}, f, indent=2, ensure_ascii=False)
+        print(f"\nJSON salvo: {json_path}")
+
+    if total_erros:
+        print(f"\nValidação: {total_erros} campos corrigidos")
 
     # Exporta CSV
     csv_path = output_dir / f"entregas_{args.provider}_{ts}.csv"
-    exportar_csv(output_validado["items"], str(csv_path))
+    exportar_csv(todos_items, str(csv_path))
     print(f"CSV salvo: {csv_path}")
 
     # Atualiza aliases
     if todas_sugestoes:
         atualizar_aliases(todas_sugestoes, args.aliases)
 
+    if cache:
+        cache.salvar()
+        print(f"\n{cache.resumo()}")
+
     print(f"\nTotal: {len(todos_items)} itens extraídos")
 
+    # Blocos que esgotaram as tentativas não entram no cache: rodar de novo refaz só eles
+    if blocos_fora_schema:
+        print(f"\nBlocos fora do schema após {TENTATIVAS_BLOCO} tentativas (items mantidos, revisar):")
+        for b in blocos_fora_schema:
+            print(f"  - {b['arquivo']} bloco {b['bloco']} ({b['driver'] or '?'}, {b['data_entrega'] or 'sem data'}): {b['erro']}")
+    if blocos_perdidos:
+        print(f"\nBlocos PERDIDOS após {TENTATIVAS_BLOCO} tentativas (sem items, rodar de novo):")
+        for b in blocos_perdidos:
+            print(f"  - {b['arquivo']} bloco {b['bloco']} ({b['driver'] or '?'}, {b['data_entrega'] or 'sem data'}): {b['erro']}")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,41 @@
+import json
+
+from db import GrowBotDB
+
+
+def _gravar(pasta, nome, dados):
+    (pasta / nome).write_text(json.dumps(dados), encoding="utf-8")
+
+
+def _estoque(pasta, data, quantidade):
+    dia, mes, ano = data.split("/")
+    _gravar(pasta, f"estoque_{ano}{mes}{dia}_RAFA.json", {"tipo": "estoque", "items": [
+        {"driver": "RAFA", "produto": "dry", "quantidade": quantidade, "data_registro": data},
+    ]})
+
+
+def test_contagens_sucessivas_partem_da_contagem_anterior(tmp_path):
+    output = tmp_path / "output"
+    output.mkdir()
+    _estoque(output, "01/01/2026", 10)
+    _estoque(output, "03/01/2026", 7)
+    _estoque(output, "05/01/2026", 5)
+    _estoque(output, "07/01/2026", 4)
+    _gravar(output, "entregas_validadas.json", {"items": [
+        {"id_sale_delivery": "001", "produto": "dry", "quantidade": 3, "driver": "RAFA",
+         "data_entrega": "02/01/2026"},
+        {"id_sale_delivery": "002", "produto": "dry", "quantidade": 2, "driver": "RAFA",
+         "data_entrega": "04/01/2026"},
+    ]})
+
+    db = GrowBotDB(tmp_path / "t.duckdb", read_only=False)
+    try:
+        db.sync_all(output_path=output, workers=1, publicar=False)
+        linhas = sorted(db.conciliacao("RAFA", divergentes=False), key=lambda r: r["data_movimento"])
+    finally:
+        db.close()
+
+    # 1ª contagem é a base; 07/01 conta 4 sem movimento desde a de 05/01 (5)
+    assert [(r["contado"], r["esperado"], r["diferenca"]) for r in linhas] == [
+        (10, 10, 0), (7, 7, 0), (5, 5, 0), (4, 5, -1),
+    ]
@@ -2,11 +2,13 @@
 GrowBot TUI - Dashboard de Entregas
 Duas visões: Cards (híbrido) e Tabela (movimentos)
 """
-import json
+import time
 from datetime import datetime, timedelta
 from pathlib import Path
 from collections import defaultdict
+from textual import work
 from textual.app import App, ComposeResult
+from textual.worker import get_current_worker
 from textual.containers import Horizontal, Vertical, VerticalScroll
 from textual.widgets import (
     Header, Footer, Static, Label, Button,
@@ -15,7 +17,8 @@ from textual.widgets import (
 )
 from textual.binding import Binding
 from rich.text import Text
-from db import GrowBotDB
+from db import GrowBotDB, filtro_particao
+import writer
 
 DRIVERS = ["TODOS", "RAFA", "FRANCIS", "RODRIGO", "KAROL", "ARTHUR"]
 DIAS_SEMANA = ["Seg", "Ter", "Qua", "Qui", "Sex", "Sab", "Dom"]
@@ -63,16 +66,31 @@ def format_valor(valor: int, tipo: str = None, width: int = 8) -> Text:
         return Text(valor_str)
 
 
-def load_entregas_from_json() -> list:
-    """Carrega entregas do JSON para ter id_sale_delivery"""
-    entregas_file = OUTPUT_PATH / "entregas_validadas.json"
-    if not entregas_file.exists():
-        return []
-
-    with open(entregas_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+def consulta_tabela(data_ini_iso: str = None, data_fim_iso: str = None, driver: str = "TODOS") -> tuple:
+    """SQL e parâmetros da tabela do dashboard: totais por driver, produto, dia e tipo"""
+    query = """
+        SELECT
+            driver,
+            produto,
+            data_movimento,
+            tipo,
+            SUM(quantidade) as total
+        FROM movimentos_diarios
+        WHERE 1=1
+    """
+    params = []
+    if data_ini_iso:
+        query += " AND data_movimento >= ?"
+        params.append(data_ini_iso)
+    if data_fim_iso:
+        query += " AND data_movimento <= ?"
+        params.append(data_fim_iso)
+    if driver != "TODOS":
+        query += " AND driver = ?"
+        params.append(driver)
 
-    return data.get("items", [])
+    query += " GROUP BY driver, produto, data_movimento, tipo ORDER BY driver, produto, data_movimento"
+    return query, params
 
 
 class FilterPanel(Static):
@@ -380,7 +398,7 @@ class ComparisonPanel(VerticalScroll):
 
 
 class AlertsPanel(VerticalScroll):
-    """Painel de alertas - produtos com mais saída que entrada (saldo negativo)"""
+    """Painel de alertas - (driver, produto) com saldo negativo (tabela alertas_saldo)"""
 
     def compose(self) -> ComposeResult:
         yield Label("[bold bright_yellow]⚠️ ALERTAS[/]", classes="panel-title")
@@ -389,41 +407,32 @@ class AlertsPanel(VerticalScroll):
         table.header_height = 1
         yield table
 
-    def update_data(self, dados_produto: dict, dados_driver: dict):
-        """Atualiza tabela com produtos que têm saldo negativo"""
+    def update_data(self, alertas: list):
+        """Atualiza tabela com os alertas (GrowBotDB.alertas, mais negativo primeiro)"""
         table = self.query_one("#alerts_table", DataTable)
         table.clear(columns=True)
 
-        # Colunas: Driver, Produto, Saldo
+        # Colunas: Driver, Produto, Saldo, Desde
         table.add_column("Driver", key="driver")
         table.add_column("Produto", key="produto")
         table.add_column("Saldo", key="saldo")
-
-        alertas = []
-        for driver, produtos in dados_produto.items():
-            for produto, datas_dict in produtos.items():
-                saldo = 0
-                for data_str, tipos in datas_dict.items():
-                    saldo += tipos.get("estoque", 0)
-                    saldo += tipos.get("recarga", 0)
-                    saldo -= tipos.get("saida", 0)
-                if saldo < 0:
-                    alertas.append((driver, produto, saldo))
+        table.add_column("Desde", key="desde")
 
         if not alertas:
             table.add_row(
                 Text("✓", style="green"),
                 Text("Nenhum alerta", style="dim"),
+                Text("-", style="dim"),
                 Text("-", style="dim")
             )
             return
 
-        # Ordenar por saldo (mais negativo primeiro)
-        for driver, produto, saldo in sorted(alertas, key=lambda x: x[2]):
+        for alerta in alertas:
             table.add_row(
-                Text(driver, style="yellow"),
-                Text(produto, style="dim"),
-                format_valor(saldo, "saldo", width=6)
+                Text(alerta["driver"], style="yellow"),
+                Text(alerta["produto"], style="dim"),
+                format_valor(alerta["saldo"], "saldo", width=6),
+                Text(alerta["negativo_desde"].strftime("%d/%m"), style="dim")
             )
 
 
@@ -694,7 +703,7 @@ class GrowBotTUI(App):
 
     def __init__(self):
         super().__init__()
-        self.db = None  # Conexão sob demanda para não bloquear sync
+        self.db = None  # Conexão sob demanda no snapshot atual
         self.data_inicio = None
         self.data_fim = None
         self.driver_filtro = "TODOS"
@@ -714,18 +723,19 @@ class GrowBotTUI(App):
         self._colunas_visiveis = []
         self._dados_driver = {}
         self._dados_produto = {}
+        self._refresh_alertas = None  # timer do refresh pedido por alerta do writer
 
     def _connect_db(self):
-        """Abre conexão com DB (fecha antiga se existir)"""
+        """Abre o snapshot atual do DB (fecha conexão antiga se existir)"""
         if self.db:
             try:
                 self.db.conn.close()
             except:
                 pass
-        self.db = GrowBotDB()
+        self.db = GrowBotDB.snapshot()
 
     def _disconnect_db(self):
-        """Fecha conexão com DB para liberar lock"""
+        """Fecha conexão (o próximo refresh abre a geração mais recente)"""
         if self.db:
             try:
                 self.db.conn.close()
@@ -733,6 +743,22 @@ class GrowBotTUI(App):
                 pass
             self.db = None
 
+    def _buscar_entregas(self, **filtros) -> list:
+        """
+        Entregas do banco (GrowBotDB.entregas). Fora do refresh (cliques)
+        abre o snapshot atual e fecha em seguida
+        """
+        try:
+            if self.db:
+                return self.db.entregas(**filtros)
+            db = GrowBotDB.snapshot()
+            try:
+                return db.entregas(**filtros)
+            finally:
+                db.close()
+        except:
+            return []
+
     def compose(self) -> ComposeResult:
         yield Header(show_clock=True)
         with Horizontal(id="main-container"):
@@ -769,6 +795,44 @@ class GrowBotTUI(App):
         self.query_one(TabbedContent).active = "tab-table"
 
         self.refresh_data()
+        self._ouvir_alertas()
+
+    @work(thread=True, exclusive=True, group="alertas")
+    def _ouvir_alertas(self) -> None:
+        """
+        Assina os alertas do writer e recarrega quando chega evento novo
+        (sem writer rodando, tenta de novo a cada 30s)
+        """
+        worker = get_current_worker()
+        while not worker.is_cancelled:
+            if writer.writer_ativo():
+                try:
+                    for evento in writer.assinar_alertas(timeout=1):
+                        if worker.is_cancelled:
+                            return
+                        if evento:
+                            self.call_from_thread(self._alerta_recebido, evento)
+                except OSError:
+                    pass
+            for _ in range(30):
+                if worker.is_cancelled:
+                    return
+                time.sleep(1)
+
+    def _alerta_recebido(self, evento: dict) -> None:
+        """
+        Evento do writer: avisa e recarrega (o snapshot novo já foi publicado).
+        Eventos do mesmo lote chegam juntos: um refresh só, meio segundo depois
+        """
+        if evento["evento"] == "negativo":
+            self.notify(f"{evento['driver']} - {evento['produto']}: saldo {evento['saldo']}",
+                        title="Saldo negativo", severity="warning")
+        else:
+            self.notify(f"{evento['driver']} - {evento['produto']}: saldo {evento['saldo']}",
+                        title="Saldo recuperado")
+        if self._refresh_alertas:
+            self._refresh_alertas.stop()
+        self._refresh_alertas = self.set_timer(0.5, self.refresh_data)
 
     def _parse_date_to_iso(self, date_str: str) -> str:
         if not date_str:
@@ -827,7 +891,7 @@ class GrowBotTUI(App):
 
     def refresh_data(self) -> None:
         """Atualiza ambas as visões"""
-        # Conectar ao DB (libera lock após refresh)
+        # Conectar ao snapshot atual (reabre a cada refresh para pegar a geração nova)
         self._connect_db()
 
         try:
@@ -847,7 +911,7 @@ class GrowBotTUI(App):
             self._refresh_table()
             self._refresh_rodrigo()
         finally:
-            # Desconectar para liberar lock do arquivo
+            # Fechar conexão com o snapshot
             self._disconnect_db()
 
     def _refresh_cards(self) -> None:
@@ -857,18 +921,13 @@ class GrowBotTUI(App):
         for child in list(cards_panel.children):
             child.remove()
 
-        data_ini = self._parse_date_br(self.data_inicio)
-        data_fim = self._parse_date_br(self.data_fim)
-
-        all_entregas = load_entregas_from_json()
+        data_ini_iso = self._parse_date_to_iso(self.data_inicio)
+        data_fim_iso = self._parse_date_to_iso(self.data_fim)
 
-        entregas_filtradas = []
-        for e in all_entregas:
-            if not self._date_in_range(e.get("data_entrega", ""), data_ini, data_fim):
-                continue
-            if self.driver_filtro != "TODOS" and e.get("driver") != self.driver_filtro:
-                continue
-            entregas_filtradas.append(e)
+        entregas_filtradas = self._buscar_entregas(
+            data_inicio=data_ini_iso, data_fim=data_fim_iso,
+            driver=self.driver_filtro if self.driver_filtro != "TODOS" else None,
+        )
 
         grupos = defaultdict(list)
         for e in entregas_filtradas:
@@ -876,10 +935,11 @@ class GrowBotTUI(App):
             grupos[key].append(e)
 
         # Busca recargas
-        data_ini_iso = self._parse_date_to_iso(self.data_inicio)
-        data_fim_iso = self._parse_date_to_iso(self.data_fim)
 
-        query_recargas = "SELECT data_movimento, driver, produto, quantidade FROM movimentos WHERE tipo = 'recarga'"
+        query_recargas = (
+            "SELECT data_movimento, driver, produto, quantidade FROM movimentos_todos"
+            f" WHERE tipo = 'recarga' AND {filtro_particao(data_ini_iso, data_fim_iso)}"
+        )
         params_rec = []
 
         if data_ini_iso:
@@ -937,28 +997,7 @@ class GrowBotTUI(App):
         data_fim_iso = self._parse_date_to_iso(self.data_fim)
 
         # Buscar dados agregados por driver E produto
-        query_mov = """
-            SELECT
-                driver,
-                produto,
-                data_movimento,
-                tipo,
-                SUM(quantidade) as total
-            FROM movimentos
-            WHERE 1=1
-        """
-        params_mov = []
-        if data_ini_iso:
-            query_mov += " AND data_movimento >= ?"
-            params_mov.append(data_ini_iso)
-        if data_fim_iso:
-            query_mov += " AND data_movimento <= ?"
-            params_mov.append(data_fim_iso)
-        if self.driver_filtro != "TODOS":
-            query_mov += " AND driver = ?"
-            params_mov.append(self.driver_filtro)
-
-        query_mov += " GROUP BY driver, produto, data_movimento, tipo ORDER BY driver, produto, data_movimento"
+        query_mov, params_mov = consulta_tabela(data_ini_iso, data_fim_iso, self.driver_filtro)
 
         try:
             movimentos = self.db.conn.execute(query_mov, params_mov).fetchall()
@@ -982,11 +1021,6 @@ class GrowBotTUI(App):
         todas_datas = set()
         colunas_com_dados = set()  # (data, tipo) que têm algum valor
 
-        # Variáveis para KPIs
-        kpi_total_recarga = 0
-        kpi_total_entrega = 0
-        kpi_datas_recarga = set()
-
         for driver, produto, data_mov, tipo, total in movimentos:
             data_str = str(data_mov)
             todas_datas.add(data_str)
@@ -997,13 +1031,6 @@ class GrowBotTUI(App):
                 self._dados_driver[driver][data_str][tipo_norm] += total
                 colunas_com_dados.add((data_str, tipo_norm))
 
-                # Acumular KPIs
-                if tipo_norm == "recarga":
-                    kpi_total_recarga += total
-                    kpi_datas_recarga.add(data_str)
-                elif tipo_norm == "saida":
-                    kpi_total_entrega += total
-
         # Ordenar datas
         datas = sorted(todas_datas)
 
@@ -1200,49 +1227,13 @@ class GrowBotTUI(App):
                             row_entrega = self._build_entrega_row(e, len(colunas_visiveis), is_last)
                             table.add_row(*row_entrega, key=f"entrega_{driver}_{produto}_{e.get('id_sale_delivery', '')}_{i}")
 
-        # Calcular e atualizar KPIs
-        # Contar entregas distintas (do JSON)
-        all_entregas = load_entregas_from_json()
-        data_ini = self._parse_date_br(self.data_inicio)
-        data_fim = self._parse_date_br(self.data_fim)
-
-        entregas_ids = set()
-        for e in all_entregas:
-            if self.driver_filtro != "TODOS" and e.get("driver") != self.driver_filtro:
-                continue
-            if not self._date_in_range(e.get("data_entrega", ""), data_ini, data_fim):
-                continue
-            entregas_ids.add(e.get("id_sale_delivery"))
-
-        kpi_entregas = len(entregas_ids)
-        kpi_retiradas = len(kpi_datas_recarga)
-
-        # Contar produtos com saldo negativo e calcular totais
-        kpi_negativos = 0
-        kpi_total_estoque = 0
-        kpi_saldo_total = 0
-
-        for driver in self._dados_driver.keys():
-            for produto in self._dados_produto[driver].keys():
-                saldo = 0
-                for data_str in todas_datas:
-                    d = self._dados_produto[driver][produto].get(data_str, {})
-                    saldo += d.get("estoque", 0)
-                    saldo += d.get("recarga", 0)
-                    saldo -= d.get("saida", 0)
-                    kpi_total_estoque += d.get("estoque", 0)
-                if saldo < 0:
-                    kpi_negativos += 1
-
-        # Calcular saldo total
-        kpi_saldo_total = kpi_total_estoque + kpi_total_recarga - kpi_total_entrega
-
-        # Atualizar KPIBar
+        # Atualizar KPIBar (KPIs do período: diferença de duas linhas das somas prefixadas)
         show_driver_kpis = self.driver_filtro != "TODOS"
         try:
+            kpis = self.db.kpis_periodo(data_ini_iso, data_fim_iso, self.driver_filtro)
             self.query_one("#kpi-bar", KPIBar).update_kpis(
-                kpi_entregas, kpi_retiradas, kpi_negativos, kpi_total_recarga, kpi_total_entrega,
-                kpi_total_estoque, kpi_saldo_total, show_driver_kpis
+                kpis["entregas"], kpis["retiradas"], kpis["negativos"], kpis["total_recarga"],
+                kpis["total_entrega"], kpis["total_estoque"], kpis["saldo"], show_driver_kpis
             )
         except:
             pass
@@ -1255,7 +1246,7 @@ class GrowBotTUI(App):
                 comparison_panel.add_class("visible")
 
                 alerts_panel = self.query_one("#alerts-panel", AlertsPanel)
-                alerts_panel.update_data(self._dados_produto, self._dados_driver)
+                alerts_panel.update_data(self.db.alertas(self.driver_filtro))
                 alerts_panel.add_class("visible")
             except:
                 pass
@@ -1280,11 +1271,21 @@ class GrowBotTUI(App):
         table.add_column(Text("Qtd", justify="right"), key="qtd")
         table.add_column(Text("Acum", justify="right"), key="acum")
 
-        # Query
+        # Query (Acum via window: entradas = estoques e depois recargas; saídas à parte)
         query = """
-            SELECT tipo, data_movimento, SUM(quantidade) as total
-            FROM movimentos WHERE driver = 'RODRIGO'
-            GROUP BY tipo, data_movimento ORDER BY data_movimento
+            SELECT
+                tipo, data_movimento, total,
+                SUM(total) OVER (
+                    PARTITION BY tipo = 'entrega'
+                    ORDER BY tipo = 'recarga', data_movimento
+                ) as acum
+            FROM (
+                SELECT tipo, data_movimento, SUM(quantidade) as total
+                FROM movimentos_diarios
+                WHERE driver = 'RODRIGO' AND tipo IN ('estoque', 'recarga', 'entrega')
+                GROUP BY tipo, data_movimento
+            )
+            ORDER BY data_movimento
         """
 
         try:
@@ -1299,21 +1300,18 @@ class GrowBotTUI(App):
 
         # Separar por tipo
         estoques, recargas, saidas = [], [], []
-        for tipo, data, total in movimentos:
+        for tipo, data, total, acum in movimentos:
             data_iso = str(data)
             data_br = self._iso_to_br(data_iso)
             if tipo == "estoque":
-                estoques.append((data_br, total))
+                estoques.append((data_br, total, acum))
             elif tipo == "recarga":
-                recargas.append((data_br, total))
+                recargas.append((data_br, total, acum))
             elif tipo == "entrega":
-                saidas.append((data_br, data_iso, total))  # Guarda ISO para key
-
-        acum = 0
+                saidas.append((data_br, data_iso, total, acum))  # Guarda ISO para key
 
         # Estoque
-        for data, total in estoques:
-            acum += total
+        for data, total, acum in estoques:
             table.add_row(f"📸 ESTOQUE {data[:5]}", str(total), str(acum))
 
         # Separador
@@ -1321,20 +1319,18 @@ class GrowBotTUI(App):
             table.add_row("─" * 25, "─" * 6, "─" * 6)
 
         # Recargas
-        for data, total in recargas:
-            acum += total
+        for data, total, acum in recargas:
             table.add_row(f"📦 Recarga {data[:5]}", str(total), str(acum))
 
         # Total Entradas
-        total_entradas = acum
+        total_entradas = sum(t for _, t, _ in estoques) + sum(t for _, t, _ in recargas)
         table.add_row("─" * 25, "─" * 6, "─" * 6)
         table.add_row("✅ TOTAL ENTRADAS", str(total_entradas), "")
         table.add_row("─" * 25, "─" * 6, "─" * 6)
 
         # Saidas
         acum_saidas = 0
-        for data_br, data_iso, total in saidas:
-            acum_saidas += total
+        for data_br, data_iso, total, acum_saidas in saidas:
             # Indicador de expansão
             expanded = data_iso in self.expanded_rodrigo_dates
             indicator = "▾" if expanded else "▸"
@@ -1497,64 +1493,54 @@ class GrowBotTUI(App):
         if event.data_table.id == "detail_table":
             return
 
-        row_key = str(event.row_key.value) if event.row_key else None
+        # Conexão só durante o clique (tabelas e entregas vêm do banco)
+        self._connect_db()
+        try:
+            row_key = str(event.row_key.value) if event.row_key else None
 
-        if row_key and row_key.startswith("driver_"):
-            # Expandir/colapsar driver
-            driver = row_key.replace("driver_", "")
-            if driver in self.expanded_drivers:
-                self.expanded_drivers.remove(driver)
-            else:
-                self.expanded_drivers.add(driver)
-            # Esconder painel de detalhes
-            detail_panel = self.query_one("#detail-panel", DetailPanel)
-            detail_panel.remove_class("visible")
-            self._refresh_table()
+            if row_key and row_key.startswith("driver_"):
+                # Expandir/colapsar driver
+                driver = row_key.replace("driver_", "")
+                if driver in self.expanded_drivers:
+                    self.expanded_drivers.remove(driver)
+                else:
+                    self.expanded_drivers.add(driver)
+                # Esconder painel de detalhes
+                detail_panel = self.query_one("#detail-panel", DetailPanel)
+                detail_panel.remove_class("visible")
+                self._refresh_table()
 
-        elif row_key and row_key.startswith("prod_"):
-            # Toggle expansão do produto (mostrar entregas inline)
-            parts = row_key.replace("prod_", "").split("_", 1)
-            if len(parts) == 2:
-                driver, produto = parts
-                expand_key = (driver, produto)
+            elif row_key and row_key.startswith("prod_"):
+                # Toggle expansão do produto (mostrar entregas inline)
+                parts = row_key.replace("prod_", "").split("_", 1)
+                if len(parts) == 2:
+                    driver, produto = parts
+                    expand_key = (driver, produto)
 
-                # Toggle expansão
-                if expand_key in self.expanded_products:
-                    self.expanded_products.discard(expand_key)
-                else:
-                    self.expanded_products.add(expand_key)
+                    # Toggle expansão
+                    if expand_key in self.expanded_products:
+                        self.expanded_products.discard(expand_key)
+                    else:
+                        self.expanded_products.add(expand_key)
 
-                self._refresh_table()
-                # Também mostrar no DetailPanel lateral
-                self._show_product_details(driver, produto)
-
-        elif row_key and row_key.startswith("saida_"):
-            # Toggle expansão de saída na aba RODRIGO
-            data_iso = row_key.replace("saida_", "")
-            if data_iso in self.expanded_rodrigo_dates:
-                self.expanded_rodrigo_dates.discard(data_iso)
-            else:
-                self.expanded_rodrigo_dates.add(data_iso)
-            self._refresh_rodrigo()
+                    self._refresh_table()
+                    # Também mostrar no DetailPanel lateral
+                    self._show_product_details(driver, produto)
+
+            elif row_key and row_key.startswith("saida_"):
+                # Toggle expansão de saída na aba RODRIGO
+                data_iso = row_key.replace("saida_", "")
+                if data_iso in self.expanded_rodrigo_dates:
+                    self.expanded_rodrigo_dates.discard(data_iso)
+                else:
+                    self.expanded_rodrigo_dates.add(data_iso)
+                self._refresh_rodrigo()
+        finally:
+            self._disconnect_db()
 
     def _show_product_details(self, driver: str, produto: str) -> None:
         """Mostra detalhes das entregas de um produto"""
-        # Buscar entregas do JSON
-        all_entregas = load_entregas_from_json()
-
-        # Filtrar por driver e produto
-        data_ini = self._parse_date_br(self.data_inicio)
-        data_fim = self._parse_date_br(self.data_fim)
-
-        entregas_filtradas = []
-        for e in all_entregas:
-            if e.get("driver") != driver:
-                continue
-            if e.get("produto") != produto:
-                continue
-            if not self._date_in_range(e.get("data_entrega", ""), data_ini, data_fim):
-                continue
-            entregas_filtradas.append(e)
+        entregas_filtradas = self._get_entregas_produto(driver, produto)
 
         # Ordenar por data
         entregas_filtradas.sort(key=lambda x: x.get("data_entrega", ""), reverse=True)
@@ -1566,25 +1552,18 @@ class GrowBotTUI(App):
 
     def _get_entregas_produto(self, driver: str, produto: str) -> list:
         """Busca entregas de um produto no período filtrado"""
-        all_entregas = load_entregas_from_json()
-        data_ini = self._parse_date_br(self.data_inicio)
-        data_fim = self._parse_date_br(self.data_fim)
-
-        return [
-            e for e in all_entregas
-            if e.get("driver") == driver
-            and e.get("produto") == produto
-            and self._date_in_range(e.get("data_entrega", ""), data_ini, data_fim)
-        ]
+        return self._buscar_entregas(
+            data_inicio=self._parse_date_to_iso(self.data_inicio),
+            data_fim=self._parse_date_to_iso(self.data_fim),
+            driver=driver, produto=produto,
+        )
 
     def _get_entregas_rodrigo_data(self, data_br: str) -> list:
         """Busca entregas do RODRIGO em uma data específica"""
-        all_entregas = load_entregas_from_json()
-        return [
-            e for e in all_entregas
-            if e.get("driver") == "RODRIGO"
-            and e.get("data_entrega") == data_br
-        ]
+        data_iso = self._parse_date_to_iso(data_br)
+        if not data_iso:
+            return []
+        return self._buscar_entregas(data_inicio=data_iso, data_fim=data_iso, driver="RODRIGO")
 
     def _build_entrega_row(self, entrega: dict, num_colunas: int, is_last: bool = False) -> list:
         """Constrói linha de detalhe de entrega para exibição inline"""
@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+"""
+GrowBot Writer - processo único dono da conexão de escrita do DuckDB.
+
+Recebe comandos (um JSON por linha) num socket Unix, aplica em lote na mesma
+conexão e publica um snapshot por lote (group commit: "importar" seguidos
+gravam numa transação, com um só recálculo das derivadas). Os demais componentes
+usam as funções de cliente abaixo; sem writer rodando, elas gravam no próprio
+processo. Conexões com o comando "assinar" recebem os eventos novos de
+alertas_saldo_log depois de cada lote.
+
+    python writer.py           # Sobe o writer
+    python writer.py status    # Estado do writer
+    python writer.py alertas   # Acompanha alertas de saldo (negativo/recuperado)
+"""
+
+import asyncio
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date
+from pathlib import Path
+
+from db import DB_PATH, GrowBotDB, snapshot_atual
+
+SOCKET_PATH = DB_PATH.with_name("growbot_writer.sock")
+
+# Comandos que escrevem no banco (o resto é leitura de status)
+COMANDOS_ESCRITA = ("sync", "importar", "reorganizar", "snapshot", "arquivar", "recanonicalizar")
+
+# Sem alerta por este tempo, o writer manda uma linha vazia ao assinante: a
+# escrita falha se ele desconectou e a conexão (thread + fila) é liberada
+KEEPALIVE_ASSINANTES = 5
+
+
+# ============ EXECUÇÃO ============
+
+def executar_lote(db: GrowBotDB, comandos: list) -> list:
+    """
+    Aplica os comandos em ordem na conexão de escrita e publica um único
+    snapshot no fim se algum deles alterou o banco. Retorna uma resposta
+    por comando ({"ok": True, ...} ou {"ok": False, "erro": ...})
+    """
+    respostas = []
+    alterado = False
+    sync_feito = None  # resposta do sync já rodado neste lote
+    importados = {}  # índice do comando -> resposta dos importar agrupados
+
+    for i, comando in enumerate(comandos):
+        nome = comando.get("comando")
+        if i in importados:
+            respostas.append(importados.pop(i))
+            continue
+        try:
+            if nome == "sync":
+                force = bool(comando.get("force"))
+                # Vários syncs no mesmo lote viram um só (o force vence)
+                if sync_feito is None or (force and not sync_feito["force"]):
+                    resultado = db.sync_all(force=force, workers=comando.get("workers"), publicar=False)
+                    alterado = alterado or resultado["alterado"]
+                    sync_feito = {"ok": True, "force": force, **resultado}
+                respostas.append(sync_feito)
+            elif nome == "importar":
+                # importar seguidos (mesmo force) gravam numa transação com um
+                # só recálculo das derivadas
+                force = bool(comando.get("force"))
+                fim = i + 1
+                while (fim < len(comandos) and comandos[fim].get("comando") == "importar"
+                       and bool(comandos[fim].get("force")) == force):
+                    fim += 1
+                importados = dict(zip(range(i, fim), _importar_grupo(db, comandos[i:fim], force)))
+                # publicar=False: grava já, o snapshot fica para um lote seguinte
+                alterado = alterado or any(r.get("registros", 0) > 0 and comandos[j].get("publicar", True)
+                                           for j, r in importados.items())
+                respostas.append(importados.pop(i))
+            elif nome == "reorganizar":
+                db.reorganizar()
+                alterado = True
+                respostas.append({"ok": True})
+            elif nome == "arquivar":
+                ate = date.fromisoformat(comando["ate"]) if comando.get("ate") else None
+                registros = db.arquivar(ate)
+                alterado = alterado or registros > 0
+                respostas.append({"ok": True, "registros": registros, "limite": db.limite_arquivo()})
+            elif nome == "recanonicalizar":
+                db.sync_aliases()
+                registros = db.recanonicalizar()
+                alterado = True
+                respostas.append({"ok": True, "registros": registros})
+            elif nome == "snapshot":
+                alterado = True
+                respostas.append({"ok": True})
+            else:
+                respostas.append({"ok": False, "erro": f"comando desconhecido: {nome}"})
+        except Exception as e:
+            respostas.append({"ok": False, "erro": f"{type(e).__name__}: {e}"})
+
+    if alterado:
+        db.publicar_snapshot()
+        snapshot = snapshot_atual(db.db_path).name
+        for resposta in respostas:
+            if resposta["ok"]:
+                resposta["snapshot"] = snapshot
+
+    return respostas
+
+
+def _importar_grupo(db: GrowBotDB, comandos: list, force: bool) -> list:
+    """
+    Importa os arquivos de vários comandos "importar" numa transação só
+    (GrowBotDB.sync_jsons). Se o grupo falhar, importa um a um para que só o
+    arquivo com problema responda erro
+    """
+    caminhos = [Path(c["arquivo"]) for c in comandos]
+    try:
+        return [{"ok": True, "registros": n} for n in db.sync_jsons(caminhos, force=force)]
+    except Exception:
+        if len(caminhos) == 1:
+            raise
+    respostas = []
+    for caminho in caminhos:
+        try:
+            respostas.append({"ok": True, "registros": db.sync_json(caminho, force=force, publicar=False)})
+        except Exception as e:
+            respostas.append({"ok": False, "erro": f"{type(e).__name__}: {e}"})
+    return respostas
+
+
+# ============ DAEMON ============
+
+class _Pedido:
+    """Comando na fila do writer, com a resposta preenchida pelo lote"""
+
+    def __init__(self, comando: dict):
+        self.comando = comando
+        self.resposta = None
+        self.pronto = threading.Event()
+
+
+class _Servidor(socketserver.ThreadingUnixStreamServer):
+    """Uma thread por conexão; backlog maior para rajadas de assinantes (SSE)"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Writer:
+    """Servidor do socket + thread que drena a fila em lotes"""
+
+    def __init__(self, db_path: Path = DB_PATH, socket_path: Path = SOCKET_PATH):
+        self.db_path = db_path
+        self.socket_path = socket_path
+        self.fila = queue.Queue()
+        self.assinantes = set()  # filas das conexões "assinar"
+        self.ultimo_alerta = 0  # id do último evento de alerta enviado
+        self.estado = {
+            "pid": os.getpid(),
+            "db": str(db_path),
+            "iniciado_em": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "ocupado": False,
+            "lotes": 0,
+            "comandos": 0,
+            "ultimo_lote": None,
+            "snapshot": None,
+        }
+
+    def _processar(self, db: GrowBotDB):
+        """Loop da conexão de escrita: pega tudo que está na fila e aplica junto"""
+        while True:
+            pedidos = [self.fila.get()]
+            while True:
+                try:
+                    pedidos.append(self.fila.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.estado["ocupado"] = True
+            inicio = time.perf_counter()
+            try:
+                respostas = executar_lote(db, [p.comando for p in pedidos])
+            except Exception as e:
+                # Falha fora de um comando (ex: publicar snapshot): ninguém fica esperando
+                respostas = [{"ok": False, "erro": f"{type(e).__name__}: {e}"}] * len(pedidos)
+            self.estado.update(
+                ocupado=False,
+                lotes=self.estado["lotes"] + 1,
+                comandos=self.estado["comandos"] + len(pedidos),
+                snapshot=snapshot_atual(self.db_path).name,
+                ultimo_lote={
+                    "comandos": dict(Counter(p.comando.get("comando") for p in pedidos)),
+                    "segundos": round(time.perf_counter() - inicio, 3),
+                    "fim": time.strftime("%Y-%m-%d %H:%M:%S"),
+                },
+            )
+            for pedido, resposta in zip(pedidos, respostas):
+                pedido.resposta = resposta
+                pedido.pronto.set()
+            self._avisar_assinantes(db)
+
+    def _avisar_assinantes(self, db: GrowBotDB):
+        """Manda aos assinantes os eventos de alerta gravados desde o último lote"""
+        eventos = db.alertas_log(self.ultimo_alerta, limite=10_000)
+        if not eventos:
+            return
+        self.ultimo_alerta = eventos[-1]["id"]
+        for assinante in list(self.assinantes):
+            for evento in eventos:
+                assinante.put(evento)
+
+    def rodar(self):
+        """Sobe o writer (bloqueia até Ctrl+C)"""
+        if writer_ativo(self.socket_path):
+            raise RuntimeError(f"Writer já rodando em {self.socket_path}")
+        self.socket_path.unlink(missing_ok=True)  # socket órfão de execução anterior
+
+        # Abre a conexão antes de aceitar comandos (falha aqui se o arquivo estiver em uso)
+        db = GrowBotDB(self.db_path, read_only=False)
+        # Leitores não migram snapshots: schema novo exige geração nova
+        if db.migrado or snapshot_atual(self.db_path) == self.db_path:
+            db.publicar_snapshot()
+        self.estado["snapshot"] = snapshot_atual(self.db_path).name
+        eventos = db.conn.execute("SELECT MAX(id) FROM alertas_saldo_log").fetchone()[0]
+        self.ultimo_alerta = eventos or 0
+
+        writer = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for linha in self.rfile:
+                    try:
+                        comando = json.loads(linha)
+                    except json.JSONDecodeError:
+                        resposta = {"ok": False, "erro": "JSON inválido"}
+                    else:
+                        if comando.get("comando") == "status":
+                            resposta = {"ok": True, "fila": writer.fila.qsize(),
+                                        "assinantes": len(writer.assinantes), **writer.estado}
+                        elif comando.get("comando") == "assinar":
+                            self.assinar()
+                            return
+                        else:
+                            pedido = _Pedido(comando)
+                            writer.fila.put(pedido)
+                            pedido.pronto.wait()
+                            resposta = pedido.resposta
+                    self.wfile.write(json.dumps(resposta, default=str).encode("utf-8") + b"\n")
+
+            def assinar(self):
+                """
+                Mantém a conexão aberta escrevendo um evento de alerta por linha
+                (linha vazia de keepalive a cada KEEPALIVE_ASSINANTES sem evento)
+                """
+                eventos = queue.Queue()
+                writer.assinantes.add(eventos)
+                try:
+                    self.wfile.write(b'{"ok": true}\n')
+                    while True:
+                        try:
+                            evento = eventos.get(timeout=KEEPALIVE_ASSINANTES)
+                        except queue.Empty:
+                            self.wfile.write(b"\n")
+                            continue
+                        self.wfile.write(json.dumps(evento, default=str).encode("utf-8") + b"\n")
+                except OSError:
+                    pass  # assinante desconectou
+                finally:
+                    writer.assinantes.discard(eventos)
+
+        # SIGTERM encerra como Ctrl+C (fecha a conexão e remove o socket)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        threading.Thread(target=self._processar, args=(db,), name="growbot-writer", daemon=True).start()
+        with _Servidor(str(self.socket_path), Handler) as servidor:
+            try:
+                servidor.serve_forever()
+            finally:
+                self.socket_path.unlink(missing_ok=True)
+                db.close()
+
+
+# ============ CLIENTE ============
+
+def writer_ativo(socket_path: Path = SOCKET_PATH) -> bool:
+    """Verifica se há um writer aceitando conexões no socket"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(str(socket_path))
+        return True
+    except OSError:
+        return False
+
+
+def enviar(comando: str, socket_path: Path = SOCKET_PATH, **args) -> dict:
+    """Envia um comando ao writer e espera a resposta do lote"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(str(socket_path))
+        s.sendall(json.dumps({"comando": comando, **args}).encode("utf-8") + b"\n")
+        with s.makefile("rb") as f:
+            linha = f.readline()
+    if not linha:
+        raise ConnectionError("Writer fechou a conexão sem responder")
+    return json.loads(linha)
+
+
+def assinar_alertas(socket_path: Path = SOCKET_PATH, timeout: float = None):
+    """
+    Gera os eventos de alertas_saldo_log conforme o writer grava (dicts com
+    driver, produto, evento, saldo...). Com `timeout`, gera None a cada
+    `timeout` segundos sem evento (para o chamador poder parar)
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(str(socket_path))
+        s.sendall(json.dumps({"comando": "assinar"}).encode("utf-8") + b"\n")
+        s.settimeout(timeout)
+        pendente = b""
+        confirmado = False
+        while True:
+            try:
+                dados = s.recv(65536)
+            except socket.timeout:
+                yield None
+                continue
+            if not dados:
+                return
+            pendente += dados
+            *linhas, pendente = pendente.split(b"\n")
+            for linha in linhas:
+                if not linha.strip():
+                    continue  # keepalive do writer
+                if not confirmado:
+                    confirmado = True  # {"ok": true} da assinatura
+                    continue
+                yield json.loads(linha)
+
+
+async def assinar_alertas_async(socket_path: Path = SOCKET_PATH, timeout: float = None):
+    """
+    assinar_alertas com asyncio (não ocupa thread enquanto espera): para o
+    SSE da API. Com `timeout`, gera None a cada `timeout` segundos sem evento
+    """
+    leitor, escritor = await asyncio.open_unix_connection(str(socket_path))
+    try:
+        escritor.write(json.dumps({"comando": "assinar"}).encode("utf-8") + b"\n")
+        await escritor.drain()
+        confirmado = False
+        while True:
+            try:
+                linha = await asyncio.wait_for(leitor.readline(), timeout)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if not linha:
+                return
+            if not linha.strip():
+                continue  # keepalive do writer
+            if not confirmado:
+                confirmado = True  # {"ok": true} da assinatura
+                continue
+            yield json.loads(linha)
+    finally:
+        escritor.close()
+
+
+def executar(comando: str, db_path: Path = DB_PATH, socket_path: Path = SOCKET_PATH, **args) -> dict:
+    """
+    Executa um comando de escrita: pelo writer se estiver rodando, senão
+    abrindo a conexão de escrita neste processo
+    """
+    if writer_ativo(socket_path):
+        return enviar(comando, socket_path, **args)
+    db = GrowBotDB(db_path, read_only=False)
+    try:
+        if db.migrado:
+            db.publicar_snapshot()  # leitores não migram snapshots
+        return executar_lote(db, [{"comando": comando, **args}])[0]
+    finally:
+        db.close()
+
+
+def sincronizar(force: bool = False, workers: int = None, db_path: Path = DB_PATH) -> dict:
+    """Sync de output/ (mesmo resumo de GrowBotDB.sync_all)"""
+    return executar("sync", db_path, force=force, workers=workers)
+
+
+def importar(json_path: Path, db_path: Path = DB_PATH, publicar: bool = True) -> dict:
+    """
+    Importa um JSON (GrowBotDB.sync_json); resposta com `registros`.
+    publicar=False não publica snapshot (quem chamou manda "snapshot" depois)
+    """
+    return executar("importar", db_path, arquivo=str(Path(json_path).resolve()), publicar=publicar)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "status":
+        if not writer_ativo():
+            print("Writer parado")
+            return
+        estado = enviar("status")
+        print(f"Writer pid {estado['pid']} desde {estado['iniciado_em']} ({estado['db']})")
+        print(f"  Fila: {estado['fila']} | Ocupado: {estado['ocupado']} | Assinantes: {estado['assinantes']}")
+        print(f"  Lotes: {estado['lotes']} | Comandos: {estado['comandos']}")
+        print(f"  Snapshot: {estado['snapshot']}")
+        if estado["ultimo_lote"]:
+            ultimo = estado["ultimo_lote"]
+            comandos = ", ".join(f"{n}x {c}" for c, n in ultimo["comandos"].items())
+            print(f"  Último lote: {comandos} em {ultimo['segundos']}s ({ultimo['fim']})")
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "alertas":
+        if not writer_ativo():
+            print("Writer parado")
+            return
+        print("Aguardando alertas (Ctrl+C para sair)")
+        try:
+            for evento in assinar_alertas():
+                sinal = "⚠️ " if evento["evento"] == "negativo" else "✓ "
+                print(f"{sinal}{evento['driver']} - {evento['produto']}: {evento['evento']} "
+                      f"(saldo {evento['saldo']}, {evento['data_movimento']})")
+        except KeyboardInterrupt:
+            pass
+        return
+
+    print(f"Writer escutando em {SOCKET_PATH}")
+    try:
+        Writer().rodar()
+    except KeyboardInterrupt:
+        print("\nWriter encerrado")
+
+
+if __name__ == "__main__":
+    main()